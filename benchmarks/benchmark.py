@@ -0,0 +1,192 @@
+"""
+Time the zInvertedBlendShape hot paths outside of Maya, using the stand-in API in fake_maya.
+
+    python benchmarks/benchmark.py
+    python benchmarks/benchmark.py --vertices 1000,10000 --densities 0.01,1 --repeat 5
+
+Each benchmark runs on a synthetic mesh for each combination of vertex count and tweak
+density (the fraction of vertices that have been sculpted), and reports the best time and
+the throughput in vertices per second.  The fake API is much simpler than Maya's, so the
+numbers are only meaningful compared to other runs on the same machine.  Without NumPy,
+the largest meshes are slow.
+"""
+
+import argparse, atexit, imp, math, os, shutil, sys, tempfile, timeit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'scripts'))
+
+import fake_maya
+fake_maya.install()
+
+import maya.OpenMaya as OpenMaya
+import zInvertedBlendShapeMath
+
+# The plugin has the same module name as the script, so load it under another name.
+plugin = imp.load_source('zInvertedBlendShapePlugin', os.path.join(root, 'plug-ins', 'zInvertedBlendShape.py'))
+
+plugin.initialize()
+node_class = plugin.zInvertedBlendShape
+
+# Corrective files are written here.
+temp_dir = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, temp_dir, True)
+
+def synthetic_points(count, offset=0):
+    """
+    Return a flat list of x, y, z values for count points on a wavy grid.
+    """
+    width = max(1, int(math.sqrt(count)))
+    values = []
+    for i in xrange(count):
+        x, z = i % width, i // width
+        values.extend((x + offset, math.sin(x * 0.1) * math.cos(z * 0.1), z))
+    return values
+
+def synthetic_matrices(count):
+    """
+    Return a matrix buffer with a different rotation and scale for each vertex, like a
+    skinned pose would have.
+    """
+    values = []
+    for i in xrange(count):
+        angle = (i % 360) * math.pi / 180
+        scale = 1 + (i % 7) * 0.05
+        c, s = math.cos(angle) * scale, math.sin(angle) * scale
+        values.extend((c, 0, -s, 0, scale, 0, s, 0, c))
+    return zInvertedBlendShapeMath.matrix_buffer(values)
+
+def synthetic_tweaks(count, density):
+    """
+    Return a dict of tweaks for about count * density evenly spaced vertices.  If density
+    is 0, this is just the zero placeholder tweak that new deformers have.
+    """
+    if density == 0:
+        return {0: (0.0, 0.0, 0.0)}
+
+    step = max(1, int(round(1 / density)))
+    return dict((idx, (0.01 * (idx % 5 + 1), -0.02, 0.005 * (idx % 3 + 1))) for idx in xrange(0, count, step))
+
+class Scene(object):
+    """
+    A deformer node with a synthetic mesh, matrices and tweaks.
+    """
+    def __init__(self, count, density):
+        self.count = count
+        self.node = node_class()
+        self.data_block = self.node._forceCache()
+
+        mesh = fake_maya.MeshData.from_values(synthetic_points(count))
+        self.data_block.set(plugin.MPxGeometryFilter_input, {0: {plugin.MPxGeometryFilter_inputGeom: mesh, plugin.MPxGeometryFilter_groupId: 0}})
+        self.output_plug = OpenMaya.MPlug(self.node.thisMObject(), plugin.MPxGeometryFilter_outputGeom).elementByLogicalIndex(0)
+
+        self.matrices = synthetic_matrices(count)
+        forward_matrices = zInvertedBlendShapeMath.invert_matrices(self.matrices)
+        self.node.set_inversion_matrices(self.matrices, forward_matrices)
+
+        self.tweaks = synthetic_tweaks(count, density)
+        self.data_block.set(node_class.tweak_attr, dict(self.tweaks))
+        self.data_block.set(node_class.enable_tweak_attr, True)
+
+        # Fill in .invertedTweak.
+        self.node.set_inverted_from_tweak(self.data_block)
+
+    def get_matrices(self):
+        # Time reading the matrices back from the packed blob, like when a scene is loaded.
+        self.node.cached_inversion_matrices = None
+        return lambda: self.node.get_matrices(self.data_block)
+
+    def set_inverted_from_tweak(self):
+        self.node.dirty_tweak_indices = None
+        return lambda: self.node.set_inverted_from_tweak(self.data_block)
+
+    def set_inverted_from_tweak_stroke(self):
+        # A brush stroke touching up to 1000 of the tweaked vertices.
+        indices = sorted(self.tweaks)
+        stroke = set(indices[len(indices)//2:len(indices)//2 + 1000])
+        def run():
+            self.node.dirty_tweak_indices = set(stroke)
+            self.node.set_inverted_from_tweak(self.data_block)
+        return run
+
+    def get_tweak_array_from_inverted(self):
+        builder = OpenMaya.MArrayDataBuilder(self.data_block, node_class.tweak_attr, 0)
+        return lambda: self.node.get_tweak_array_from_inverted(self.data_block, builder)
+
+    def compute(self):
+        return lambda: self.node.compute(self.output_plug, self.data_block)
+
+    def write_corrective(self):
+        path = os.path.join(temp_dir, 'corrective.zibs')
+        return lambda: self.node.write_corrective(path, True)
+
+    def read_corrective(self):
+        # Streaming a corrective and its matrices into a rebuilt rig.
+        path = os.path.join(temp_dir, 'corrective.zibs')
+        self.node.write_corrective(path, True)
+        return lambda: self.node.read_corrective(path, True)
+
+    def solve_inversion_matrices(self):
+        # The Update Pose solve from probed points, and storing the result on the node.
+        base = synthetic_points(self.count)
+        probes = [zInvertedBlendShapeMath.point_buffer([value + (0.5 if i % 3 == axis else 0.1) for i, value in enumerate(base)]) for axis in xrange(3)]
+        base = zInvertedBlendShapeMath.point_buffer(base)
+        def run():
+            matrices, jacobians, singular = zInvertedBlendShapeMath.solve_inversion_matrices(base, *probes)
+            self.node.set_inversion_matrices(matrices, jacobians, singular)
+        return run
+
+benchmarks = [
+    'get_matrices',
+    'set_inverted_from_tweak',
+    'set_inverted_from_tweak_stroke',
+    'get_tweak_array_from_inverted',
+    'compute',
+    'write_corrective',
+    'read_corrective',
+    'solve_inversion_matrices',
+]
+
+def time_benchmark(scene, name, repeat):
+    """
+    Return the best time of repeat runs of a benchmark, in seconds.
+    """
+    best = None
+    for i in xrange(repeat):
+        func = getattr(scene, name)()
+        start = timeit.default_timer()
+        func()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def parse_list(value, type):
+    return [type(item) for item in value.split(',') if item]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark zInvertedBlendShape outside of Maya.')
+    parser.add_argument('--vertices', default='1000,10000,100000,1000000', help='comma-separated vertex counts')
+    parser.add_argument('--densities', default='0,0.01,0.1,1', help='comma-separated fractions of vertices with tweaks')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, keeping the best')
+    parser.add_argument('--only', default='', help='comma-separated benchmarks to run: %s' % ', '.join(benchmarks))
+    args = parser.parse_args(argv)
+
+    names = parse_list(args.only, str) or benchmarks
+    for name in names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: %s' % name)
+
+    print 'NumPy: %s' % ('yes' if zInvertedBlendShapeMath.has_numpy() else 'no')
+    print '%10s %8s %8s  %-32s %12s %14s' % ('vertices', 'density', 'tweaks', 'benchmark', 'best (ms)', 'vertices/s')
+    for count in parse_list(args.vertices, int):
+        for density in parse_list(args.densities, float):
+            scene = Scene(count, density)
+            for name in names:
+                elapsed = time_benchmark(scene, name, args.repeat)
+                rate = count / elapsed if elapsed > 0 else float('inf')
+                print '%10i %8g %8i  %-32s %12.2f %14.0f' % (count, density, len(scene.tweaks), name, elapsed * 1000, rate)
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
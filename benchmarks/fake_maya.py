@@ -0,0 +1,498 @@
+"""
+A small stand-in for the parts of the Maya API that the zInvertedBlendShape plugin uses, so
+its hot paths can be run and timed outside of Maya.
+
+This only implements what the plugin's compute paths actually call, and only as much of it
+as they need.  Attribute values live in plain dictionaries in MDataBlock: array attributes
+are dicts from logical index to value, and compound elements are dicts from child attribute
+to value.  Meshes are MeshData, which holds its points in a ctypes float array so
+MFnMesh.getRawPoints works like it does in Maya.
+
+Call install() before importing the plugin.  This replaces any real Maya modules.
+"""
+
+import bisect, ctypes, sys, types
+
+class MObject(object):
+    def __init__(self, node=None):
+        self.node = node
+
+    def isNull(self):
+        return self.node is None
+
+class Attribute(MObject):
+    """
+    An attribute MObject.  The default is what the data block returns before anything is set.
+    """
+    def __init__(self, name, default=None, array=False):
+        super(Attribute, self).__init__(self)
+        self.name = name
+        self.default = default
+        self.array = array
+
+    def __repr__(self):
+        return '<Attribute %s>' % self.name
+
+class MTypeId(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, MTypeId) and self.value == other.value
+
+class MGlobal(object):
+    @staticmethod
+    def apiVersion():
+        return 201700
+
+class MFnData(object):
+    kString, kIntArray, kMesh = range(3)
+
+class MFnNumericData(object):
+    kFloat, kBoolean, kInt, kShort = range(4)
+
+class _AttributeFn(object):
+    """
+    The attribute function sets.  Only the default value and whether the attribute is an
+    array matter here, so the other setters do nothing.
+    """
+    def __init__(self):
+        self.attr = None
+
+    def create(self, name, short_name, data_type=None, default=None):
+        self.attr = Attribute(name, default)
+        return self.attr
+
+    def createPoint(self, name, short_name):
+        self.attr = Attribute(name, (0.0, 0.0, 0.0))
+        return self.attr
+
+    def setArray(self, value):
+        self.attr.array = value
+
+    def __getattr__(self, name):
+        if name.startswith('set') or name.startswith('add'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+class MFnNumericAttribute(_AttributeFn):
+    def create(self, name, short_name, data_type, default=0):
+        return super(MFnNumericAttribute, self).create(name, short_name, data_type, default)
+
+class MFnEnumAttribute(_AttributeFn):
+    def create(self, name, short_name, default=0):
+        return super(MFnEnumAttribute, self).create(name, short_name, None, default)
+
+class MFnTypedAttribute(_AttributeFn): pass
+class MFnMatrixAttribute(_AttributeFn): pass
+class MFnCompoundAttribute(_AttributeFn): pass
+
+class MeshData(object):
+    """
+    Mesh data, holding count float32 points.  groups maps a group ID to the list of vertices
+    in it, for deformer sets that don't cover the whole mesh.
+    """
+    def __init__(self, points, groups=None):
+        self.points = points
+        self.groups = groups or {}
+
+    @classmethod
+    def from_values(cls, values):
+        points = (ctypes.c_float * len(values))()
+        points[:] = values
+        return cls(points)
+
+    def copy(self):
+        return MeshData(type(self.points).from_buffer_copy(self.points), dict(self.groups))
+
+    def count(self):
+        return len(self.points) // 3
+
+class MFnMesh(object):
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def getRawPoints(self):
+        return ctypes.addressof(self.mesh.points)
+
+    def numVertices(self):
+        return self.mesh.count()
+
+    def getPoint(self, idx, point):
+        point.x, point.y, point.z = self.mesh.points[idx*3:idx*3+3]
+
+    def setPoint(self, idx, point):
+        self.mesh.points[idx*3:idx*3+3] = [point.x, point.y, point.z]
+
+class MPoint(object):
+    __slots__ = ('x', 'y', 'z', 'w')
+    def __init__(self, x=0.0, y=0.0, z=0.0, w=1.0):
+        self.x, self.y, self.z, self.w = x, y, z, w
+
+    def __getitem__(self, idx):
+        return (self.x, self.y, self.z, self.w)[idx]
+
+class MPointArray(object):
+    def __init__(self, other=None):
+        self.points = []
+        if other is not None:
+            self.points = [MPoint(p.x, p.y, p.z) for p in other.points]
+
+    def length(self):
+        return len(self.points)
+
+    def __getitem__(self, idx):
+        return self.points[idx]
+
+    def set(self, idx, x, y, z):
+        self.points[idx] = MPoint(x, y, z)
+
+class MItGeometry(object):
+    def __init__(self, handle, group_id, write):
+        self.mesh = handle.asMesh()
+        self.indices = self.mesh.groups.get(group_id, range(self.mesh.count()))
+        self.position_index = 0
+
+    def count(self):
+        return len(self.indices)
+
+    def isDone(self):
+        return self.position_index >= len(self.indices)
+
+    def next(self):
+        self.position_index += 1
+
+    def index(self):
+        return self.indices[self.position_index]
+
+    def position(self):
+        idx = self.index()
+        return MPoint(*self.mesh.points[idx*3:idx*3+3])
+
+    def setPosition(self, point):
+        idx = self.index()
+        self.mesh.points[idx*3:idx*3+3] = [point.x, point.y, point.z]
+
+    def allPositions(self, point_array):
+        values = self.mesh.points
+        point_array.points = [MPoint(values[i*3], values[i*3+1], values[i*3+2]) for i in self.indices]
+
+    def setAllPositions(self, point_array):
+        for idx, point in zip(self.indices, point_array.points):
+            self.mesh.points[idx*3:idx*3+3] = [point.x, point.y, point.z]
+
+class MMatrix(object):
+    def __init__(self):
+        self.values = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+
+class MVector(object):
+    __slots__ = ('x', 'y', 'z')
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x, self.y, self.z = x, y, z
+
+    def __getitem__(self, idx):
+        return (self.x, self.y, self.z)[idx]
+
+    def __mul__(self, matrix):
+        # Vectors are rows, and ignore the translation.
+        m = matrix.values
+        x, y, z = self.x, self.y, self.z
+        return MVector(
+            x*m[0] + y*m[4] + z*m[8],
+            x*m[1] + y*m[5] + z*m[9],
+            x*m[2] + y*m[6] + z*m[10])
+
+class MScriptUtil(object):
+    @staticmethod
+    def createMatrixFromList(values, matrix):
+        matrix.values = list(values)
+
+class MIntArray(list):
+    def length(self):
+        return len(self)
+
+class MFnIntArrayData(object):
+    def __init__(self, data=None):
+        self.data = data
+
+    def create(self, values):
+        return _Value(list(values))
+
+    def array(self):
+        return MIntArray(self.data.node)
+
+class _Value(MObject):
+    """
+    An MObject holding a value, for MDataHandle.data() and MFnIntArrayData.create().
+    """
+
+class MDataHandle(object):
+    """
+    A handle to container[key].
+    """
+    def __init__(self, container, key):
+        self.container = container
+        self.key = key
+
+    def value(self):
+        return self.container[self.key]
+
+    def asFloat(self): return float(self.value())
+    def asShort(self): return int(self.value())
+    def asLong(self): return int(self.value())
+    def asBool(self): return bool(self.value())
+    def asString(self): return self.value() or ''
+    def asFloat3(self): return self.value()
+    def asMesh(self): return self.value()
+
+    def data(self):
+        return _Value(self.value())
+
+    def type(self):
+        if isinstance(self.value(), MeshData):
+            return MFnData.kMesh
+        return None
+
+    def child(self, attr):
+        return MDataHandle(self.value(), attr)
+
+    def copy(self, other):
+        self.container[self.key] = other.value().copy()
+
+    def setMObject(self, value):
+        self.container[self.key] = value.node
+
+    def set3Float(self, x, y, z):
+        self.container[self.key] = (x, y, z)
+
+    def setString(self, value):
+        self.container[self.key] = value
+
+class MArrayDataBuilder(object):
+    def __init__(self, data_block=None, attr=None, count=0, elements=None):
+        self.elements = dict(elements or {})
+
+    def addElement(self, idx):
+        self.elements.setdefault(idx, (0.0, 0.0, 0.0))
+        return MDataHandle(self.elements, idx)
+
+    def removeElement(self, idx):
+        if idx not in self.elements:
+            raise RuntimeError('kInvalidParameter: No element at given index')
+        del self.elements[idx]
+
+class MArrayDataHandle(object):
+    def __init__(self, handle, data_block=None, attr=None):
+        # Like Maya, this can be constructed from an MDataHandle to an array.
+        if isinstance(handle, MDataHandle):
+            handle = handle.value()
+        self.elements = handle
+        self.data_block = data_block
+        self.attr = attr
+        self.indices = sorted(handle)
+        self.position = 0
+
+    def elementIndex(self):
+        if self.position >= len(self.indices):
+            raise RuntimeError('kInvalidParameter: No element at current index')
+        return self.indices[self.position]
+
+    def next(self):
+        self.position += 1
+        if self.position >= len(self.indices):
+            raise RuntimeError('kFailure: Past the end of the array')
+
+    def jumpToElement(self, idx):
+        if idx not in self.elements:
+            raise RuntimeError('kInvalidParameter: No element at given index')
+        self.position = bisect.bisect_left(self.indices, idx)
+
+    def jumpToArrayElement(self, position):
+        if position >= len(self.indices):
+            raise RuntimeError('kInvalidParameter: No element at given index')
+        self.position = position
+
+    def inputValue(self):
+        return MDataHandle(self.elements, self.elementIndex())
+    outputValue = inputValue
+
+    def builder(self):
+        return MArrayDataBuilder(elements=self.elements)
+
+    def set(self, builder):
+        self.data_block.values[self.attr] = builder.elements
+        self.elements = builder.elements
+        self.indices = sorted(builder.elements)
+        self.position = 0
+
+    def setAllClean(self):
+        pass
+
+class MDataBlock(object):
+    def __init__(self):
+        self.values = {}
+
+    def _container(self, attr):
+        if attr not in self.values:
+            self.values[attr] = {} if attr.array else attr.default
+        return self.values
+
+    def set(self, attr, value):
+        self.values[attr] = value
+
+    def get(self, attr):
+        return self._container(attr)[attr]
+
+    def inputValue(self, attr):
+        if isinstance(attr, MPlug):
+            attr = attr.attribute()
+        return MDataHandle(self._container(attr), attr)
+
+    def outputValue(self, plug):
+        # Output geometry is stored by element, so a plug with an index gets its own handle.
+        if isinstance(plug, MPlug) and plug.index is not None:
+            return MDataHandle(self._container(plug.attr)[plug.attr], plug.index)
+        return self.inputValue(plug)
+
+    def inputArrayValue(self, attr):
+        return MArrayDataHandle(self._container(attr)[attr], self, attr)
+    outputArrayValue = inputArrayValue
+
+    def setClean(self, plug):
+        pass
+
+    def context(self):
+        return None
+
+class MPlug(object):
+    def __init__(self, node=None, attr=None, index=None):
+        self.node = node
+        self.attr = attr
+        self.index = index
+
+    def __eq__(self, other):
+        # Like Maya, comparing a plug to an attribute compares its attribute.
+        if isinstance(other, MPlug):
+            return self.attr is other.attr and self.index == other.index
+        return self.attr is other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def attribute(self):
+        return self.attr
+
+    def isChild(self):
+        return False
+
+    def isElement(self):
+        return self.index is not None
+
+    def logicalIndex(self):
+        return self.index
+
+    def elementByLogicalIndex(self, idx):
+        return MPlug(self.node, self.attr, idx)
+
+    def _data_block(self):
+        return self.node.node._forceCache()
+
+    def asMObject(self, context=None):
+        return MObject()
+
+    def asBool(self):
+        return self._data_block().inputValue(self.attr).asBool()
+
+    def _set_internal(self, value):
+        data_block = self._data_block()
+        data_block.set(self.attr, value)
+        self.node.node.setInternalValueInContext(self, data_block.inputValue(self.attr), None)
+
+    def setString(self, value):
+        self._set_internal(value)
+
+    def setMObject(self, value):
+        self._set_internal(value.node)
+
+class MPxNode(object):
+    kDeformerNode = 0
+    kParallel, kSerial, kGloballySerial, kUntrusted = range(4)
+
+    def __init__(self):
+        self._data_block = MDataBlock()
+        self._object = MObject(self)
+
+    def thisMObject(self):
+        return self._object
+
+    def _forceCache(self):
+        return self._data_block
+
+    @classmethod
+    def addAttribute(cls, attr):
+        pass
+
+    @classmethod
+    def attributeAffects(cls, source, dest):
+        pass
+
+    def compute(self, plug, data):
+        raise RuntimeError('kUnknownParameter')
+
+    def setDependentsDirty(self, plug, plug_array):
+        pass
+
+    def setInternalValueInContext(self, plug, handle, context):
+        return False
+
+    def shouldSave(self, plug, is_saving):
+        return True
+
+class MPxDeformerNode(MPxNode):
+    pass
+
+class MPxCommand(object):
+    pass
+
+def _geometry_filter_attributes():
+    """
+    Return the MPxGeometryFilter and MPxDeformerNode attributes, under both of the names
+    the plugin might look for them by.
+    """
+    attrs = {
+        'outputGeom': Attribute('outputGeom', array=True),
+        'input': Attribute('input', array=True),
+        'inputGeom': Attribute('inputGeom'),
+        'groupId': Attribute('groupId', 0),
+        'envelope': Attribute('envelope', 1.0),
+        'weightList': Attribute('weightList', array=True),
+        'weights': Attribute('weights', array=True),
+    }
+
+    cvar = types.ModuleType('cvar')
+    for name, attr in attrs.items():
+        setattr(cvar, 'MPxDeformerNode_' + name, attr)
+        setattr(cvar, 'MPxGeometryFilter_' + name, attr)
+    return cvar
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def install():
+    """
+    Install the fake modules in sys.modules, replacing Maya if it's there.
+    """
+    names = dict(globals())
+    open_maya = _module('maya.OpenMaya', **dict((name, value) for name, value in names.items() if name.startswith('M')))
+    open_maya_mpx = _module('maya.OpenMayaMPx',
+            MPxNode=MPxNode, MPxDeformerNode=MPxDeformerNode, MPxCommand=MPxCommand,
+            cvar=_geometry_filter_attributes(), asMPxPtr=lambda node: node)
+    cmds = _module('maya.cmds')
+    utils = _module('maya.utils', executeDeferred=lambda func, *args: func(*args))
+    _module('maya', OpenMaya=open_maya, OpenMayaMPx=open_maya_mpx, cmds=cmds, utils=utils)
+
+    pymel_core = _module('pymel.core')
+    _module('pymel', core=pymel_core)
@@ -1,25 +1,26 @@
 import maya.OpenMayaMPx as OpenMayaMPx
 import maya.OpenMaya as OpenMaya
+import maya.cmds as cmds
+import maya.utils
 import pymel.core
-import math, traceback, time
-
-last_time = time.time()
-def log_time(s):
-    global last_time
-    delta = time.time() - last_time
-    last_time = time.time()
-    print '%f: %s' % (delta, s)
+import math, sys, traceback, time, timeit
+import zInvertedBlendShapeMath
 
 if OpenMaya.MGlobal.apiVersion() < 201600:
     MPxGeometryFilter_outputGeom = OpenMayaMPx.cvar.MPxDeformerNode_outputGeom
     MPxGeometryFilter_input = OpenMayaMPx.cvar.MPxDeformerNode_input
     MPxGeometryFilter_inputGeom = OpenMayaMPx.cvar.MPxDeformerNode_inputGeom
     MPxGeometryFilter_groupId = OpenMayaMPx.cvar.MPxDeformerNode_groupId
+    MPxGeometryFilter_envelope = OpenMayaMPx.cvar.MPxDeformerNode_envelope
 else:
     MPxGeometryFilter_outputGeom = outputGeom = OpenMayaMPx.cvar.MPxGeometryFilter_outputGeom
     MPxGeometryFilter_input = OpenMayaMPx.cvar.MPxGeometryFilter_input
     MPxGeometryFilter_inputGeom = OpenMayaMPx.cvar.MPxGeometryFilter_inputGeom
     MPxGeometryFilter_groupId = OpenMayaMPx.cvar.MPxGeometryFilter_groupId
+    MPxGeometryFilter_envelope = OpenMayaMPx.cvar.MPxGeometryFilter_envelope
+
+MPxDeformerNode_weightList = OpenMayaMPx.cvar.MPxDeformerNode_weightList
+MPxDeformerNode_weights = OpenMayaMPx.cvar.MPxDeformerNode_weights
 
 def array_current_index(array):
     """
@@ -95,40 +96,375 @@ def iterate_array_handle(array):
         except RuntimeError as e:
             break
 
+identity_matrix_values = [1, 0, 0, 0, 1, 0, 0, 0, 1]
+
+# If a mesh has more than this many vertices per tweak, compute moves the tweaked vertices one
+# by one instead of reading and writing all of the mesh's points.
+sparse_tweak_ratio = 8
+
+class NodeProfile(object):
+    """
+    Counters and accumulated timings for one deformer, so we can tell which deformers are
+    taking up evaluation time in a heavy scene.  These aren't saved, and are read and reset
+    with the zInvertedBlendShapeProfile command.
+    """
+    counter_names = [
+        'outputGeomComputes', 'outputGeomTime',
+        'invertedTweakRebuilds', 'invertedTweakUpdates', 'invertedTweakTime',
+        'tweakRecalculations', 'tweakRecalculationTime',
+        'matrixCacheHits', 'matrixCacheMisses',
+    ]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = dict.fromkeys(self.counter_names, 0)
+
+    def add(self, name, value=1):
+        self.counters[name] += value
+
+    def timer(self, count_name, time_name):
+        """
+        Return a context manager that increments count_name, and adds the time spent inside
+        it to time_name.
+        """
+        return _ProfileTimer(self, count_name, time_name)
+
+class _ProfileTimer(object):
+    def __init__(self, profile, count_name, time_name):
+        self.profile = profile
+        self.count_name = count_name
+        self.time_name = time_name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profile.add(self.count_name)
+        self.profile.add(self.time_name, timeit.default_timer() - self.start)
+
+def get_raw_points(geometry_handle):
+    """
+    Return a writable zInvertedBlendShapeMath point buffer viewing the points of the mesh
+    in geometry_handle.
+
+    Return None if the geometry isn't a mesh or NumPy isn't available.
+    """
+    if not zInvertedBlendShapeMath.has_numpy():
+        return None
+    if geometry_handle.type() != OpenMaya.MFnData.kMesh:
+        return None
+
+    mesh_fn = OpenMaya.MFnMesh(geometry_handle.asMesh())
+    return zInvertedBlendShapeMath.raw_point_view(int(mesh_fn.getRawPoints()), mesh_fn.numVertices())
+
 class zInvertedBlendShape(OpenMayaMPx.MPxDeformerNode):
     pluginNodeId = OpenMaya.MTypeId(0x124740)
 
     def __init__(self):
         super(zInvertedBlendShape, self).__init__()
         self.cached_inversion_matrices = None
+        self.cached_forward_matrices = None
+        self.cached_unsolved_vertices = None
 
-    def get_matrices(self, data_block):
-        """
-        Return a list of the current value of .inversionMatrices.
+        # This is true while set_inversion_matrices is setting attributes, so we don't throw
+        # away the caches it's about to fill in.
+        self.setting_inversion_matrices = False
+
+        # The current value of .invertedTweak as zInvertedBlendShapeMath tweak buffers.  This
+        # is thrown away when .invertedTweak is dirtied.
+        self.cached_inverted_tweak = None
+
+        # The tweaks compute applies: cached_inverted_tweak without its zero tweaks, and the
+        # cached_inverted_tweak it was made from.
+        self.applied_tweak = None
+        self.applied_tweak_source = None
+
+        # A packed .invertedTweakData blob that was loaded with the scene, which hasn't been
+        # expanded into .invertedTweak yet.
+        self.pending_inverted_tweak_data = None
+
+        # While saving with packed tweaks, the real value of .invertedTweak, and whether we're
+        # setting .invertedTweakData ourself.
+        self.saved_inverted_tweak = None
+        self.packing_inverted_tweak = False
+
+        # The .tweak elements that have changed since .invertedTweak was last updated, or None
+        # if the whole array needs to be updated.  tweak_changed is set when any of it changes.
+        self.dirty_tweak_indices = None
+        self.tweak_changed = False
 
-        This caches the value of the list.
+        # Painted weights for each geometry index, as zInvertedBlendShapeMath weight buffers,
+        # or None if there are no weights other than 1.  This is thrown away when the weights
+        # are dirtied.
+        self.cached_weights = {}
+
+        # Vertices that have been sculpted, but which are in .unsolvedVertices.  The script
+        # collects these with take_pending_vertices and fills in their matrices.
+        self.pending_vertices = set()
+
+        self.profile = NodeProfile()
+
+    def get_legacy_matrices(self, data_block):
         """
-        # This is accessed a lot, and unlike the tweaks it always contains a value for every vertex,
-        # so retrieving this is relatively expensive.  Cache the results.
-        if self.cached_inversion_matrices is not None:
-            return self.cached_inversion_matrices
+        Return the value of the old .inversionMatrix array as a matrix buffer, or None if
+        it's empty.
 
+        Scenes saved by older versions store a full matrix per vertex here.  These are moved
+        to .inversionMatrixData when the scene is loaded.
+        """
         matrix_array = data_block.inputArrayValue(zInvertedBlendShape.matrix_attr)
 
-        matrices = []
+        values = []
         for item in iterate_array_handle(matrix_array):
             idx = matrix_array.elementIndex()
 
             # If this is a sparse array, fill it in.
-            if idx > len(matrices):
-                matrices.extend([OpenMaya.MMatrix()] * (idx - len(matrices)))
+            if idx > len(values) // 9:
+                values.extend(identity_matrix_values * (idx - len(values) // 9))
 
             matrix = matrix_array.inputValue().asMatrix()
-            matrices.append(matrix)
+            for row in xrange(3):
+                for col in xrange(3):
+                    values.append(OpenMaya.MScriptUtil.getDoubleArrayItem(matrix[row], col))
+
+        if not values:
+            return None
+        return zInvertedBlendShapeMath.matrix_buffer(values)
+
+    def get_matrices(self, data_block):
+        """
+        Return the current inversion matrices as a zInvertedBlendShapeMath matrix buffer.
+
+        This caches the value of the buffer.
+        """
+        # This is accessed a lot, and unlike the tweaks it always contains a value for every vertex,
+        # so retrieving this is relatively expensive.  Cache the results.
+        if self.cached_inversion_matrices is not None:
+            self.profile.add('matrixCacheHits')
+            return self.cached_inversion_matrices
+
+        self.profile.add('matrixCacheMisses')
+        blob = data_block.inputValue(zInvertedBlendShape.matrix_data_attr).asString()
+        matrices = zInvertedBlendShapeMath.unpack_matrices(blob)
+
+        # If we don't have packed matrices yet, this is an old scene that hasn't been migrated.
+        if matrices is None:
+            matrices = self.get_legacy_matrices(data_block)
+        if matrices is None:
+            matrices = zInvertedBlendShapeMath.matrix_buffer([])
 
         self.cached_inversion_matrices = matrices
         return matrices
 
+    def get_inverted_tweak(self, data_block):
+        """
+        Return the current value of .invertedTweak as (indices, deltas) tweak buffers.
+
+        This caches the value.
+        """
+        # If the scene was saved with packed tweaks, expand them into .invertedTweak the first
+        # time they're needed.
+        if self.pending_inverted_tweak_data is not None:
+            tweaks = zInvertedBlendShapeMath.unpack_tweaks(self.pending_inverted_tweak_data)
+            self.pending_inverted_tweak_data = None
+            if tweaks is not None:
+                self.set_tweak_array(data_block, zInvertedBlendShape.inverted_tweak_attr, *tweaks)
+                self.tweak_changed = False
+
+        # If .tweak has changed, invert the changes ourself instead of pulling on .invertedTweak
+        # through a plug to get Maya to do it.  .tweak affects the output geometry, so we can
+        # read it from the data block, and compute never has to leave the data block.
+        if self.tweak_changed:
+            self.update_inverted_from_tweak(data_block)
+
+        if self.cached_inverted_tweak is not None:
+            return self.cached_inverted_tweak
+
+        inverted_tweak_data = data_block.inputArrayValue(zInvertedBlendShape.inverted_tweak_attr)
+
+        indices = []
+        deltas = []
+        for item in iterate_array_handle(inverted_tweak_data):
+            indices.append(inverted_tweak_data.elementIndex())
+            delta = inverted_tweak_data.inputValue().asFloat3()
+            deltas.extend((delta[0], delta[1], delta[2]))
+
+        self.cached_inverted_tweak = zInvertedBlendShapeMath.tweak_buffers(indices, deltas)
+        return self.cached_inverted_tweak
+
+    def get_applied_tweak(self, data_block):
+        """
+        Return the tweaks to apply to the output geometry, as (indices, deltas) tweak buffers.
+        This is .invertedTweak without any zero tweaks, so it's empty if nothing has been
+        sculpted.
+        """
+        tweaks = self.get_inverted_tweak(data_block)
+        if tweaks is not self.applied_tweak_source:
+            self.applied_tweak = zInvertedBlendShapeMath.nonzero_tweaks(*tweaks)
+            self.applied_tweak_source = tweaks
+        return self.applied_tweak
+
+    def get_weights(self, data_block, geometry_index):
+        """
+        Return the painted deformer weights for a geometry index as (indices, values) weight
+        buffers, or None if every weight is 1.
+
+        This caches the value.
+        """
+        if geometry_index in self.cached_weights:
+            return self.cached_weights[geometry_index]
+
+        weights = None
+        weight_list = data_block.inputArrayValue(MPxDeformerNode_weightList)
+        try:
+            weight_list.jumpToElement(geometry_index)
+        except RuntimeError as e:
+            # There's no weightList entry for this geometry, so everything has a weight of 1.
+            pass
+        else:
+            weight_array = OpenMaya.MArrayDataHandle(weight_list.inputValue().child(MPxDeformerNode_weights))
+
+            indices = []
+            values = []
+            for item in iterate_array_handle(weight_array):
+                indices.append(weight_array.elementIndex())
+                values.append(weight_array.inputValue().asFloat())
+
+            # If everything is 1, we can use the unweighted path.
+            if any(value != 1 for value in values):
+                weights = zInvertedBlendShapeMath.weight_buffers(indices, values)
+
+        self.cached_weights[geometry_index] = weights
+        return weights
+
+    def get_unsolved_vertices(self, data_block):
+        """
+        Return the set of vertices in .unsolvedVertices.
+
+        This caches the value of the set.
+        """
+        if self.cached_unsolved_vertices is not None:
+            return self.cached_unsolved_vertices
+
+        data = data_block.inputValue(zInvertedBlendShape.unsolved_vertices_attr).data()
+        ranges = []
+        if not data.isNull():
+            array = OpenMaya.MFnIntArrayData(data).array()
+            ranges = [array[i] for i in xrange(array.length())]
+
+        self.cached_unsolved_vertices = set(zInvertedBlendShapeMath.indices_from_ranges(ranges))
+        return self.cached_unsolved_vertices
+
+    def take_pending_vertices(self):
+        """
+        Return the sorted list of unsolved vertices that have been sculpted, and clear it.
+        """
+        pending = sorted(self.pending_vertices)
+        self.pending_vertices.clear()
+        return pending
+
+    def get_profile(self):
+        """
+        Return the profiling counters as a list of (name, value) pairs, followed by the number
+        of inverted tweaks and the memory used by the cached matrices.
+        """
+        result = [(name, self.profile.counters[name]) for name in self.profile.counter_names]
+
+        indices, deltas = self.get_inverted_tweak(self._forceCache())
+        result.append(('tweakCount', len(indices)))
+
+        matrix_bytes = 0
+        for matrices in (self.cached_inversion_matrices, self.cached_forward_matrices):
+            if matrices is not None:
+                matrix_bytes += zInvertedBlendShapeMath.matrix_nbytes(matrices)
+        result.append(('matrixBytes', matrix_bytes))
+        return result
+
+    def set_inversion_matrices(self, matrices, forward_matrices, unsolved_vertices=()):
+        """
+        Replace the inversion matrices, their forward Jacobians and the unsolved vertices
+        all at once.
+
+        matrices and forward_matrices are zInvertedBlendShapeMath matrix buffers, and
+        unsolved_vertices is a sorted list of vertex indices.  Each attribute is set once,
+        and the caches are filled in directly from the buffers instead of being thrown away
+        and read back.
+        """
+        data_block = self._forceCache()
+        double_precision = data_block.inputValue(zInvertedBlendShape.matrix_precision_attr).asShort() == 1
+
+        ranges = OpenMaya.MIntArray()
+        for value in zInvertedBlendShapeMath.index_ranges(unsolved_vertices):
+            ranges.append(value)
+
+        node = self.thisMObject()
+        self.setting_inversion_matrices = True
+        try:
+            blob = zInvertedBlendShapeMath.pack_matrices(forward_matrices, double_precision)
+            OpenMaya.MPlug(node, zInvertedBlendShape.jacobian_data_attr).setString(blob)
+
+            blob = zInvertedBlendShapeMath.pack_matrices(matrices, double_precision)
+            OpenMaya.MPlug(node, zInvertedBlendShape.matrix_data_attr).setString(blob)
+
+            ranges = OpenMaya.MFnIntArrayData().create(ranges)
+            OpenMaya.MPlug(node, zInvertedBlendShape.unsolved_vertices_attr).setMObject(ranges)
+        finally:
+            self.setting_inversion_matrices = False
+
+        self.cached_inversion_matrices = matrices
+        self.cached_forward_matrices = forward_matrices
+        self.cached_unsolved_vertices = set(unsolved_vertices)
+
+    def get_forward_matrices(self, data_block):
+        """
+        Return the forward Jacobians that the inversion matrices are the inverse of, as a
+        zInvertedBlendShapeMath matrix buffer.
+
+        These come from .jacobianData if it's been set since the scene was loaded.  Otherwise,
+        they're calculated from the inversion matrices.  This caches the value of the buffer.
+        """
+        if self.cached_forward_matrices is not None:
+            self.profile.add('matrixCacheHits')
+            return self.cached_forward_matrices
+
+        self.profile.add('matrixCacheMisses')
+
+        matrices = self.get_matrices(data_block)
+
+        blob = data_block.inputValue(zInvertedBlendShape.jacobian_data_attr).asString()
+        forward_matrices = zInvertedBlendShapeMath.unpack_matrices(blob)
+        if forward_matrices is None or zInvertedBlendShapeMath.matrix_count(forward_matrices) != zInvertedBlendShapeMath.matrix_count(matrices):
+            forward_matrices = zInvertedBlendShapeMath.invert_matrices(matrices)
+
+        self.cached_forward_matrices = forward_matrices
+        return forward_matrices
+
+    def migrate_legacy_matrices(self):
+        """
+        If this node has matrices in the old .inversionMatrix array, pack them into
+        .inversionMatrixData and clear the old array.
+
+        Return true if anything was migrated.
+        """
+        data_block = self._forceCache()
+        if data_block.inputValue(zInvertedBlendShape.matrix_data_attr).asString():
+            return False
+
+        matrices = self.get_legacy_matrices(data_block)
+        if matrices is None:
+            return False
+
+        double_precision = data_block.inputValue(zInvertedBlendShape.matrix_precision_attr).asShort() == 1
+        blob = zInvertedBlendShapeMath.pack_matrices(matrices, double_precision)
+        OpenMaya.MPlug(self.thisMObject(), zInvertedBlendShape.matrix_data_attr).setString(blob)
+
+        output_matrices = data_block.outputArrayValue(zInvertedBlendShape.matrix_attr)
+        output_matrices.set(OpenMaya.MArrayDataBuilder(data_block, zInvertedBlendShape.matrix_attr, 0))
+        output_matrices.setAllClean()
+        return True
+
     def get_one_tweak_from_inverted(self, data_block, start_index):
         """
         Given the current invertedTweak, return the current tweak data.
@@ -150,57 +486,301 @@ class zInvertedBlendShape(OpenMayaMPx.MPxDeformerNode):
         idx = inverted_tweak_data.elementIndex()
 
         delta = thisValue.asFloat3()
-        delta = OpenMaya.MVector(*delta)
-
-        offset = delta
-        if idx < len(matrices):
-            offset *= matrices[idx]
-
-        return offset
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers([idx], [delta[0], delta[1], delta[2]])
+        offsets = zInvertedBlendShapeMath.transform_tweaks(matrices, indices, deltas)
+        for idx, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, offsets):
+            return OpenMaya.MVector(x, y, z)
 
     def get_tweak_array_from_inverted(self, data_block, builder):
         """
-        Set .invertedTweak from the current value of .tweak and input matrices.
         Given the current invertedTweak, return the current tweak data.
+
+        The tweaks are multiplied by the forward Jacobians all at once, so this doesn't need
+        to invert any matrices.
         """
-        matrices = self.get_matrices(data_block)
+        forward_matrices = self.get_forward_matrices(data_block)
+        indices, deltas = self.get_inverted_tweak(data_block)
 
-        inverted_tweak_data = data_block.inputArrayValue(self.inverted_tweak_attr)
+        tweaks = zInvertedBlendShapeMath.transform_tweaks(forward_matrices, indices, deltas)
+        for idx, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, tweaks):
+            element = builder.addElement(idx)
+            element.set3Float(x, y, z)
 
-        for item in iterate_array_handle(inverted_tweak_data):
-            thisValue = inverted_tweak_data.inputValue()
+    def set_tweak_from_inverted(self, data_block):
+        """
+        Set .tweak from the current value of .invertedTweak and input matrices.
+        """
+        with self.profile.timer('tweakRecalculations', 'tweakRecalculationTime'):
+            output_tweak = data_block.outputArrayValue(self.tweak_attr)
+            builder = output_tweak.builder()
 
-            idx = inverted_tweak_data.elementIndex()
+            values = self.get_tweak_array_from_inverted(data_block, builder)
+            output_tweak.set(builder)
+            output_tweak.setAllClean()
 
-            delta = thisValue.asFloat3()
-            delta = OpenMaya.MVector(*delta)
+    def get_tweak(self, data_block):
+        """
+        Return the current value of .tweak as (indices, deltas) tweak buffers.
+        """
+        tweak_data = data_block.inputArrayValue(self.tweak_attr)
+
+        indices = []
+        deltas = []
+        for item in iterate_array_handle(tweak_data):
+            indices.append(tweak_data.elementIndex())
+            delta = tweak_data.inputValue().asFloat3()
+            deltas.extend((delta[0], delta[1], delta[2]))
 
-            if idx < len(matrices):
-                mat = matrices[idx]
-                mat = mat.inverse()
-                delta *= mat
+        return zInvertedBlendShapeMath.tweak_buffers(indices, deltas)
 
+    def set_tweak_array(self, data_block, attr, indices, deltas):
+        """
+        Replace .tweak or .invertedTweak with the contents of a pair of tweak buffers.
+        """
+        output_array = data_block.outputArrayValue(attr)
+        builder = OpenMaya.MArrayDataBuilder(data_block, attr, 0)
+        for idx, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, deltas):
             element = builder.addElement(idx)
-            element.set3Float(delta.x, delta.y, delta.z)
+            element.set3Float(x, y, z)
 
-    def set_tweak_from_inverted(self, data_block):
+        output_array.set(builder)
+        output_array.setAllClean()
+
+        if attr == self.inverted_tweak_attr:
+            self.cached_inverted_tweak = (indices, deltas)
+
+    def set_inverted_tweak(self, indices, deltas):
         """
-        Set .tweak from the current value of .invertedTweak and input matrices.
+        Replace .invertedTweak with the contents of a pair of tweak buffers.
         """
-        output_tweak = data_block.outputArrayValue(self.tweak_attr)
-        builder = output_tweak.builder()
+        self.set_tweak_array(self._forceCache(), self.inverted_tweak_attr, indices, deltas)
+
+    def pack_inverted_tweak(self):
+        """
+        Before saving, store .invertedTweak in .invertedTweakData if .invertedTweakPrecision
+        asks for it, and replace .invertedTweak with a placeholder so it isn't saved twice.
+        restore_inverted_tweak puts it back after saving.
+        """
+        data_block = self._forceCache()
+        precision = data_block.inputValue(zInvertedBlendShape.inverted_tweak_precision_attr).asShort()
+
+        blob = ''
+        if precision != 0:
+            tweaks = self.get_inverted_tweak(data_block)
+            storage = zInvertedBlendShapeMath.TWEAK_HALF if precision == 1 else zInvertedBlendShapeMath.TWEAK_INT16
+            blob = zInvertedBlendShapeMath.pack_tweaks(tweaks[0], tweaks[1], storage)
+
+        # Always set this, so a blob from an earlier save isn't left behind.
+        self.packing_inverted_tweak = True
+        try:
+            OpenMaya.MPlug(self.thisMObject(), zInvertedBlendShape.inverted_tweak_data_attr).setString(blob)
+        finally:
+            self.packing_inverted_tweak = False
+
+        if precision == 0:
+            return
+
+        # Keep the placeholder element at index 0.  See set_all_inverted_from_tweak.
+        self.saved_inverted_tweak = tweaks
+        self.set_tweak_array(data_block, zInvertedBlendShape.inverted_tweak_attr,
+                *zInvertedBlendShapeMath.tweak_buffers([0], [0, 0, 0]))
+        self.cached_inverted_tweak = tweaks
+
+    def restore_inverted_tweak(self):
+        """
+        After saving, put back the .invertedTweak that pack_inverted_tweak replaced.
+        """
+        if self.saved_inverted_tweak is None:
+            return
+
+        tweaks, self.saved_inverted_tweak = self.saved_inverted_tweak, None
+        self.set_tweak_array(self._forceCache(), zInvertedBlendShape.inverted_tweak_attr, *tweaks)
+
+    def get_input_mesh(self):
+        """
+        Return the MDagPath of the mesh feeding .input[0], so it can be baked into.
+
+        Raise RuntimeError if there isn't one, or if it has history of its own.
+        """
+        name = OpenMaya.MFnDependencyNode(self.thisMObject()).name()
+        input_plug = OpenMaya.MPlug(self.thisMObject(), MPxGeometryFilter_input).elementByLogicalIndex(0)
+        input_geom_plug = input_plug.child(MPxGeometryFilter_inputGeom)
+
+        it = OpenMaya.MItDependencyGraph(input_geom_plug, OpenMaya.MFn.kMesh,
+                OpenMaya.MItDependencyGraph.kUpstream, OpenMaya.MItDependencyGraph.kDepthFirst,
+                OpenMaya.MItDependencyGraph.kNodeLevel)
+        if it.isDone():
+            raise RuntimeError('Couldn\'t find the input mesh for %s.' % name)
 
-        values = self.get_tweak_array_from_inverted(data_block, builder)
-        output_tweak.set(builder)
-        output_tweak.setAllClean()
+        mesh = it.currentItem()
+        if OpenMaya.MFnDependencyNode(mesh).findPlug('inMesh', False).isConnected():
+            raise RuntimeError('The input mesh for %s has history, so it can\'t be baked into.' % name)
+
+        path = OpenMaya.MDagPath()
+        OpenMaya.MDagPath.getAPathTo(mesh, path)
+        return path
+
+    def get_input_vertex_count(self, data_block):
+        """
+        Return the number of vertices in the input mesh.
+        """
+        input_array = data_block.inputArrayValue(MPxGeometryFilter_input)
+        input_array.jumpToArrayElement(0)
+        input_geom = input_array.inputValue().child(MPxGeometryFilter_inputGeom)
+        return OpenMaya.MFnMesh(input_geom.asMesh()).numVertices()
+
+    def write_corrective(self, path, include_matrices=False, corrective_name=''):
+        """
+        Write .invertedTweak to a corrective file.  If include_matrices is true, the inversion
+        matrices are written too.  corrective_name is stored in the file.
+        """
+        data_block = self._forceCache()
+        indices, deltas = self.get_inverted_tweak(data_block)
+        vertex_count = self.get_input_vertex_count(data_block)
+
+        matrices = jacobians = None
+        unsolved = ()
+        if include_matrices:
+            matrices = self.get_matrices(data_block)
+            if zInvertedBlendShapeMath.matrix_count(matrices) != vertex_count:
+                name = OpenMaya.MFnDependencyNode(self.thisMObject()).name()
+                raise RuntimeError('%s doesn\'t have inversion matrices for every vertex.' % name)
+            jacobians = self.get_forward_matrices(data_block)
+            unsolved = sorted(self.get_unsolved_vertices(data_block))
+
+        zInvertedBlendShapeMath.write_corrective(path, vertex_count, indices, deltas, matrices, jacobians, unsolved, corrective_name)
+
+    def read_corrective(self, path, include_matrices=False, corrective_name=None):
+        """
+        Replace .invertedTweak with the tweaks in a corrective file, and recalculate .tweak.
+        If include_matrices is true, the inversion matrices are replaced with the ones in the
+        file first.
+
+        Nothing is changed if the file is for a mesh with a different number of vertices, or
+        if corrective_name is given and the file was written for a different corrective.
+        """
+        data_block = self._forceCache()
+        corrective = zInvertedBlendShapeMath.read_corrective(path)
+
+        if corrective_name is not None and corrective.name != corrective_name:
+            raise RuntimeError('%s is for the corrective "%s", not "%s".' % (path, corrective.name, corrective_name))
+
+        vertex_count = self.get_input_vertex_count(data_block)
+        if corrective.vertex_count != vertex_count:
+            name = OpenMaya.MFnDependencyNode(self.thisMObject()).name()
+            raise RuntimeError('%s is for a mesh with %i vertices, but %s has %i.' % (path, corrective.vertex_count, name, vertex_count))
+        if include_matrices and corrective.matrices is None:
+            raise RuntimeError('%s doesn\'t have inversion matrices.' % path)
+
+        # Bring .invertedTweak up to date first, so pending changes to .tweak or a packed
+        # .invertedTweakData from the scene can't overwrite what we read later.
+        self.get_inverted_tweak(data_block)
+
+        if include_matrices:
+            self.set_inversion_matrices(corrective.matrices, corrective.jacobians, corrective.unsolved)
+
+        # Keep the placeholder element at index 0.  See set_all_inverted_from_tweak.
+        indices, deltas = corrective.indices, corrective.deltas
+        if not len(indices) or indices[0] != 0:
+            indices, deltas = zInvertedBlendShapeMath.merge_tweaks(indices, deltas, [0], [0, 0, 0])
+
+        self.set_tweak_array(data_block, self.inverted_tweak_attr, indices, deltas)
+        self.set_tweak_from_inverted(data_block)
+
+    def bake(self):
+        """
+        Apply .invertedTweak to the input mesh, including the envelope and weights, and clear
+        it and .tweak.
+
+        Return the input mesh and its old points, for undo.
+        """
+        data_block = self._forceCache()
+        mesh_path = self.get_input_mesh()
+        mesh_fn = OpenMaya.MFnMesh(mesh_path)
+
+        old_points = OpenMaya.MPointArray()
+        mesh_fn.getPoints(old_points, OpenMaya.MSpace.kObject)
+
+        indices, deltas = self.get_inverted_tweak(data_block)
+        envelope = data_block.inputValue(MPxGeometryFilter_envelope).asFloat()
+        deltas = zInvertedBlendShapeMath.weight_tweaks(indices, deltas, self.get_weights(data_block, 0), envelope)
+
+        points = OpenMaya.MPointArray(old_points)
+        count = points.length()
+        for idx, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, deltas):
+            if idx >= count:
+                break
+            point = points[idx]
+            points.set(idx, point.x + x, point.y + y, point.z + z)
+
+        mesh_fn.setPoints(points, OpenMaya.MSpace.kObject)
+
+        # Keep the placeholder element at index 0.  See set_all_inverted_from_tweak.
+        empty_tweak = zInvertedBlendShapeMath.tweak_buffers([0], [0, 0, 0])
+        self.set_tweak_array(data_block, self.inverted_tweak_attr, *empty_tweak)
+        self.set_tweak_array(data_block, self.tweak_attr, *empty_tweak)
+
+        return mesh_path, old_points
+
+    def invert_tweaks(self, matrices, unsolved_vertices, indices, deltas):
+        """
+        Return the inverted values of .tweak elements, given a list of their indices and a
+        flat list of their x, y, z deltas.  Return a list of (index, x, y, z).
+
+        All of the deltas are multiplied by their inversion matrices at once.
+        """
+        # If a vertex hasn't been probed for this pose yet, its matrix is still the one from
+        # the last pose it was solved for, or identity if it was never solved.  Remember it,
+        # so the script can fill it in.
+        if unsolved_vertices:
+            self.pending_vertices.update(idx for idx in indices if idx in unsolved_vertices)
+
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers(indices, deltas)
+        deltas = zInvertedBlendShapeMath.transform_tweaks(matrices, indices, deltas)
+        return list(zInvertedBlendShapeMath.iterate_tweaks(indices, deltas))
+
+    def update_inverted_from_tweak(self, data_block):
+        """
+        Update .invertedTweak from the .tweak elements that have changed, if editing is enabled.
+        Otherwise, forget about the changes.
+        """
+        self.tweak_changed = False
+
+        # We need to do this, or we'll clobber invertedTweak on load when compute is first called.
+        if not data_block.inputValue(self.enable_tweak_attr).asBool():
+            self.dirty_tweak_indices = set()
+            data_block.setClean(self.inverted_tweak_attr)
+            return
+
+        self.set_inverted_from_tweak(data_block)
 
     def set_inverted_from_tweak(self, data_block):
         """
         Update .inverted_tweak_attr from the current value of .tweak.
+
+        If we know which .tweak elements have changed, only those are updated.
+        """
+        dirty_tweak_indices = self.dirty_tweak_indices
+        self.dirty_tweak_indices = set()
+
+        if dirty_tweak_indices is None or self.cached_inverted_tweak is None:
+            with self.profile.timer('invertedTweakRebuilds', 'invertedTweakTime'):
+                self.set_all_inverted_from_tweak(data_block)
+        else:
+            with self.profile.timer('invertedTweakUpdates', 'invertedTweakTime'):
+                self.set_changed_inverted_from_tweak(data_block, sorted(dirty_tweak_indices))
+
+        data_block.setClean(self.inverted_tweak_attr)
+
+    def set_all_inverted_from_tweak(self, data_block):
+        """
+        Rebuild all of .inverted_tweak_attr from the current value of .tweak.
         """
         tweak_data = data_block.inputArrayValue(self.tweak_attr)
 
         matrices = self.get_matrices(data_block)
+        unsolved_vertices = self.get_unsolved_vertices(data_block)
+        epsilon = data_block.inputValue(self.tweak_epsilon_attr).asFloat()
 
         outputInvertedTweak = data_block.outputArrayValue(self.inverted_tweak_attr)
 
@@ -216,100 +796,305 @@ class zInvertedBlendShape(OpenMayaMPx.MPxDeformerNode):
         newElement = builder.addElement(0)
         newElement.set3Float(0,0,0)
 
+        tweak_indices = []
+        tweak_deltas = []
         for item in iterate_array_handle(tweak_data):
-            thisValue = tweak_data.inputValue()
-            delta = thisValue.asFloat3()
+            delta = tweak_data.inputValue().asFloat3()
 
             # Skip zero tweaks.  Most blend shapes will have small, localized changes to
             # some part of the mesh, so we save a lot of time by not processing vertices
             # that haven't been changed.  This also saves time during MPxGeometryFilter_outputGeom
             # calculation, since that also won't spend any time deforming unchanged vertices.
-            if abs(delta[0]) < 0.001 and abs(delta[1]) < 0.001 and abs(delta[2]) < 0.001:
+            if abs(delta[0]) < epsilon and abs(delta[1]) < epsilon and abs(delta[2]) < epsilon:
                 continue
 
-            delta = OpenMaya.MVector(*delta)
+            tweak_indices.append(array_current_index(tweak_data))
+            tweak_deltas.extend((delta[0], delta[1], delta[2]))
 
-            idx = array_current_index(tweak_data)
-            if idx < len(matrices):
-                delta *= matrices[idx]
+        indices = [0]
+        deltas = [0, 0, 0]
 
+        for idx, x, y, z in self.invert_tweaks(matrices, unsolved_vertices, tweak_indices, tweak_deltas):
             newElement = builder.addElement(idx)
-            newElement.set3Float(*delta)
+            newElement.set3Float(x, y, z)
+
+            if idx == 0:
+                deltas[:] = []
+            else:
+                indices.append(idx)
+            deltas.extend((x, y, z))
 
         outputInvertedTweak.set(builder)
         outputInvertedTweak.setAllClean()
-        data_block.setClean(self.inverted_tweak_attr)
-      
+
+        # We have the new tweaks already, so update the cache with them instead of reading
+        # them back.
+        self.cached_inverted_tweak = zInvertedBlendShapeMath.tweak_buffers(indices, deltas)
+
+    def set_changed_inverted_from_tweak(self, data_block, dirty_tweak_indices):
+        """
+        Update the given indices of .inverted_tweak_attr from the current value of .tweak.
+
+        This is used while sculpting, so a brush stroke only costs as much as the number of
+        vertices it touches, and not the number of vertices that have been sculpted.
+        """
+        tweak_data = data_block.inputArrayValue(self.tweak_attr)
+
+        matrices = self.get_matrices(data_block)
+        unsolved_vertices = self.get_unsolved_vertices(data_block)
+        epsilon = data_block.inputValue(self.tweak_epsilon_attr).asFloat()
+
+        # Unlike set_all_inverted_from_tweak, we do want the existing data here.
+        outputInvertedTweak = data_block.outputArrayValue(self.inverted_tweak_attr)
+        builder = outputInvertedTweak.builder()
+
+        tweak_indices = []
+        tweak_deltas = []
+        changed_indices = []
+        changed_deltas = []
+        removed_indices = []
+        for idx in dirty_tweak_indices:
+            try:
+                tweak_data.jumpToElement(idx)
+                delta = tweak_data.inputValue().asFloat3()
+            except RuntimeError as e:
+                # The element has been removed.
+                delta = None
+
+            # Skip zero tweaks, like set_all_inverted_from_tweak.
+            if delta is not None and abs(delta[0]) < epsilon and abs(delta[1]) < epsilon and abs(delta[2]) < epsilon:
+                delta = None
+
+            # Index 0 always exists.  See set_all_inverted_from_tweak.
+            if delta is None and idx == 0:
+                newElement = builder.addElement(idx)
+                newElement.set3Float(0, 0, 0)
+                changed_indices.append(idx)
+                changed_deltas.extend((0, 0, 0))
+                continue
+
+            if delta is None:
+                try:
+                    builder.removeElement(idx)
+                except RuntimeError as e:
+                    # There was no tweak here before, either.
+                    pass
+                removed_indices.append(idx)
+                continue
+
+            tweak_indices.append(idx)
+            tweak_deltas.extend((delta[0], delta[1], delta[2]))
+
+        for idx, x, y, z in self.invert_tweaks(matrices, unsolved_vertices, tweak_indices, tweak_deltas):
+            newElement = builder.addElement(idx)
+            newElement.set3Float(x, y, z)
+            changed_indices.append(idx)
+            changed_deltas.extend((x, y, z))
+
+        outputInvertedTweak.set(builder)
+        outputInvertedTweak.setAllClean()
+
+        indices, deltas = self.cached_inverted_tweak
+        self.cached_inverted_tweak = zInvertedBlendShapeMath.merge_tweaks(indices, deltas,
+                changed_indices, changed_deltas, removed_indices)
+
     def compute(self, plug, data):
         # We have to handle updating invertedTweak for both elements of the array and the
         # array itself, or things won't update reliably.
         # print 'Compute: %s, %i, %i' % (plug.info(), plug.isElement(), plug.isChild())
         if plug == self.inverted_tweak_attr or (plug.isChild() and plug.parent() == self.inverted_tweak_attr):
             # When the tweak input is changed, invert the change and store it in invertedTweak.
-            # However, only do this if editing is enabled.  We need to do this, or we'll clobber
-            # invertedTweak on load when compute is first called.
-            inverted_tweak_plug = OpenMaya.MPlug(self.thisMObject(), self.enable_tweak_attr)
-            if not inverted_tweak_plug.asBool():
-                return
-            self.set_inverted_from_tweak(data)
+            # However, only do this if editing is enabled.
+            self.update_inverted_from_tweak(data)
             return
 
         if plug == MPxGeometryFilter_outputGeom:
-            # We should be able to just call the base implementation of compute(), but that's broken.
-            index = plug.logicalIndex()
-            input_array = data.inputArrayValue(MPxGeometryFilter_input)
-            input_array.jumpToArrayElement(index)
-
-            input_element_handle = input_array.inputValue()	
-            input_geom = input_element_handle.child(MPxGeometryFilter_inputGeom)
-            group_id_handle = input_element_handle.child(MPxGeometryFilter_groupId)
-
-            output_handle = data.outputValue(plug)
-            output_handle.copy(input_geom)
-            geometry_iterator = OpenMaya.MItGeometry(output_handle, group_id_handle.asLong(), False)
+            with self.profile.timer('outputGeomComputes', 'outputGeomTime'):
+                self.compute_output_geometry(plug, data)
+            return
 
-            # We have to read the invertedTweak array through a plug.  If we use the MDataBlock like
-            # we're supposed to, it won't update.  The basicBlendShape.cpp sample does this, saying
-            # "inputPointsTarget is computed on pull, so can't just read it out of the datablock",
-            # but it doesn't explain what the hell that means and why we can't do the normal thing.
-            inverted_tweak_plug = OpenMaya.MPlug(self.thisMObject(), zInvertedBlendShape.inverted_tweak_attr)
-            inverted_tweak_plug = inverted_tweak_plug.elementByLogicalIndex(0)
-            inverted_tweak_plug.asMObject(data.context())
+        return super(zInvertedBlendShape, self).compute(plug, data)
 
-            inverted_tweak_data = data.inputArrayValue(zInvertedBlendShape.inverted_tweak_attr)
+    def compute_output_geometry(self, plug, data):
+        """
+        Compute an element of MPxGeometryFilter_outputGeom.
+        """
+        # We should be able to just call the base implementation of compute(), but that's broken.
+        index = plug.logicalIndex()
+        input_array = data.inputArrayValue(MPxGeometryFilter_input)
+        input_array.jumpToArrayElement(index)
+
+        input_element_handle = input_array.inputValue()	
+        input_geom = input_element_handle.child(MPxGeometryFilter_inputGeom)
+        group_id_handle = input_element_handle.child(MPxGeometryFilter_groupId)
+
+        output_handle = data.outputValue(plug)
+
+        # In probe mode, ignore our tweaks and move the whole input by .probeOffset.  The
+        # script uses this to find out how moving our output affects the sculpted mesh.
+        # The envelope and weights don't apply to probing.
+        probe = data.inputValue(zInvertedBlendShape.probe_attr).asBool()
+        if probe:
+            offset = data.inputValue(zInvertedBlendShape.probe_offset_attr).asFloat3()
+            offset = (offset[0], offset[1], offset[2])
+        else:
+            # If the envelope is 0, the output is just the input, so we don't need to look
+            # at the points at all.  Pass the input data through instead of copying it.
+            envelope = data.inputValue(MPxGeometryFilter_envelope).asFloat()
+            if envelope == 0:
+                output_handle.setMObject(input_geom.data())
+                data.setClean(plug)
+                return
 
             # This is a simple relative tweak.  In fact, we should be able to just connect our
             # .invertedTweak plug to the vlist input of a tweak node, but Maya is bad at connecting
             # arrays.
-            points = OpenMaya.MPointArray()
-            geometry_iterator.allPositions(points)
-
-            # We have the input geometry iterator, and the list of tweaks.  The tweak list is
-            # usually sparse, so loop through that rather than the geometry.
-            for tweak in iterate_array_handle(inverted_tweak_data):
-                index = tweak.elementIndex()
-                if index >= points.length():
-                    break
+            indices, deltas = self.get_applied_tweak(data)
+
+            # Until a shape is sculpted, .invertedTweak only has the placeholder at index 0, so
+            # there's nothing to apply and the output is just the input.  This is most shapes
+            # in a big rig, so don't touch the points at all, or even copy them.
+            if not len(indices):
+                output_handle.setMObject(input_geom.data())
+                data.setClean(plug)
+                return
 
-                point = points[index]
-                delta = inverted_tweak_data.inputValue().asFloat3()
-                points.set(index, point[0] + delta[0], point[1] + delta[1], point[2] + delta[2])
+            # Only scale the deltas if there's an envelope or painted weights.
+            weights = self.get_weights(data, index)
+            if weights is not None or envelope != 1:
+                deltas = zInvertedBlendShapeMath.weight_tweaks(indices, deltas, weights, envelope)
+
+        # We're going to move points, so give the output its own copy of the input.
+        output_handle.copy(input_geom)
+
+        # Only the vertices in the deformer set are deformed.  The set almost always covers
+        # the whole mesh, and then we can move points by index without looking at it.
+        geometry_iterator = OpenMaya.MItGeometry(output_handle, group_id_handle.asLong(), False)
+        whole_mesh = output_handle.type() == OpenMaya.MFnData.kMesh and \
+                geometry_iterator.count() == OpenMaya.MFnMesh(output_handle.asMesh()).numVertices()
+
+        # If we can, modify the output mesh's points directly.  output_handle has its own
+        # copy of the input, so this doesn't affect anything else.
+        points = get_raw_points(output_handle) if whole_mesh else None
+        if points is not None:
+            if probe:
+                points += offset
+            else:
+                zInvertedBlendShapeMath.add_tweaks(points, indices, deltas)
+
+            data.setClean(plug)
+            return
+
+        # If only a few vertices are tweaked, move just those vertices.
+        if not probe and whole_mesh:
+            mesh_fn = OpenMaya.MFnMesh(output_handle.asMesh())
+            count = mesh_fn.numVertices()
+            if len(indices) * sparse_tweak_ratio < count:
+                point = OpenMaya.MPoint()
+                for index, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, deltas):
+                    if index >= count:
+                        break
+
+                    mesh_fn.getPoint(index, point)
+                    mesh_fn.setPoint(index, OpenMaya.MPoint(point.x + x, point.y + y, point.z + z))
+
+                data.setClean(plug)
+                return
+
+        # If this isn't a mesh or the set is only part of it, the positions might not line up
+        # with vertex indices, so look up each vertex in the set.
+        if not whole_mesh:
+            if not probe:
+                tweaks = dict((index, (x, y, z)) for index, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, deltas))
 
-            geometry_iterator.setAllPositions(points)
+            while not geometry_iterator.isDone():
+                delta = offset if probe else tweaks.get(geometry_iterator.index())
+                if delta is not None:
+                    point = geometry_iterator.position()
+                    geometry_iterator.setPosition(OpenMaya.MPoint(point.x + delta[0], point.y + delta[1], point.z + delta[2]))
+                geometry_iterator.next()
 
             data.setClean(plug)
             return
 
-        return super(zInvertedBlendShape, self).compute(plug, data)
+        points = OpenMaya.MPointArray()
+        geometry_iterator.allPositions(points)
+
+        if probe:
+            for index in xrange(points.length()):
+                point = points[index]
+                points.set(index, point[0] + offset[0], point[1] + offset[1], point[2] + offset[2])
+        else:
+            # The tweak list is usually sparse, so loop through that rather than the geometry.
+            count = points.length()
+            for index, x, y, z in zInvertedBlendShapeMath.iterate_tweaks(indices, deltas):
+                if index >= count:
+                    break
+
+                point = points[index]
+                points.set(index, point[0] + x, point[1] + y, point[2] + z)
+
+        geometry_iterator.setAllPositions(points)
+
+        data.setClean(plug)
+
+    def schedulingType(self):
+        # compute only reads from the data block, and its caches and profile counters all
+        # belong to this node, so different zInvertedBlendShape nodes can be evaluated at the
+        # same time.  The evaluation manager never computes one node on two threads at once.
+        return OpenMayaMPx.MPxNode.kParallel
+
+    def setDependentsDirty(self, plug, plug_array):
+        # If a .tweakX child is being dirtied, look at its .tweak element.
+        element = plug
+        if plug.isChild():
+            element = plug.parent()
+        attr = element.attribute()
+
+        # Throw away the cached .invertedTweak when it changes.
+        if attr == zInvertedBlendShape.inverted_tweak_attr:
+            self.cached_inverted_tweak = None
+
+        # Remember which .tweak elements changed, so set_inverted_from_tweak only has to update
+        # those.  If the whole array is dirtied, update everything.
+        if attr == zInvertedBlendShape.tweak_attr:
+            self.tweak_changed = True
+            if not element.isElement():
+                self.dirty_tweak_indices = None
+            elif self.dirty_tweak_indices is not None:
+                self.dirty_tweak_indices.add(element.logicalIndex())
+
+        # Changing the epsilon can change which tweaks are kept, so update all of them.
+        if attr == zInvertedBlendShape.tweak_epsilon_attr:
+            self.tweak_changed = True
+            self.dirty_tweak_indices = None
+
+        # Throw away the cached weights when any weight is painted.
+        if attr in (MPxDeformerNode_weightList, MPxDeformerNode_weights):
+            self.cached_weights = {}
+
+        return super(zInvertedBlendShape, self).setDependentsDirty(plug, plug_array)
 
     def setInternalValueInContext(self, plug, handle, context):
         try:
             if plug == self.recalculate_tweak_attr:
                 # This attribute is only used to trigger this recalculation.
                 self.set_tweak_from_inverted(self._forceCache())
-            elif plug == zInvertedBlendShape.matrix_attr:
-                # .inversionMatrices is changing, so throw away our cache.
+            elif self.setting_inversion_matrices:
+                # set_inversion_matrices will fill in the caches itself.
+                pass
+            elif plug in (zInvertedBlendShape.matrix_attr, zInvertedBlendShape.matrix_data_attr):
+                # The inversion matrices are changing, so throw away our cache.
                 self.cached_inversion_matrices = None
+                self.cached_forward_matrices = None
+            elif plug == zInvertedBlendShape.jacobian_data_attr:
+                self.cached_forward_matrices = None
+            elif plug == zInvertedBlendShape.unsolved_vertices_attr:
+                self.cached_unsolved_vertices = None
+            elif plug == zInvertedBlendShape.inverted_tweak_data_attr and not self.packing_inverted_tweak:
+                # This is being loaded with the scene.  Expand it when it's first needed.
+                self.pending_inverted_tweak_data = handle.asString() or None
+                self.cached_inverted_tweak = None
         except Exception as e:
             print 'setInternalValueInContext error: %s' % e
             traceback.print_exc()
@@ -325,7 +1110,7 @@ class zInvertedBlendShape(OpenMayaMPx.MPxDeformerNode):
         # saves it anyway.
         inverted_tweak_plug = OpenMaya.MPlug(self.thisMObject(), self.enable_tweak_attr)
         if not inverted_tweak_plug.asBool():
-            if plug in (self.matrix_attr, self.tweak_attr):
+            if plug in (self.matrix_attr, self.matrix_data_attr, self.tweak_attr):
                 return False
         
         return super(zInvertedBlendShape, self).shouldSave(plug, isSaving)
@@ -353,6 +1138,7 @@ def initialize():
     tAttr = OpenMaya.MFnTypedAttribute()
     nAttr = OpenMaya.MFnNumericAttribute()
     cmpAttr = OpenMaya.MFnCompoundAttribute()
+    eAttr = OpenMaya.MFnEnumAttribute()
 
     # The main, stored data of the deformer, as a list of tweaks (vertex deltas) for the input
     # geometry.
@@ -376,27 +1162,106 @@ def initialize():
     # pose of the mesh being sculpted.  Note that changing this will not automatically
     # update tweak_attr, since this doesn't seem to update attached tweakLocation meshes
     # correctly.  To force this update to happen, a value is written to .recalculateTweak.
+    #
+    # The matrices are packed into a single string by zInvertedBlendShapeMath.pack_matrices.
+    # Only the 3x3 part is stored, and identity matrices are left out.
+    zInvertedBlendShape.matrix_data_attr = tAttr.create('inversionMatrixData', 'imd', OpenMaya.MFnData.kString)
+    tAttr.setInternal(True)
+    tAttr.setHidden(True)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.matrix_data_attr)
+
+    # The forward Jacobians that the inversion matrices are the inverse of, packed the same
+    # way.  These are used to recalculate .tweak from .invertedTweak without inverting every
+    # matrix.  This isn't saved, since it can be recreated from the inversion matrices.
+    zInvertedBlendShape.jacobian_data_attr = tAttr.create('jacobianData', 'jd', OpenMaya.MFnData.kString)
+    tAttr.setInternal(True)
+    tAttr.setHidden(True)
+    tAttr.setStorable(False)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.jacobian_data_attr)
+
+    # Whether .inversionMatrixData and .jacobianData are stored as floats or doubles.
+    zInvertedBlendShape.matrix_precision_attr = eAttr.create('inversionMatrixPrecision', 'imp', 0)
+    eAttr.addField('Float', 0)
+    eAttr.addField('Double', 1)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.matrix_precision_attr)
+
+    # If this isn't Float, .invertedTweak is packed into .invertedTweakData when the scene is
+    # saved, with each delta stored as a float16 or as an int16 with a scale for the whole
+    # shape.  This makes scenes with lots of inverted shapes smaller and faster to load, at
+    # the cost of some precision.
+    zInvertedBlendShape.inverted_tweak_precision_attr = eAttr.create('invertedTweakPrecision', 'itp', 0)
+    eAttr.addField('Float', 0)
+    eAttr.addField('Half', 1)
+    eAttr.addField('Int16', 2)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.inverted_tweak_precision_attr)
+
+    zInvertedBlendShape.inverted_tweak_data_attr = tAttr.create('invertedTweakData', 'itd', OpenMaya.MFnData.kString)
+    tAttr.setInternal(True)
+    tAttr.setHidden(True)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.inverted_tweak_data_attr)
+
+    # Tweaks smaller than this on every axis are treated as zero, and aren't stored.
+    zInvertedBlendShape.tweak_epsilon_attr = nAttr.create('tweakEpsilon', 'tep', OpenMaya.MFnNumericData.kFloat, 0.001)
+    nAttr.setMin(0)
+    nAttr.setKeyable(False)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.tweak_epsilon_attr)
+    zInvertedBlendShape.attributeAffects(zInvertedBlendShape.tweak_epsilon_attr, zInvertedBlendShape.inverted_tweak_attr)
+    zInvertedBlendShape.attributeAffects(zInvertedBlendShape.tweak_epsilon_attr, MPxGeometryFilter_outputGeom)
+
+    # Vertices that haven't been probed for the current pose after updating the inversion
+    # for only part of the mesh, as [start, end) pairs.  These vertices keep the matrices
+    # from the last pose they were solved for, or identity if they were never solved.
+    zInvertedBlendShape.unsolved_vertices_attr = tAttr.create('unsolvedVertices', 'usv', OpenMaya.MFnData.kIntArray)
+    tAttr.setInternal(True)
+    tAttr.setHidden(True)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.unsolved_vertices_attr)
+
+    # Older versions stored the matrices here, with a full MMatrix per vertex.  This is only
+    # read to migrate old scenes to .inversionMatrixData.
     zInvertedBlendShape.matrix_attr = mAttr.create('inversionMatrix', 'im')
     mAttr.setArray(True)
     mAttr.setInternal(True)
+    mAttr.setHidden(True)
     mAttr.setUsesArrayDataBuilder(True)
     zInvertedBlendShape.addAttribute(zInvertedBlendShape.matrix_attr)
-    # zInvertedBlendShape.attributeAffects(zInvertedBlendShape.matrix_attr, zInvertedBlendShape.tweak_attr)
 
     # If true, we're currently sculpting.  Changes to .tweak will be inverted and copied
     # to .invertedTweak.
     zInvertedBlendShape.enable_tweak_attr = nAttr.create('enableTweak', 'et', OpenMaya.MFnNumericData.kBoolean)
     zInvertedBlendShape.addAttribute(zInvertedBlendShape.enable_tweak_attr)
+    zInvertedBlendShape.attributeAffects(zInvertedBlendShape.enable_tweak_attr, MPxGeometryFilter_outputGeom)
 
-    # This is a hack: write to this attribute to force .tweak to be recalculated from
-    # .invertedTweak.  We should use a command for this, but I can't find any way to
-    # get our MPxDeformerNode instance from a command like you can natively.
+    # Writing to this attribute forces .tweak to be recalculated from .invertedTweak.  This
+    # is kept for older scripts.  Use zInvertedBlendShapeEdit -recalculateTweak instead.
     zInvertedBlendShape.recalculate_tweak_attr = nAttr.create('recalculateTweak', 'rct', OpenMaya.MFnNumericData.kBoolean)
     nAttr.setStorable(False)
     nAttr.setKeyable(False)
     nAttr.setInternal(True)
     zInvertedBlendShape.addAttribute(zInvertedBlendShape.recalculate_tweak_attr)
 
+    # While this is true, the deformer ignores its tweaks and outputs the input geometry moved
+    # by .probeOffset.  This is used by the script to probe the deformation chain without
+    # moving vertices with cmds.move.
+    zInvertedBlendShape.probe_attr = nAttr.create('probe', 'prb', OpenMaya.MFnNumericData.kBoolean)
+    nAttr.setStorable(False)
+    nAttr.setKeyable(False)
+    nAttr.setHidden(True)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.probe_attr)
+    zInvertedBlendShape.attributeAffects(zInvertedBlendShape.probe_attr, MPxGeometryFilter_outputGeom)
+
+    zInvertedBlendShape.probe_offset_attr = nAttr.createPoint('probeOffset', 'pro')
+    nAttr.setStorable(False)
+    nAttr.setKeyable(False)
+    nAttr.setHidden(True)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.probe_offset_attr)
+    zInvertedBlendShape.attributeAffects(zInvertedBlendShape.probe_offset_attr, MPxGeometryFilter_outputGeom)
+
+    # If this is true, the script updates the inversion matrices while sculpting when the pose
+    # changes, if it can do so without probing the rig.  This doesn't affect the node itself.
+    zInvertedBlendShape.live_update_attr = nAttr.create('liveUpdate', 'lu', OpenMaya.MFnNumericData.kBoolean)
+    nAttr.setKeyable(False)
+    zInvertedBlendShape.addAttribute(zInvertedBlendShape.live_update_attr)
+
     # This attribute is only used to temporarily store the original tweak node while
     # we're redirecting tweaks for a mesh to us.
     #
@@ -407,12 +1272,344 @@ def initialize():
     nAttr.setUsesArrayDataBuilder(True)
     zInvertedBlendShape.addAttribute(zInvertedBlendShape.saved_tweak_connection_attr)
 
+class zInvertedBlendShapeEdit(OpenMayaMPx.MPxCommand):
+    """
+    Edit any number of zInvertedBlendShape nodes at once.  The deformers are given as
+    arguments, or the selection is used.
+
+    -recalculateTweak (-rt): Recalculate .tweak from .invertedTweak and the inversion matrices.
+    -rebuildInvertedTweak (-rit): Recalculate all of .invertedTweak from .tweak.
+    -bake (-b): Apply .invertedTweak to the deformer's input mesh, and clear it.
+
+    For undo, we only keep the packed tweak buffers of each deformer, and the old points of
+    baked meshes.
+    """
+    command_name = 'zInvertedBlendShapeEdit'
+
+    recalculate_tweak_flag = ('-rt', '-recalculateTweak')
+    rebuild_inverted_tweak_flag = ('-rit', '-rebuildInvertedTweak')
+    bake_flag = ('-b', '-bake')
+
+    def __init__(self):
+        super(zInvertedBlendShapeEdit, self).__init__()
+        self.deformers = []
+        self.undo_data = []
+
+    def isUndoable(self):
+        return True
+
+    def doIt(self, args):
+        arg_data = OpenMaya.MArgDatabase(self.syntax(), args)
+        self.recalculate_tweak = arg_data.isFlagSet(self.recalculate_tweak_flag[0])
+        self.rebuild_inverted_tweak = arg_data.isFlagSet(self.rebuild_inverted_tweak_flag[0])
+        self.bake = arg_data.isFlagSet(self.bake_flag[0])
+        if not (self.recalculate_tweak or self.rebuild_inverted_tweak or self.bake):
+            raise RuntimeError('Specify -recalculateTweak, -rebuildInvertedTweak or -bake.')
+
+        selection = OpenMaya.MSelectionList()
+        arg_data.getObjects(selection)
+        for idx in xrange(selection.length()):
+            obj = OpenMaya.MObject()
+            selection.getDependNode(idx, obj)
+            dep_node = OpenMaya.MFnDependencyNode(obj)
+            if dep_node.typeId() != zInvertedBlendShape.pluginNodeId:
+                raise RuntimeError('%s isn\'t a zInvertedBlendShape.' % dep_node.name())
+            self.deformers.append(OpenMaya.MObjectHandle(obj))
+
+        self.redoIt()
+
+    def redoIt(self):
+        self.undo_data = []
+        for handle in self.deformers:
+            dep_node = OpenMaya.MFnDependencyNode(handle.object())
+            node = dep_node.userNode()
+            data_block = node._forceCache()
+
+            saved_tweak = node.get_tweak(data_block)
+            saved_inverted_tweak = node.get_inverted_tweak(data_block)
+            baked = None
+
+            if self.rebuild_inverted_tweak:
+                node.dirty_tweak_indices = None
+                node.set_inverted_from_tweak(data_block)
+            if self.recalculate_tweak:
+                node.set_tweak_from_inverted(data_block)
+            if self.bake:
+                baked = node.bake()
+
+            self.undo_data.append((saved_tweak, saved_inverted_tweak, baked))
+            cmds.dgdirty('%s.outputGeometry' % dep_node.name())
+
+    def undoIt(self):
+        for handle, (saved_tweak, saved_inverted_tweak, baked) in reversed(zip(self.deformers, self.undo_data)):
+            dep_node = OpenMaya.MFnDependencyNode(handle.object())
+            node = dep_node.userNode()
+            data_block = node._forceCache()
+
+            node.set_tweak_array(data_block, zInvertedBlendShape.tweak_attr, *saved_tweak)
+            node.set_tweak_array(data_block, zInvertedBlendShape.inverted_tweak_attr, *saved_inverted_tweak)
+            if baked is not None:
+                mesh_path, old_points = baked
+                OpenMaya.MFnMesh(mesh_path).setPoints(old_points, OpenMaya.MSpace.kObject)
+
+            cmds.dgdirty('%s.outputGeometry' % dep_node.name())
+
+def command_creator():
+    return OpenMayaMPx.asMPxPtr(zInvertedBlendShapeEdit())
+
+def command_syntax():
+    syntax = OpenMaya.MSyntax()
+    syntax.addFlag(zInvertedBlendShapeEdit.recalculate_tweak_flag[0], zInvertedBlendShapeEdit.recalculate_tweak_flag[1])
+    syntax.addFlag(zInvertedBlendShapeEdit.rebuild_inverted_tweak_flag[0], zInvertedBlendShapeEdit.rebuild_inverted_tweak_flag[1])
+    syntax.addFlag(zInvertedBlendShapeEdit.bake_flag[0], zInvertedBlendShapeEdit.bake_flag[1])
+    syntax.useSelectionAsDefault(True)
+    syntax.setObjectType(OpenMaya.MSyntax.kSelectionList, 1)
+    return syntax
+
+class zInvertedBlendShapeFile(OpenMayaMPx.MPxCommand):
+    """
+    Write the sculpted changes of a zInvertedBlendShape node to a binary corrective file,
+    or read them back in.  This is much faster than rebuilding .invertedTweak from meshes.
+
+    -write (-w) path: Write the deformer's .invertedTweak to path.
+    -read (-r) path: Replace the deformer's .invertedTweak with the one in path, and
+    recalculate .tweak.  The file must be for a mesh with the same number of vertices.
+    -matrices (-m): Write or read the inversion matrices too.  These are only correct for
+    the pose they were solved in.
+    -name (-n) name: When writing, store name in the file as the corrective's name.  When
+    reading, fail unless the file was written with this name.
+
+    Reading can be undone.  For undo, we keep the old tweak buffers, and the old matrix
+    buffers if they're being replaced.
+    """
+    command_name = 'zInvertedBlendShapeFile'
+
+    write_flag = ('-w', '-write')
+    read_flag = ('-r', '-read')
+    matrices_flag = ('-m', '-matrices')
+    name_flag = ('-n', '-name')
+
+    def __init__(self):
+        super(zInvertedBlendShapeFile, self).__init__()
+        self.deformer = None
+        self.read_path = None
+        self.matrices = False
+        self.corrective_name = None
+        self.undo_data = None
+
+    def isUndoable(self):
+        return self.read_path is not None
+
+    def doIt(self, args):
+        arg_data = OpenMaya.MArgDatabase(self.syntax(), args)
+        write_path = None
+        if arg_data.isFlagSet(self.write_flag[0]):
+            write_path = arg_data.flagArgumentString(self.write_flag[0], 0)
+        if arg_data.isFlagSet(self.read_flag[0]):
+            self.read_path = arg_data.flagArgumentString(self.read_flag[0], 0)
+        self.matrices = arg_data.isFlagSet(self.matrices_flag[0])
+        if arg_data.isFlagSet(self.name_flag[0]):
+            self.corrective_name = arg_data.flagArgumentString(self.name_flag[0], 0)
+        if (write_path is None) == (self.read_path is None):
+            raise RuntimeError('Specify one of -write or -read.')
+
+        selection = OpenMaya.MSelectionList()
+        arg_data.getObjects(selection)
+        if selection.length() != 1:
+            raise RuntimeError('Specify one zInvertedBlendShape.')
+
+        obj = OpenMaya.MObject()
+        selection.getDependNode(0, obj)
+        dep_node = OpenMaya.MFnDependencyNode(obj)
+        if dep_node.typeId() != zInvertedBlendShape.pluginNodeId:
+            raise RuntimeError('%s isn\'t a zInvertedBlendShape.' % dep_node.name())
+        self.deformer = OpenMaya.MObjectHandle(obj)
+
+        if write_path is not None:
+            dep_node.userNode().write_corrective(write_path, self.matrices, self.corrective_name or '')
+            return
+
+        self.redoIt()
+
+    def redoIt(self):
+        dep_node = OpenMaya.MFnDependencyNode(self.deformer.object())
+        node = dep_node.userNode()
+        data_block = node._forceCache()
+
+        saved_matrices = None
+        if self.matrices:
+            saved_matrices = (node.get_matrices(data_block), node.get_forward_matrices(data_block),
+                    sorted(node.get_unsolved_vertices(data_block)))
+        self.undo_data = (node.get_tweak(data_block), node.get_inverted_tweak(data_block), saved_matrices)
+
+        node.read_corrective(self.read_path, self.matrices, self.corrective_name)
+        cmds.dgdirty('%s.outputGeometry' % dep_node.name())
+
+    def undoIt(self):
+        dep_node = OpenMaya.MFnDependencyNode(self.deformer.object())
+        node = dep_node.userNode()
+        data_block = node._forceCache()
+
+        saved_tweak, saved_inverted_tweak, saved_matrices = self.undo_data
+        if saved_matrices is not None:
+            node.set_inversion_matrices(*saved_matrices)
+        node.set_tweak_array(data_block, zInvertedBlendShape.tweak_attr, *saved_tweak)
+        node.set_tweak_array(data_block, zInvertedBlendShape.inverted_tweak_attr, *saved_inverted_tweak)
+
+        cmds.dgdirty('%s.outputGeometry' % dep_node.name())
+
+def file_command_creator():
+    return OpenMayaMPx.asMPxPtr(zInvertedBlendShapeFile())
+
+def file_command_syntax():
+    syntax = OpenMaya.MSyntax()
+    syntax.addFlag(zInvertedBlendShapeFile.write_flag[0], zInvertedBlendShapeFile.write_flag[1], OpenMaya.MSyntax.kString)
+    syntax.addFlag(zInvertedBlendShapeFile.read_flag[0], zInvertedBlendShapeFile.read_flag[1], OpenMaya.MSyntax.kString)
+    syntax.addFlag(zInvertedBlendShapeFile.matrices_flag[0], zInvertedBlendShapeFile.matrices_flag[1])
+    syntax.addFlag(zInvertedBlendShapeFile.name_flag[0], zInvertedBlendShapeFile.name_flag[1], OpenMaya.MSyntax.kString)
+    syntax.useSelectionAsDefault(True)
+    syntax.setObjectType(OpenMaya.MSyntax.kSelectionList, 1)
+    return syntax
+
+class zInvertedBlendShapeProfile(OpenMayaMPx.MPxCommand):
+    """
+    Return the profiling counters of a zInvertedBlendShape node, as a list of alternating
+    counter names and values.  Times are in seconds.
+
+    -reset (-r): Reset the counters of any number of nodes instead.
+    """
+    command_name = 'zInvertedBlendShapeProfile'
+
+    reset_flag = ('-r', '-reset')
+
+    def isUndoable(self):
+        return False
+
+    def doIt(self, args):
+        arg_data = OpenMaya.MArgDatabase(self.syntax(), args)
+        reset = arg_data.isFlagSet(self.reset_flag[0])
+
+        selection = OpenMaya.MSelectionList()
+        arg_data.getObjects(selection)
+        nodes = []
+        for idx in xrange(selection.length()):
+            obj = OpenMaya.MObject()
+            selection.getDependNode(idx, obj)
+            dep_node = OpenMaya.MFnDependencyNode(obj)
+            if dep_node.typeId() != zInvertedBlendShape.pluginNodeId:
+                raise RuntimeError('%s isn\'t a zInvertedBlendShape.' % dep_node.name())
+            nodes.append(dep_node.userNode())
+
+        if reset:
+            for node in nodes:
+                node.profile.reset()
+            return
+
+        if len(nodes) != 1:
+            raise RuntimeError('Specify one zInvertedBlendShape to query.')
+
+        result = OpenMaya.MStringArray()
+        for name, value in nodes[0].get_profile():
+            result.append(name)
+            result.append(repr(value))
+        self.setResult(result)
+
+def profile_command_creator():
+    return OpenMayaMPx.asMPxPtr(zInvertedBlendShapeProfile())
+
+def profile_command_syntax():
+    syntax = OpenMaya.MSyntax()
+    syntax.addFlag(zInvertedBlendShapeProfile.reset_flag[0], zInvertedBlendShapeProfile.reset_flag[1])
+    syntax.useSelectionAsDefault(True)
+    syntax.setObjectType(OpenMaya.MSyntax.kSelectionList, 1)
+    return syntax
+
+def iterate_deformer_nodes():
+    """
+    Yield the zInvertedBlendShape instance for each of our nodes in the scene.
+    """
+    it = OpenMaya.MItDependencyNodes(OpenMaya.MFn.kPluginDeformerNode)
+    while not it.isDone():
+        dep_node = OpenMaya.MFnDependencyNode(it.thisNode())
+        if dep_node.typeId() == zInvertedBlendShape.pluginNodeId:
+            yield dep_node.userNode()
+        it.next()
+
+def migrate_legacy_matrices(client_data=None):
+    """
+    Move inversion matrices in scenes saved by older versions to .inversionMatrixData.
+    """
+    try:
+        migrated = [node for node in iterate_deformer_nodes() if node.migrate_legacy_matrices()]
+        if migrated:
+            OpenMaya.MGlobal.displayInfo('Migrated inversion matrices for %i zInvertedBlendShape nodes.' % len(migrated))
+    except Exception as e:
+        print 'migrate_legacy_matrices error: %s' % e
+        traceback.print_exc()
+
+def restore_live_updates(client_data=None):
+    """
+    Start watching the pose of deformers that were saved with .liveUpdate on.
+    """
+    try:
+        for node in iterate_deformer_nodes():
+            if OpenMaya.MPlug(node.thisMObject(), zInvertedBlendShape.live_update_attr).asBool():
+                maya.utils.executeDeferred('import zInvertedBlendShape; zInvertedBlendShape.restore_live_updates()')
+                break
+    except Exception as e:
+        print 'restore_live_updates error: %s' % e
+        traceback.print_exc()
+
+def pack_inverted_tweaks(client_data=None):
+    try:
+        for node in iterate_deformer_nodes():
+            node.pack_inverted_tweak()
+    except Exception as e:
+        print 'pack_inverted_tweaks error: %s' % e
+        traceback.print_exc()
+
+def restore_inverted_tweaks(client_data=None):
+    try:
+        for node in iterate_deformer_nodes():
+            node.restore_inverted_tweak()
+    except Exception as e:
+        print 'restore_inverted_tweaks error: %s' % e
+        traceback.print_exc()
+
+callback_ids = []
+
 def initializePlugin(mobject):
     plugin = OpenMayaMPx.MFnPlugin(mobject)
     plugin.registerNode('zInvertedBlendShape', zInvertedBlendShape.pluginNodeId, creator,
             initialize, OpenMayaMPx.MPxNode.kDeformerNode)
+    plugin.registerCommand(zInvertedBlendShapeEdit.command_name, command_creator, command_syntax)
+    plugin.registerCommand(zInvertedBlendShapeProfile.command_name, profile_command_creator, profile_command_syntax)
+    plugin.registerCommand(zInvertedBlendShapeFile.command_name, file_command_creator, file_command_syntax)
+
+    for message in (OpenMaya.MSceneMessage.kAfterOpen, OpenMaya.MSceneMessage.kAfterImport,
+            OpenMaya.MSceneMessage.kAfterCreateReference):
+        callback_ids.append(OpenMaya.MSceneMessage.addCallback(message, migrate_legacy_matrices))
+        callback_ids.append(OpenMaya.MSceneMessage.addCallback(message, restore_live_updates))
+
+    for message in (OpenMaya.MSceneMessage.kBeforeSave, OpenMaya.MSceneMessage.kBeforeExport):
+        callback_ids.append(OpenMaya.MSceneMessage.addCallback(message, pack_inverted_tweaks))
+    for message in (OpenMaya.MSceneMessage.kAfterSave, OpenMaya.MSceneMessage.kAfterExport):
+        callback_ids.append(OpenMaya.MSceneMessage.addCallback(message, restore_inverted_tweaks))
 
 def uninitializePlugin(mobject):
+    for callback_id in callback_ids:
+        OpenMaya.MMessage.removeCallback(callback_id)
+    del callback_ids[:]
+
+    # Remove the script's callbacks too, if it's been loaded.  The plugin has the same module
+    # name, so check that it's really the script.
+    script = sys.modules.get('zInvertedBlendShape')
+    if script is not None and hasattr(script, '_unwatch_topology'):
+        script._unwatch_topology()
+
     plugin = OpenMayaMPx.MFnPlugin(mobject)
+    plugin.deregisterCommand(zInvertedBlendShapeFile.command_name)
+    plugin.deregisterCommand(zInvertedBlendShapeProfile.command_name)
+    plugin.deregisterCommand(zInvertedBlendShapeEdit.command_name)
     plugin.deregisterNode(zInvertedBlendShape.pluginNodeId)
 
@@ -5,9 +5,85 @@ Based on https://github.com/chadmv/cvshapeinverter by Chad Vernon.
 """
 
 import maya.cmds as cmds
+import maya.mel
+import maya.utils
 import maya.OpenMaya as OpenMaya
 import maya.OpenMayaAnim as OpenMayaAnim
-import math, time
+import maya.api.OpenMaya as OpenMaya2
+import maya.api.OpenMayaAnim as OpenMayaAnim2
+import array, collections, copy, hashlib, math, multiprocessing, os, Queue, re, threading, time
+import zInvertedBlendShapeMath
+
+# Walking history is slow on big rigs, so _get_history caches it until the graph changes.  This
+# maps (node, future, listHistory flags) to a list of (node, node types) pairs.
+_history_cache = {}
+
+# The callbacks that clear _history_cache.  The list is kept when the module is reloaded, so
+# the old module's callbacks can be removed before this one installs its own.
+_topology_callback_ids = globals().get('_topology_callback_ids', [])
+_topology_callbacks_installed = False
+
+def _clear_topology_cache(*args):
+    _history_cache.clear()
+
+def _watch_topology():
+    """
+    Install the callbacks that clear the history cache, if they aren't installed yet.
+
+    Any connection change, deletion, rename or reparent clears everything.  These happen
+    rarely compared to the lookups, and working out which entries they affect would mean
+    walking the graph again.
+    """
+    global _topology_callbacks_installed
+    if _topology_callbacks_installed:
+        return
+
+    _unwatch_topology()
+    _topology_callback_ids.extend([
+        OpenMaya.MDGMessage.addConnectionCallback(_clear_topology_cache),
+        OpenMaya.MDGMessage.addNodeRemovedCallback(_clear_topology_cache),
+        OpenMaya.MNodeMessage.addNameChangedCallback(OpenMaya.MObject(), _clear_topology_cache),
+        OpenMaya.MDagMessage.addAllDagChangesCallback(_clear_topology_cache),
+    ])
+    for message in (OpenMaya.MSceneMessage.kBeforeNew, OpenMaya.MSceneMessage.kBeforeOpen):
+        _topology_callback_ids.append(OpenMaya.MSceneMessage.addCallback(message, _clear_topology_cache))
+    _topology_callbacks_installed = True
+
+def _unwatch_topology():
+    """
+    Remove the callbacks installed by _watch_topology, and clear the history cache, since
+    nothing will clear it when the graph changes.  The plugin calls this when it's unloaded.
+    """
+    global _topology_callbacks_installed
+    if _topology_callback_ids:
+        callback_ids = OpenMaya.MCallbackIdArray()
+        for callback_id in _topology_callback_ids:
+            callback_ids.append(callback_id)
+        OpenMaya.MMessage.removeCallbacks(callback_ids)
+        del _topology_callback_ids[:]
+
+    _history_cache.clear()
+    _topology_callbacks_installed = False
+
+def _get_history(node, future=False, **kwargs):
+    """
+    Return the history of node, or its future if future is true, as a list of
+    (node, node_types) pairs.  node_types are the node's inherited types, so the last one
+    is the node's own type.  kwargs are passed to cmds.listHistory.
+
+    The result is cached until a connection changes or a node is deleted, renamed or
+    reparented.  Don't modify it.
+    """
+    _watch_topology()
+
+    key = (node, future, tuple(sorted(kwargs.items())))
+    history = _history_cache.get(key)
+    if history is None:
+        history = []
+        for history_node in cmds.listHistory(node, future=future, **kwargs) or []:
+            history.append((history_node, tuple(cmds.nodeType(history_node, inherited=True) or ())))
+        _history_cache[key] = history
+    return history
 
 def _find_inverted_shape_for_deformer(deformer):
     """
@@ -27,18 +103,16 @@ def _find_inverted_shape_for_deformer(deformer):
     if not outputGeometry:
         raise RuntimeError('Couldn\'t find the inverted output mesh for %s.' % deformer)
 
-    history_nodes = cmds.listHistory(outputGeometry[0], f=True)
-
-    for history_node in history_nodes:
-        if cmds.nodeType(history_node) != 'mesh':
+    for history_node, node_types in _get_history(outputGeometry[0], future=True):
+        if node_types[-1] != 'mesh':
             continue
         if cmds.getAttr('%s.intermediateObject' % history_node):
             continue
 
         # We should always find the mesh before we hit a deformer.  This makes sure
         # that we don't go too far forward and start messing with the real mesh.
-        if set(cmds.nodeType(history_node, inherited=True)) & {'geometryFilter', 'deformer'}:
-            raise RuntimeError('Found deformer %s before the inverted mesh for deformer %s' % (node, deformer))
+        if set(node_types) & {'geometryFilter', 'deformer'}:
+            raise RuntimeError('Found deformer %s before the inverted mesh for deformer %s' % (history_node, deformer))
 
         return history_node
 
@@ -59,15 +133,9 @@ def _find_sculpting_output_mesh(deformer):
         OpenMaya.MGlobal.displayWarning('Couldn\'t find the inverted mesh for %s' % deformer)
         return None
 
-    visible_nodes = []
-    for history_node in cmds.listHistory(inverted_mesh, f=True):
-        if history_node == inverted_mesh:
-            continue
-        if cmds.nodeType(history_node) != 'mesh':
-            continue
-        if not _node_visible(history_node):
-            continue
-        visible_nodes.append(history_node)
+    meshes = [history_node for history_node, node_types in _get_history(inverted_mesh, future=True)
+            if node_types[-1] == 'mesh' and history_node != inverted_mesh]
+    visible_nodes = _get_visible_nodes(meshes)
 
     if not visible_nodes:
         return None
@@ -79,11 +147,10 @@ def _find_sculpting_output_mesh(deformer):
 
 def _find_blend_shapes(node):
     # Look through history backwards, so front-of-chain blend shapes are found first.
-    for history_node in reversed(cmds.listHistory(node, gl=True)):
-        if 'blendShape' not in cmds.nodeType(history_node, inherited=True):
+    for history_node, node_types in reversed(_get_history(node, groupLevels=True)):
+        if 'blendShape' not in node_types:
             continue
 
-        # print 'Blend shape:', history_node, cmds.nodeType(history_node, inherited=True)
         yield history_node
 
 def _find_visible_shape(transform):
@@ -149,41 +216,48 @@ def _get_geometry_iterator(path):
         path = _get_dag_path(_get_shape(path))
     return OpenMaya.MItGeometry(path)
 
-def _get_mesh_points(path, space=OpenMaya.MSpace.kObject):
+def _read_points(mesh):
     """
-    Get the control point positions of a geometry node.
+    Return the object space points of a mesh as a zInvertedBlendShapeMath point buffer.
+
+    mesh is the name of a mesh or its transform, or an MObject containing mesh data.  The
+    points are copied straight out of the mesh's vertex array, without going through an
+    MPointArray.
     """
-    itGeo = _get_geometry_iterator(path)
-    points = OpenMaya.MPointArray()
-    itGeo.allPositions(points, space)
-    return points
+    if isinstance(mesh, basestring):
+        mesh = _get_plug_from_node('%s.outMesh' % _get_shape(mesh)).asMObject()
 
-def _get_points(obj, space=OpenMaya.MSpace.kObject):
-    itMesh = OpenMaya.MItMeshVertex(obj)
+    mesh_fn = OpenMaya.MFnMesh(mesh)
+    return zInvertedBlendShapeMath.copy_raw_points(int(mesh_fn.getRawPoints()), mesh_fn.numVertices())
 
-    # We should be able to stop iteration when next() returns an error, but that doesn't
-    # actually happen in Python for some reason.
-    result = OpenMaya.MPointArray()
-    for idx in xrange(0, itMesh.count()):
-        result.append(itMesh.position(space))
-        itMesh.next()
-        
-    return result
-
-def _set_matrix_row(matrix, row, newVector):
+def _write_points(mesh, points):
     """
-    Sets a matrix row with an MVector or MPoint.
+    Set the object space points of a mesh from a zInvertedBlendShapeMath point buffer.
     """
-    _set_matrix_cell(matrix, row, 0, newVector.x)
-    _set_matrix_cell(matrix, row, 1, newVector.y)
-    _set_matrix_cell(matrix, row, 2, newVector.z)
+    # Build the MPointArray from a C array in one call, instead of appending each point.
+    count = zInvertedBlendShapeMath.point_count(points)
+    util = OpenMaya.MScriptUtil()
+    util.createFromList(zInvertedBlendShapeMath.homogeneous_point_values(points), count * 4)
+    point_array = OpenMaya.MPointArray(util.asDouble4Ptr(), count)
+
+    _get_geometry_iterator(mesh).setAllPositions(point_array, OpenMaya.MSpace.kObject)
 
+def _get_deformer_node(deformer):
+    """
+    Return the zInvertedBlendShape instance for a deformer node name.
+    """
+    return OpenMaya.MFnDependencyNode(_get_mobject(deformer)).userNode()
 
-def _set_matrix_cell(matrix, row, column, value):
+def _set_inversion_matrices(deformer, matrices, jacobians, unsolved=()):
     """
-    Set a matrix cell.
+    Replace deformer's inversion matrices with a buffer of 3x3 matrices, and the forward
+    Jacobians they're the inverse of.  unsolved is a sorted list of vertices that haven't
+    been probed for the current pose, whose matrices are left over from an older one.
+
+    This hands the buffers to the node in one call, which stores them and uses them as
+    its cache directly.
     """
-    OpenMaya.MScriptUtil.setDoubleArray(matrix[row], column, value)
+    _get_deformer_node(deformer).set_inversion_matrices(matrices, jacobians, unsolved)
 
 def _get_active_sculpting_mesh_for_deformer(deformer):
     """
@@ -264,14 +338,524 @@ def _find_deformer(node):
             return connections[0]
 
         # See if this is an output inverted blend shape mesh.
-        for history_node in cmds.listHistory(node, gl=True, pdo=True) or []:
-            if 'zInvertedBlendShape' in cmds.nodeType(history_node, inherited=True):
+        for history_node, node_types in _get_history(node, groupLevels=True, pruneDagObjects=True):
+            if 'zInvertedBlendShape' in node_types:
                 return history_node
 
     return None
 
+def _find_deformers_for_blend_shape(blend_shape):
+    """
+    Return the deformers whose inverted meshes are targets of blend_shape.
+    """
+    deformers = []
+    for target in cmds.listConnections('%s.inputTarget' % blend_shape, s=True, d=False, shapes=True) or []:
+        if cmds.nodeType(target) != 'mesh':
+            continue
+
+        deformer = _find_deformer(target)
+        if deformer is not None and deformer not in deformers:
+            deformers.append(deformer)
+    return deformers
+
+
+def _get_selected_vertices():
+    """
+    Return the set of selected vertex indices, including soft selection if it's enabled.
+
+    Vertices are returned for any selected mesh.  The inverted mesh and the mesh being
+    sculpted have the same topology, so it doesn't matter which one they're selected on.
+    """
+    selection = OpenMaya.MSelectionList()
+    if cmds.softSelect(q=True, softSelectEnabled=True):
+        rich_selection = OpenMaya.MRichSelection()
+        OpenMaya.MGlobal.getRichSelection(rich_selection)
+        rich_selection.getSelection(selection)
+    else:
+        OpenMaya.MGlobal.getActiveSelectionList(selection)
+
+    vertices = set()
+    it = OpenMaya.MItSelectionList(selection, OpenMaya.MFn.kMeshVertComponent)
+    while not it.isDone():
+        path = OpenMaya.MDagPath()
+        component = OpenMaya.MObject()
+        it.getDagPath(path, component)
+        if not component.isNull():
+            elements = OpenMaya.MIntArray()
+            OpenMaya.MFnSingleIndexedComponent(component).getElements(elements)
+            vertices.update(elements[i] for i in xrange(elements.length()))
+        it.next()
+
+    return vertices
+
+def _grow_vertices(mesh, vertices, rings):
+    """
+    Grow a set of vertex indices on mesh by the given number of rings, and return them
+    as a sorted list.
+    """
+    result = set(vertices)
+    frontier = set(vertices)
+
+    it = OpenMaya.MItMeshVertex(_get_dag_path(mesh))
+    prev_index_util = OpenMaya.MScriptUtil()
+    prev_index = prev_index_util.asIntPtr()
+    connected = OpenMaya.MIntArray()
+    for ring in xrange(rings):
+        next_frontier = set()
+        for idx in frontier:
+            it.setIndex(idx, prev_index)
+            it.getConnectedVertices(connected)
+            next_frontier.update(connected[i] for i in xrange(connected.length()))
+
+        frontier = next_frontier - result
+        result.update(frontier)
+        if not frontier:
+            break
+
+    return sorted(result)
+
+def _get_sculpted_vertices(deformer):
+    """
+    Return a sorted list of the vertices that deformer has tweaks on.
+
+    This asks the node rather than listing .invertedTweak, which always has the placeholder
+    element at index 0, and which only has the placeholder after loading a scene saved with
+    packed tweaks until the node unpacks them.
+    """
+    node = _get_deformer_node(deformer)
+    indices, deltas = node.get_applied_tweak(node._forceCache())
+    return sorted(int(idx) for idx in indices)
+
+def _get_region_vertices(deformer, inverted_shape, rings):
+    """
+    Return the vertices to update when updating the inversion for a region: the vertices
+    that have been sculpted and the current selection, grown by rings.
+    """
+    vertices = set(_get_sculpted_vertices(deformer))
+    vertices.update(_get_selected_vertices())
+    return _grow_vertices(inverted_shape, vertices, rings)
+
+def _get_inversion_matrices(deformer, count):
+    """
+    Return (matrices, jacobians, unsolved) for deformer's current inversion matrices and
+    forward Jacobians, where unsolved is a sorted list of vertices that haven't been probed
+    for the current pose.
+
+    If the deformer doesn't have count matrices, return identity matrices with all vertices
+    unsolved.
+
+    The buffers are copies of the node's cached buffers, so they can be modified.
+    """
+    node = _get_deformer_node(deformer)
+    data_block = node._forceCache()
+
+    matrices = node.get_matrices(data_block)
+    if zInvertedBlendShapeMath.matrix_count(matrices) != count:
+        matrices = zInvertedBlendShapeMath.identity_matrices(count)
+        return matrices, zInvertedBlendShapeMath.identity_matrices(count), range(count)
+
+    jacobians = node.get_forward_matrices(data_block)
+    unsolved = sorted(node.get_unsolved_vertices(data_block))
+    return copy.copy(matrices), copy.copy(jacobians), unsolved
+
+def _get_blend_shape_target(inverted_shape):
+    """
+    Return (blend_shape, target, key) for the blendShape target that inverted_shape is
+    connected to, or (None, None, None) if it isn't connected directly to a target.
+
+    key is the same for two targets of blend_shape only if moving either inverted mesh moves
+    the blendShape's output by the same amount at every vertex.  It includes the target
+    weight, which in-between item the mesh drives and the target's painted weights.
+    """
+    plugs = cmds.listConnections('%s.worldMesh' % inverted_shape, d=True, s=False, plugs=True, type='blendShape') or []
+    for plug in plugs:
+        match = re.match(r'([^.]+)\.inputTarget\[(\d+)\]\.inputTargetGroup\[(\d+)\]\.inputTargetItem\[(\d+)\]', plug)
+        if match is None:
+            continue
+
+        blend_shape, geometry_index, target, item = match.group(1), int(match.group(2)), int(match.group(3)), int(match.group(4))
+        target_plug = '%s.inputTarget[%i].inputTargetGroup[%i]' % (blend_shape, geometry_index, target)
+        items = tuple(cmds.getAttr('%s.inputTargetItem' % target_plug, mi=True) or ())
+        weight = cmds.getAttr('%s.weight[%i]' % (blend_shape, target))
+
+        # Unset painted weights are 1, so leave out weights of 1 so both hash the same.
+        selection = OpenMaya2.MSelectionList()
+        selection.add('%s.targetWeights' % target_plug)
+        weights_plug = selection.getPlug(0)
+        hasher = hashlib.sha1()
+        for idx in weights_plug.getExistingArrayAttributeIndices():
+            value = round(weights_plug.elementByLogicalIndex(idx).asFloat(), 5)
+            if value != 1:
+                hasher.update('%i:%r;' % (idx, value))
+
+        return blend_shape, target, (round(weight, 5), item, items, hasher.hexdigest())
+
+    return None, None, None
+
+def _find_skin_cluster_chain(posed_mesh, blend_shape):
+    """
+    If the only thing between blend_shape and posed_mesh is a skinCluster, return
+    (skin_cluster, geometry_index), where geometry_index is the blendShape's output
+    geometry index.  Otherwise, return None.
+
+    tweak and groupParts nodes in between are allowed, since they don't change how
+    vertices move.
+    """
+    skin_cluster = None
+    plug = '%s.inMesh' % posed_mesh
+    while True:
+        sources = cmds.listConnections(plug, s=True, d=False, plugs=True) or []
+        if len(sources) != 1:
+            return None
+
+        node, attr = sources[0].split('.', 1)
+        node_type = cmds.nodeType(node)
+        if node_type == 'groupParts':
+            plug = '%s.inputGeometry' % node
+            continue
+
+        match = re.match(r'outputGeometry\[(\d+)\]$', attr)
+        if match is None:
+            return None
+        geometry_index = int(match.group(1))
+
+        if node == blend_shape:
+            if skin_cluster is None:
+                return None
+            return skin_cluster, geometry_index
+
+        if node_type == 'skinCluster' and skin_cluster is None:
+            skin_cluster = node
+        elif node_type != 'tweak':
+            return None
+
+        plug = '%s.input[%i].inputGeometry' % (node, geometry_index)
+
+def _get_sparse_weights(plug, count):
+    """
+    Return a list of count values from a sparse array of weights that default to 1.
+    """
+    weights = [1.0] * count
+    for idx in plug.getExistingArrayAttributeIndices():
+        if idx < count:
+            weights[idx] = plug.elementByLogicalIndex(idx).asFloat()
+    return weights
+
+def _get_skin_cluster_jacobians(posed_mesh, blend_shape, target, vertices=None):
+    """
+    If posed_mesh is deformed from blend_shape by a linear skinCluster, calculate the Jacobian
+    of each vertex from the skin weights and influence matrices, and return them as a matrix
+    buffer.  This doesn't evaluate the rig at all.
+
+    If vertices is a sorted list of vertex indices, only the Jacobians of those vertices
+    are returned.
+
+    Return None if the rig isn't one we can handle this way, and it needs to be probed.
+    """
+    chain = _find_skin_cluster_chain(posed_mesh, blend_shape)
+    if chain is None:
+        return None
+    skin_cluster, geometry_index = chain
+
+    # Only classic linear skinning is linear in the input points.
+    if cmds.getAttr('%s.skinningMethod' % skin_cluster) != 0:
+        return None
+
+    # In-between targets and world space targets don't scale linearly with the target weight.
+    target_plug = '%s.inputTarget[%i].inputTargetGroup[%i]' % (blend_shape, geometry_index, target)
+    if cmds.getAttr('%s.inputTargetItem' % target_plug, mi=True) != [6000]:
+        return None
+    if cmds.getAttr('%s.origin' % blend_shape, asString=True) != 'local':
+        return None
+
+    # This uses API 2.0, since its arrays convert to Python lists far faster than API 1.0's,
+    # and there's one weight for each influence on every vertex.
+    selection = OpenMaya2.MSelectionList()
+    selection.add(skin_cluster)
+    selection.add(posed_mesh)
+    selection.add('%s.targetWeights' % target_plug)
+    selection.add('%s.inputTarget[%i].baseWeights' % (blend_shape, geometry_index))
+    skin_cluster_fn = OpenMayaAnim2.MFnSkinCluster(selection.getDependNode(0))
+    mesh_path = selection.getDagPath(1)
+
+    vertex_count = OpenMaya2.MFnMesh(mesh_path).numVertices
+    components = OpenMaya2.MFnSingleIndexedComponent()
+    components.create(OpenMaya2.MFn.kMeshVertComponent)
+    if vertices is None:
+        components.setCompleteData(vertex_count)
+    else:
+        components.addElements(vertices)
+    weights, influence_count = skin_cluster_fn.getWeights(mesh_path, components.object())
+    weights = list(weights)
+    if len(weights) != components.elementCount * influence_count:
+        return None
+
+    def get_matrix(plug):
+        return OpenMaya2.MFnMatrixData(plug.asMObject()).matrix()
+
+    def upper_3x3(matrix):
+        return [matrix.getElement(row, col) for row in xrange(3) for col in xrange(3)]
+
+    # The weights are in the order of influenceObjects, which isn't the logical index of their
+    # .matrix and .bindPreMatrix.
+    matrix_plug = skin_cluster_fn.findPlug('matrix', False)
+    bind_pre_matrix_plug = skin_cluster_fn.findPlug('bindPreMatrix', False)
+    influence_matrices = []
+    for influence in skin_cluster_fn.influenceObjects():
+        idx = skin_cluster_fn.indexForInfluenceObject(influence)
+        matrix = get_matrix(bind_pre_matrix_plug.elementByLogicalIndex(idx)) * get_matrix(matrix_plug.elementByLogicalIndex(idx))
+        influence_matrices.extend(upper_3x3(matrix))
+
+    geom_matrix = upper_3x3(get_matrix(skin_cluster_fn.findPlug('geomMatrix', False)))
+    envelope = skin_cluster_fn.findPlug('envelope', False).asFloat()
+    normalize = skin_cluster_fn.findPlug('normalizeWeights', False).asInt() == 2
+
+    # Moving a target vertex moves the blendShape's output by the target weight, scaled by
+    # the blendShape's envelope and painted weights.
+    target_weights = _get_sparse_weights(selection.getPlug(2), vertex_count)
+    base_weights = _get_sparse_weights(selection.getPlug(3), vertex_count)
+    scale = cmds.getAttr('%s.weight[%i]' % (blend_shape, target)) * cmds.getAttr('%s.envelope' % blend_shape)
+    scales = [scale * a * b for a, b in zip(target_weights, base_weights)]
+    if vertices is not None:
+        scales = [scales[idx] for idx in vertices]
+
+    return zInvertedBlendShapeMath.skin_jacobians(weights, zInvertedBlendShapeMath.matrix_buffer(influence_matrices),
+            geom_matrix, envelope, normalize, scales)
+
+def _probe_deformer(deformer, posed_mesh):
+    """
+    Return the points of posed_mesh with deformer's output moved by (0,0,0), (1,0,0), (0,1,0)
+    and (0,0,1), as point buffers.
+    """
+    # We need to find out the effect that translating the blend shape vertices has.  Do
+    # this by putting the deformer in probe mode, which replaces its output with the input
+    # geometry offset by .probeOffset.  These are set through the API, so they're fast and
+    # don't go into the undo queue.
+    deformer_fn = OpenMaya.MFnDependencyNode(_get_mobject(deformer))
+    node_state_plug = deformer_fn.findPlug('nodeState', False)
+    probe_plug = deformer_fn.findPlug('probe', False)
+    probe_offset_plug = deformer_fn.findPlug('probeOffset', False)
+
+    def probe(*offset):
+        for axis in xrange(3):
+            probe_offset_plug.child(axis).setFloat(offset[axis])
+        return _read_points(posed_mesh)
+
+    # The deformer needs to be enabled for probing to do anything.
+    old_node_state = node_state_plug.asInt()
+    node_state_plug.setInt(0)
+    probe_plug.setBool(True)
+    try:
+        # The base shape data, and the base shape after being deformed on each axis:
+        return [probe(0, 0, 0), probe(1, 0, 0), probe(0, 1, 0), probe(0, 0, 1)]
+    finally:
+        probe(0, 0, 0)
+        probe_plug.setBool(False)
+        node_state_plug.setInt(old_node_state)
+
+# Inversion matrices that have already been solved, keyed by a fingerprint of the pose.
+_matrix_cache = zInvertedBlendShapeMath.MatrixCache(256 * 1024 * 1024)
+_matrix_cache_on_disk = False
+
+# The deformer types that _get_pose_fingerprint knows how to fingerprint.
+_fingerprinted_deformer_types = ('skinCluster', 'blendShape', 'tweak', 'zInvertedBlendShape')
+
+def set_inversion_cache(max_megabytes=256, on_disk=False):
+    """
+    Configure the cache of inversion matrices for previously seen poses.
+
+    If on_disk is true, cached matrices are also saved in a directory next to the scene,
+    so they're still available in later sessions.
+    """
+    global _matrix_cache_on_disk
+    _matrix_cache_on_disk = on_disk
+    _matrix_cache.resize(max_megabytes * 1024 * 1024)
+
+def clear_inversion_cache():
+    """
+    Forget the inversion matrices of previously seen poses.
+    """
+    _matrix_cache.clear()
+    if _matrix_cache.directory is not None and os.path.isdir(_matrix_cache.directory):
+        for filename in os.listdir(_matrix_cache.directory):
+            if filename.endswith('.zibc'):
+                os.remove(os.path.join(_matrix_cache.directory, filename))
+
+def _update_matrix_cache_directory():
+    """
+    Point the matrix cache at the current scene's sidecar directory, if it's enabled.
+    """
+    scene = cmds.file(q=True, sceneName=True)
+    if _matrix_cache_on_disk and scene:
+        _matrix_cache.directory = '%s.inversionCache' % scene
+    else:
+        _matrix_cache.directory = None
+
+def _get_matrix_plug_values(plug):
+    """
+    Return the values of a matrix plug, rounded for _get_pose_fingerprint.  If plug is an
+    array, return the logical index and values of each element.
+    """
+    if plug.isArray():
+        values = []
+        for idx in xrange(plug.numElements()):
+            element = plug.elementByPhysicalIndex(idx)
+            values.append(element.logicalIndex())
+            values.extend(_get_matrix_plug_values(element))
+        return values
+
+    matrix = OpenMaya.MFnMatrixData(plug.asMObject()).matrix()
+    return [round(matrix(row, col), 6) for row in xrange(4) for col in xrange(4)]
+
+def _get_skin_weights_digest(skin_cluster):
+    """
+    Return a digest of the weights of a skinCluster on each of its geometries, for
+    _get_pose_fingerprint.
+    """
+    # This uses API 2.0, since its arrays convert far faster than API 1.0's.
+    selection = OpenMaya2.MSelectionList()
+    selection.add(skin_cluster)
+    skin_cluster_fn = OpenMayaAnim2.MFnSkinCluster(selection.getDependNode(0))
+
+    hasher = hashlib.sha1()
+    for idx in xrange(skin_cluster_fn.numOutputConnections()):
+        path = skin_cluster_fn.getPathAtIndex(skin_cluster_fn.indexForOutputConnection(idx))
+        weights, influence_count = skin_cluster_fn.getWeights(path, OpenMaya2.MObject())
+        hasher.update(repr((idx, influence_count)))
+        hasher.update(array.array('d', weights).tostring())
+    return hasher.hexdigest()
+
+def _get_pose_fingerprint(posed_mesh, group_key):
+    """
+    Return a string that identifies the current pose of posed_mesh's rig, for probing through
+    the deformers in group_key.
+
+    This hashes the topology counts of posed_mesh, the nodes in its history, and the envelope
+    of each deformer.  For each skinCluster it adds the influence, bind pre-matrix and
+    geometry matrices and the skin weights, for each blendShape the weights, and for each tweak
+    node the vertex offsets.  Return None if the history contains deformers that we can't
+    fingerprint.
+    """
+    mesh_fn = OpenMaya.MFnMesh(_get_dag_path(posed_mesh))
+    topology = (mesh_fn.numVertices(), mesh_fn.numEdges(), mesh_fn.numPolygons(), mesh_fn.numFaceVertices())
+
+    history = _get_history(posed_mesh, pruneDagObjects=True)
+    hasher = hashlib.sha1(repr((group_key, topology, [(node, node_types[-1]) for node, node_types in history])))
+    for node, node_types in history:
+        if 'geometryFilter' not in node_types:
+            continue
+        if node_types[-1] not in _fingerprinted_deformer_types:
+            return None
+
+        dep_node = OpenMaya.MFnDependencyNode(_get_mobject(node))
+        values = [node, dep_node.findPlug('envelope', False).asFloat()]
+
+        if node_types[-1] == 'skinCluster':
+            for attr in ('matrix', 'bindPreMatrix', 'geomMatrix'):
+                values.append(attr)
+                values.extend(_get_matrix_plug_values(dep_node.findPlug(attr, False)))
+            values.append(_get_skin_weights_digest(node))
+        elif node_types[-1] == 'tweak':
+            values.append(dep_node.findPlug('relativeTweak', False).asBool())
+            vlist_plug = dep_node.findPlug('vlist', False)
+            vertex_attr = dep_node.attribute('vertex')
+            for idx in xrange(vlist_plug.numElements()):
+                vlist_element = vlist_plug.elementByPhysicalIndex(idx)
+                vertex_plug = vlist_element.child(vertex_attr)
+                values.append(vlist_element.logicalIndex())
+                for vertex_idx in xrange(vertex_plug.numElements()):
+                    element = vertex_plug.elementByPhysicalIndex(vertex_idx)
+                    values.append(element.logicalIndex())
+                    values.extend(round(element.child(axis).asFloat(), 6) for axis in xrange(3))
+        elif node_types[-1] == 'blendShape':
+            weight_plug = dep_node.findPlug('weight', False)
+            for idx in xrange(weight_plug.numElements()):
+                element = weight_plug.elementByPhysicalIndex(idx)
+                values.extend((element.logicalIndex(), round(element.asFloat(), 6)))
+
+        hasher.update(repr(values))
+
+    return hasher.hexdigest()
+
+def _update_inversion_for_deformer(deformer, vertices=None, recalculate_tweak=True, fill_unsolved=False, background=False, callback=None):
+    """
+    Update the inversion matrices of deformer for the current pose.
+
+    If vertices is a sorted list of vertex indices, only those vertices are solved.  If
+    recalculate_tweak is false, .tweak isn't updated from .invertedTweak afterwards.
+    fill_unsolved, background and callback are the same as for _update_inversion_for_deformers.
+    """
+    if vertices is not None:
+        vertices = {deformer: vertices}
+    _update_inversion_for_deformers([deformer], vertices, recalculate_tweak, fill_unsolved=fill_unsolved,
+            background=background, callback=callback)
+
+def _update_inversion_for_deformers(deformers, vertices=None, recalculate_tweak=True, probe=True, fill_unsolved=False,
+        background=False, callback=None):
+    """
+    Update the inversion matrices of a list of deformers for the current pose, and return
+    the deformers that were updated.
+
+    If vertices is a dictionary of deformers to sorted lists of vertex indices, only those
+    vertices are solved for those deformers.  The rest of their vertices still have matrices
+    for an older pose, so they're marked unsolved and are filled in when they're sculpted.
+    If fill_unsolved is true, the vertices are being filled in for the pose the others were
+    solved for, so only they stop being unsolved.
+
+    Deformers that are sculpted on the same mesh, and whose inverted meshes are targets of
+    the same blendShape with the same weight, in-between item and painted target weights,
+    all have the same Jacobians.  The rig is only
+    probed once for each of these groups, and deformers in a group that are solved for the
+    same vertices share the same matrix buffers.
+
+    Solutions for every vertex are cached by pose.  If a group's pose has been seen before,
+    the cached matrices are used for all of its vertices and the rig isn't probed at all.
+    If the blendShape only goes through a linear skinCluster, the Jacobians are calculated
+    directly from the skinCluster instead of probing.  If probe is false, deformers that
+    can't be updated either of these ways are skipped.
+
+    Probing happens right away, but the matrices are solved on worker threads.  If background
+    is true, this returns as soon as the rig has been probed, and the result is applied
+    when the solve finishes, with its progress shown in the main progress bar.  Pressing
+    escape cancels it and leaves the deformers unchanged.  This returns None in that case.
+    If callback is given, it's called with the list of updated deformers when they've been
+    updated.
+    """
+    jobs, solutions, updates = _capture_inversion(deformers, vertices or {}, probe)
+    solver = _InversionSolver(jobs)
+
+    def commit(results):
+        solutions.update(results)
+        updated = _commit_inversion(jobs, solutions, updates, recalculate_tweak, fill_unsolved)
+        if callback is not None:
+            callback(updated)
+        return updated
+
+    if not background or not jobs or cmds.about(batch=True):
+        solver.wait()
+        if solver.error is not None:
+            raise solver.error
+        return commit(solver.results())
+
+    _start_background_update(solver, commit)
+    return None
+
+def _capture_inversion(deformers, vertices, probe):
+    """
+    Gather everything needed to update the inversion of a list of deformers for the current
+    pose.  This is the part of updating the pose that has to run on the main thread: it
+    looks up cached poses, reads skinClusters and probes the rig.
+
+    Return (jobs, solutions, updates).  jobs is an OrderedDict of solves that still need
+    to be run, from a solve key to (kind, buffers, fingerprint).  kind is 'jacobians' with a
+    matrix buffer of Jacobians to invert, or 'probe' with a list of probed point buffers.
+    If fingerprint isn't None, the solution should be cached for that pose.  solutions
+    maps solve keys that are already known to their solutions, and updates is a list of
+    (deformer, posed_mesh, deformer_vertices, solve_key) for each deformer to update.
+    """
+    _update_matrix_cache_directory()
+    targets = {}
 
-def _update_inversion_for_deformer(deformer):
     # The deformer outputs to the inverted mesh, which then generally goes into a blendShape
     # and then a skinCluster to get the final mesh.  We need to figure out how changes to
     # the inverted mesh affect the final output mesh that the user is sculpting.
@@ -282,83 +866,495 @@ def _update_inversion_for_deformer(deformer):
     #
     # Doing this instead of just looking at .outputGeometry avoids problems when Maya
     # silently adds helper nodes between us and the geometry, such as createColorSet.
+    groups = collections.OrderedDict()
+    for deformer in deformers:
+        inverted_shape = _find_inverted_shape_for_deformer(deformer)
+        if not inverted_shape:
+            raise Exception('Couldn\'t find the output inverted mesh for "%s".' % deformer)
+
+        # Get the mesh that's being sculpted.
+        posed_mesh = _get_active_sculpting_mesh_for_deformer(deformer)
+        if not posed_mesh:
+            OpenMaya.MGlobal.displayError('Deformer "%s" isn\'t being sculpted.' % deformer)
+            continue
+
+        # If we can't tell which blendShape target the inverted mesh drives, probe it by itself.
+        # Otherwise, it shares a probe with the other targets that have the same weights.
+        blend_shape, target, target_key = _get_blend_shape_target(inverted_shape)
+        if blend_shape is None:
+            key = (posed_mesh, deformer)
+        else:
+            key = (posed_mesh, blend_shape, target_key)
+        groups.setdefault(key, []).append(deformer)
+        targets[deformer] = target
+
+    jobs = collections.OrderedDict()
+    solutions = {}
+    updates = []
+    for key, group in groups.iteritems():
+        posed_mesh = key[0]
+        fingerprint = _get_pose_fingerprint(posed_mesh, key)
+        full_solution = _matrix_cache.get(fingerprint) if fingerprint is not None else None
+
+        # Don't use a cached solution for a mesh with a different number of vertices.  The
+        # fingerprint includes the topology, so this only happens if the cache is out of date.
+        if full_solution is not None and zInvertedBlendShapeMath.matrix_count(full_solution[0]) != cmds.polyEvaluate(posed_mesh, vertex=True):
+            _matrix_cache.discard(fingerprint)
+            full_solution = None
+
+        # A cached solution covers every vertex, so we don't need to solve anything.
+        if full_solution is not None:
+            solutions[(key, None)] = full_solution
+
+        # Solve each set of vertices in the group once.  This uses the skinCluster if
+        # possible, and probing the rig otherwise.  The rig is probed at most once.
+        probe_points = []
+        for deformer in group:
+            deformer_vertices = vertices.get(deformer) if full_solution is None else None
+            solve_key = (key, None if deformer_vertices is None else tuple(deformer_vertices))
+            if solve_key not in solutions and solve_key not in jobs and len(key) == 3:
+                jacobians = _get_skin_cluster_jacobians(posed_mesh, key[1], targets[group[0]], deformer_vertices)
+                if jacobians is not None:
+                    jobs[solve_key] = ('jacobians', jacobians, None)
+
+            if solve_key not in solutions and solve_key not in jobs:
+                if not probe:
+                    break
+
+                if not probe_points:
+                    probe_points = _probe_deformer(group[0], posed_mesh)
+
+                    # If moving points has no effect, something's wrong.  The blend shape may not
+                    # be enabled, or there could be another deformer in the way that's replacing
+                    # the shape entirely.
+                    check_idx = deformer_vertices[0] if deformer_vertices else 0
+                    if zInvertedBlendShapeMath.point_count(probe_points[0]) > check_idx:
+                        base_x = zInvertedBlendShapeMath.point_at(probe_points[0], check_idx)[0]
+                        moved_x = zInvertedBlendShapeMath.point_at(probe_points[1], check_idx)[0]
+                        if abs(base_x - moved_x) < 0.001:
+                            OpenMaya.MGlobal.displayError('Moving the inverted mesh isn\'t moving the output mesh.  Is the blend shape for this mesh enabled?')
+                            break
+
+                points = probe_points
+                if deformer_vertices is not None:
+                    points = [zInvertedBlendShapeMath.take_points(buf, deformer_vertices) for buf in points]
+
+                # Only cache probed solutions.  Calculating them from the skinCluster is about as
+                # fast as looking them up.
+                cache_fingerprint = fingerprint if deformer_vertices is None else None
+                jobs[solve_key] = ('probe', points, cache_fingerprint)
+
+            updates.append((deformer, posed_mesh, deformer_vertices, solve_key))
+
+    return jobs, solutions, updates
+
+def _commit_inversion(jobs, solutions, updates, recalculate_tweak, fill_unsolved=False):
+    """
+    Apply the solutions gathered by _capture_inversion to the deformers, and return the
+    deformers that were updated.  fill_unsolved is the same as for _update_inversion_for_deformers.
+    """
+    for solve_key, (kind, buffers, fingerprint) in jobs.iteritems():
+        if fingerprint is not None:
+            _matrix_cache.put(fingerprint, solutions[solve_key])
+
+    updated = []
+    for deformer, posed_mesh, deformer_vertices, solve_key in updates:
+        # The deformer may have been deleted while we were solving in the background.
+        if not cmds.objExists(deformer):
+            continue
+
+        matrices, jacobians, singular = solutions[solve_key]
+        if singular:
+            OpenMaya.MGlobal.displayWarning('%i vertices on %s don\'t respond to the inverted mesh, and won\'t be inverted.' % (len(singular), deformer))
+
+        # If we only solved some vertices, merge them into the existing matrices.  Unless
+        # we're filling in unsolved vertices, the rest are still for the old pose, so they
+        # become unsolved and are filled in when they're sculpted.
+        unsolved = []
+        if deformer_vertices is not None:
+            vertex_count = cmds.polyEvaluate(posed_mesh, vertex=True)
+            all_matrices, all_jacobians, unsolved = _get_inversion_matrices(deformer, vertex_count)
+            unsolved = zInvertedBlendShapeMath.merge_region(all_matrices, all_jacobians, unsolved,
+                    deformer_vertices, matrices, jacobians, stale=not fill_unsolved)
+            matrices = all_matrices
+            jacobians = all_jacobians
+
+        _set_inversion_matrices(deformer, matrices, jacobians, unsolved)
+
+        if unsolved:
+            _watch_unsolved_vertices(deformer)
+        else:
+            _unwatch_unsolved_vertices(deformer)
+
+        updated.append(deformer)
+
+    # Now that we've updated the inversion, tell the deformers to recalculate the
+    # .tweak values based on the .inverseTweak and the new .inversionMatrix.
+    if recalculate_tweak and updated:
+        cmds.zInvertedBlendShapeEdit(updated, recalculateTweak=True)
+
+    return updated
+
+class _InversionSolver(object):
+    """
+    Run the solves gathered by _capture_inversion on a pool of worker threads.
+
+    Each solve is split into chunks of vertices, so large meshes are spread across threads
+    and can be cancelled between chunks.  The solves only touch point and matrix buffers,
+    never Maya, and NumPy releases the GIL while it works, so this runs in parallel.
+    """
+    chunk_size = 65536
+
+    def __init__(self, jobs, thread_count=None):
+        self.jobs = jobs
+        self.error = None
+        self.cancelled = threading.Event()
+        self.chunk_results = {}
+        self.tasks = Queue.Queue()
+
+        self.job_chunks = {}
+        for solve_key, (kind, buffers, fingerprint) in jobs.iteritems():
+            if kind == 'jacobians':
+                count = zInvertedBlendShapeMath.matrix_count(buffers)
+            else:
+                count = zInvertedBlendShapeMath.point_count(buffers[0])
+            starts = range(0, count, self.chunk_size) or [0]
+            self.job_chunks[solve_key] = starts
+            for start in starts:
+                self.tasks.put((solve_key, start, min(start + self.chunk_size, count)))
+        self.total = self.tasks.qsize()
+
+        if thread_count is None:
+            thread_count = multiprocessing.cpu_count()
+
+        self.threads = []
+        for idx in xrange(min(thread_count, self.total)):
+            thread = threading.Thread(target=self._work, name='zInvertedBlendShapeSolve%i' % idx)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while not self.cancelled.is_set():
+            try:
+                solve_key, start, end = self.tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            kind, buffers, fingerprint = self.jobs[solve_key]
+            try:
+                if kind == 'jacobians':
+                    result = zInvertedBlendShapeMath.invert_jacobians(zInvertedBlendShapeMath.matrix_range(buffers, start, end))
+                else:
+                    result = zInvertedBlendShapeMath.solve_inversion_matrices(
+                            *[zInvertedBlendShapeMath.point_range(points, start, end) for points in buffers])
+            except Exception as e:
+                # Stop the other workers too.  The error is raised on the main thread.
+                self.error = e
+                self.cancelled.set()
+                return
+
+            self.chunk_results[(solve_key, start)] = result
+
+    @property
+    def completed(self):
+        return len(self.chunk_results)
+
+    def finished(self):
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def results(self):
+        """
+        Return a dictionary from each solve key to its (matrices, jacobians, singular),
+        once every chunk has been solved.
+        """
+        results = {}
+        for solve_key, starts in self.job_chunks.iteritems():
+            chunks = [self.chunk_results[(solve_key, start)] for start in starts]
+            if len(chunks) == 1:
+                results[solve_key] = chunks[0]
+                continue
+
+            matrices = zInvertedBlendShapeMath.concatenate_matrices([chunk[0] for chunk in chunks])
+            jacobians = zInvertedBlendShapeMath.concatenate_matrices([chunk[1] for chunk in chunks])
+            singular = [start + idx for start, chunk in zip(starts, chunks) for idx in chunk[2]]
+            results[solve_key] = (matrices, jacobians, singular)
+        return results
+
+# The update that's solving in the background, as (solver, commit, idle callback ID).
+_background_update = None
 
+def _get_main_progress_bar():
+    return maya.mel.eval('$tmp = $gMainProgressBar')
+
+def _start_background_update(solver, commit):
+    """
+    Wait for solver to finish without blocking Maya, then call commit with its results.
+
+    Only one update runs in the background at a time, so this cancels any update that's
+    still running.
+    """
+    global _background_update
+    cancel_background_update()
+
+    cmds.progressBar(_get_main_progress_bar(), e=True, beginProgress=True, isInterruptable=True,
+            status='Updating pose...', minValue=0, maxValue=max(solver.total, 1), progress=0)
+    callback_id = OpenMaya.MEventMessage.addEventCallback('idle', _poll_background_update)
+    _background_update = (solver, commit, callback_id)
+
+def _end_background_update():
+    global _background_update
+    solver, commit, callback_id = _background_update
+    _background_update = None
+    OpenMaya.MMessage.removeCallback(callback_id)
+    cmds.progressBar(_get_main_progress_bar(), e=True, endProgress=True)
+    return solver, commit
+
+def cancel_background_update():
+    """
+    Cancel the pose update that's running in the background, if any.  Nothing is changed
+    on the deformers.
+    """
+    if _background_update is None:
+        return
+
+    solver, commit = _end_background_update()
+    solver.cancel()
+    OpenMaya.MGlobal.displayWarning('Update pose cancelled.')
+
+def _poll_background_update(*args):
+    if _background_update is None:
+        return
+
+    solver = _background_update[0]
+    progress_bar = _get_main_progress_bar()
+    if cmds.progressBar(progress_bar, q=True, isCancelled=True):
+        cancel_background_update()
+        return
+
+    if not solver.finished():
+        cmds.progressBar(progress_bar, e=True, progress=solver.completed)
+        return
+
+    solver, commit = _end_background_update()
+    if solver.error is not None:
+        OpenMaya.MGlobal.displayError('Updating the pose failed: %s' % solver.error)
+        return
+
+    # Apply the whole update as a single undo.
+    cmds.undoInfo(openChunk=True)
+    try:
+        commit(solver.results())
+    finally:
+        cmds.undoInfo(closeChunk=True)
+
+# The dirty plug callback for each deformer that has unsolved vertices, and the deformers
+# that have a fill scheduled.
+_unsolved_vertex_callbacks = {}
+_scheduled_unsolved_fills = set()
+
+def _watch_unsolved_vertices(deformer):
+    """
+    After updating the inversion for a region, fill in the matrices of unsolved vertices
+    the first time they're sculpted.
+    """
+    if deformer in _unsolved_vertex_callbacks:
+        return
+
+    callback_id = OpenMaya.MNodeMessage.addNodeDirtyPlugCallback(_get_mobject(deformer), _unsolved_vertex_dirty, deformer)
+    _unsolved_vertex_callbacks[deformer] = callback_id
+
+def _unwatch_unsolved_vertices(deformer):
+    callback_id = _unsolved_vertex_callbacks.pop(deformer, None)
+    if callback_id is not None:
+        OpenMaya.MMessage.removeCallback(callback_id)
+
+def _unsolved_vertex_dirty(node, plug, deformer):
+    # The deformer notices tweaks on unsolved vertices when it computes .invertedTweak, which
+    # happens after this, so check for them when we're idle.
+    if not OpenMaya.MFnAttribute(plug.attribute()).name().startswith('tweak'):
+        return
+    if deformer in _scheduled_unsolved_fills:
+        return
+
+    _scheduled_unsolved_fills.add(deformer)
+    maya.utils.executeDeferred(_fill_unsolved_vertices, deformer)
+
+def _fill_unsolved_vertices(deformer, rings=2):
+    """
+    Probe the unsolved vertices that the deformer has seen tweaks on.
+    """
+    _scheduled_unsolved_fills.discard(deformer)
+    if not cmds.objExists(deformer):
+        _unwatch_unsolved_vertices(deformer)
+        return
+
+    node = _get_deformer_node(deformer)
+    pending = node.take_pending_vertices()
+    if not pending:
+        return
+
+    # Grow the region a little, so we don't have to do this again for every brush dab.
     inverted_shape = _find_inverted_shape_for_deformer(deformer)
-    if not inverted_shape:
-        raise Exception('Couldn\'t find the output inverted mesh for "%s".' % deformer)
+    vertices = _grow_vertices(inverted_shape, pending, rings)
+
+    # This happens in the middle of sculpting, so keep it out of the undo queue.
+    cmds.undoInfo(stateWithoutFlush=False)
+    try:
+        # Don't update .tweak, since the tweaks on these vertices are what the user
+        # sculpted.  Instead, recalculate .invertedTweak with the new matrices.
+        _update_inversion_for_deformer(deformer, vertices, recalculate_tweak=False, fill_unsolved=True)
+        cmds.zInvertedBlendShapeEdit(deformer, rebuildInvertedTweak=True)
+    finally:
+        cmds.undoInfo(stateWithoutFlush=True)
+
+# The dirty plug callbacks for each deformer in live update mode, and the deformers that
+# have an update scheduled.
+_live_update_callbacks = {}
+_scheduled_live_updates = set()
+
+# The attributes that change the pose, when they're dirtied on a deformer in the rig.  These
+# are the values _get_pose_fingerprint looks at.
+_pose_attributes = ('matrix', 'bindPreMatrix', 'weight', 'envelope')
+
+def _watch_pose(deformer):
+    """
+    Update the inversion for deformer when the pose of the mesh being sculpted changes.
+    """
+    _unwatch_pose(deformer)
 
-    # Get the mesh that's being sculpted.
     posed_mesh = _get_active_sculpting_mesh_for_deformer(deformer)
     if not posed_mesh:
-        OpenMaya.MGlobal.displayError('Deformer "%s" isn\'t being sculpted.' % deformer)
         return
 
-    # Temporarily disable the deformer.
-    old_node_state = cmds.getAttr('%s.nodeState' % deformer)
-    cmds.setAttr('%s.nodeState' % deformer, 1)
+    callback_ids = []
+    for node, node_types in _get_history(posed_mesh, pruneDagObjects=True):
+        if 'geometryFilter' not in node_types or node_types[-1] == 'zInvertedBlendShape':
+            continue
+        callback_ids.append(OpenMaya.MNodeMessage.addNodeDirtyPlugCallback(_get_mobject(node), _pose_dirty, deformer))
+    _live_update_callbacks[deformer] = callback_ids
+
+def _unwatch_pose(deformer):
+    for callback_id in _live_update_callbacks.pop(deformer, []):
+        OpenMaya.MMessage.removeCallback(callback_id)
+
+def _pose_dirty(node, plug, deformer):
+    if OpenMaya.MFnAttribute(plug.attribute()).name() not in _pose_attributes:
+        return
+    if deformer in _scheduled_live_updates:
+        return
+
+    # Wait until we're idle, so scrubbing through poses only updates once per redraw.
+    _scheduled_live_updates.add(deformer)
+    maya.utils.executeDeferred(_live_update, deformer)
+
+def _live_update(deformer):
+    """
+    Update the inversion of the vertices that deformer has tweaks on for the current pose,
+    if it can be done without probing the rig.
+    """
+    _scheduled_live_updates.discard(deformer)
+    if not cmds.objExists(deformer) or not cmds.getAttr('%s.liveUpdate' % deformer):
+        _unwatch_pose(deformer)
+        return
 
-    # In 2016 SP1, auto-keyframe makes cmds.move extremely slow, so disable it while we
-    # do this.
-    old_autokeyframe = cmds.autoKeyframe(q=True, st=True)
-    cmds.autoKeyframe(st=False)
+    posed_mesh = _get_active_sculpting_mesh_for_deformer(deformer)
+    if not posed_mesh:
+        _unwatch_pose(deformer)
+        return
+
+    # Only the vertices that have been sculpted need to follow the pose right away.  The
+    # rest still have matrices for the old pose, so they're marked unsolved, and are filled
+    # in when they're sculpted.
+    vertices = _get_sculpted_vertices(deformer)
+
+    # This happens in the middle of sculpting, so keep it out of the undo queue.
+    cmds.undoInfo(stateWithoutFlush=False)
     try:
-        # We need to find out the effect that translating the blend shape vertices
-        # has.  Do this by moving vertices on the actual blend shape.  We've disabled
-        # the deformer while we test this.
-
-        # The base shape data:
-        basePoints = _get_mesh_points(posed_mesh)
-
-        # The base shape after being deformed on each axis:
-        cmds.move(1, 0, 0, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-        xPoints = _get_mesh_points(posed_mesh)
-        cmds.move(-1, 0, 0, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-
-        cmds.move(0, 1, 0, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-        yPoints = _get_mesh_points(posed_mesh)
-        cmds.move(0, -1, 0, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-
-        cmds.move(0, 0, 1, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-        zPoints = _get_mesh_points(posed_mesh)
-        cmds.move(0, 0, -1, '%s.vtx[*]' % inverted_shape, r=True, os=True)
-
-        # If moving points has no effect, something's wrong.  The blend shape may not
-        # be enabled, or there could be another deformer in the way that's replacing
-        # the shape entirely.
-        if basePoints and abs(basePoints[0].x - xPoints[0].x) < 0.001:
-            OpenMaya.MGlobal.displayError('Moving the inverted mesh isn\'t moving the output mesh.  Is the blend shape for this mesh enabled?')
+        if vertices:
+            _update_inversion_for_deformers([deformer], {deformer: vertices}, probe=False, fill_unsolved=False)
             return
-        
+
+        # Nothing has been sculpted, so there's nothing to solve, but none of the matrices
+        # are for this pose anymore.
+        vertex_count = cmds.polyEvaluate(posed_mesh, vertex=True)
+        matrices, jacobians, unsolved = _get_inversion_matrices(deformer, vertex_count)
+        if len(unsolved) != vertex_count:
+            _set_inversion_matrices(deformer, matrices, jacobians, range(vertex_count))
+            _watch_unsolved_vertices(deformer)
     finally:
-        # Restore the deformer's state.
-        cmds.setAttr('%s.nodeState' % deformer, old_node_state)
+        cmds.undoInfo(stateWithoutFlush=True)
 
-        # Restore autoKeyframe.
-        cmds.autoKeyframe(st=old_autokeyframe)
+def restore_live_updates():
+    """
+    Watch the pose of every deformer that's being sculpted with .liveUpdate on.  This is called
+    by the plugin when a scene is loaded.
+    """
+    for deformer in cmds.ls(type='zInvertedBlendShape') or []:
+        if cmds.getAttr('%s.liveUpdate' % deformer) and _get_active_sculpting_mesh_for_deformer(deformer):
+            _watch_pose(deformer)
 
-    # Calculate the inversion matrices.
-    deformer_node = _get_mobject(deformer)
-    inversion_matrix_plug = OpenMaya.MFnDependencyNode(deformer_node).findPlug('inversionMatrix', False)
-    fnMatrixData = OpenMaya.MFnMatrixData()
+def _set_live_update(node, enabled):
+    if node is not None:
+        nodes = [node]
+    else:
+        nodes = cmds.ls(sl=True, l=True)
 
-    for i in xrange(basePoints.length()):
-        matrix = OpenMaya.MMatrix()
-        _set_matrix_row(matrix, 0, xPoints[i] - basePoints[i])
-        _set_matrix_row(matrix, 1, yPoints[i] - basePoints[i])
-        _set_matrix_row(matrix, 2, zPoints[i] - basePoints[i])
-        matrix = matrix.inverse()
+    if not nodes:
+        OpenMaya.MGlobal.displayError('Select an inverted blend shape')
+        return
 
-        matrix_node = fnMatrixData.create(matrix)
-        matrix_element_plug = inversion_matrix_plug.elementByLogicalIndex(i)
-        matrix_element_plug.setMObject(matrix_node)
+    for node in nodes:
+        deformer = _find_deformer(node)
+        if deformer is None:
+            OpenMaya.MGlobal.displayError('Couldn\'t find a zInvertedBlendShape for: %s' % node)
+            continue
 
-    # Now that we've updated the inversion, tell the deformer to recalculate the
-    # .tweak values based on the .inverseTweak and the new .inversionMatrix.
-    cmds.setAttr('%s.recalculateTweak' % deformer, 1)
+        cmds.setAttr('%s.liveUpdate' % deformer, enabled)
+        if not enabled:
+            _unwatch_pose(deformer)
+            msg = 'Live pose updates <hl>disabled</hl> for: %s' % node
+        else:
+            if _get_active_sculpting_mesh_for_deformer(deformer):
+                _watch_pose(deformer)
+                _live_update(deformer)
+            msg = 'Live pose updates <hl>enabled</hl> for: %s' % node
+        _show_message(msg)
+
+def enable_live_update(node=None):
+    """
+    Update the selected deformer's inversion automatically while sculpting, when the pose
+    changes.
 
-def update_inversion(node=None):
+    This only happens when the rig can be inverted without probing it: when the mesh is only
+    deformed by a linear skinCluster after the blendShape, or when the pose has been seen
+    before.  Otherwise, select Update pose as usual.
+    """
+    _set_live_update(node, True)
+
+def disable_live_update(node=None):
+    """
+    Stop updating the selected deformer's inversion automatically.
+    """
+    _set_live_update(node, False)
+
+def update_inversion(node=None, region=False, rings=2):
     """
     Update the selected deformer's inversion, so it inverts the current pose.
+
+    If a blendShape is selected, every inverted shape on it that's being sculpted is
+    updated.  Deformers on the same blendShape are updated together, so the rig only
+    has to be probed once.
+
+    If region is true, only the vertices that have been sculpted and the selected vertices,
+    grown by rings, are updated.  The rest are updated when they're first sculpted.
     """
     if node is not None:
         nodes = [node]
@@ -371,18 +1367,169 @@ def update_inversion(node=None):
 
     cmds.undoInfo(openChunk=True)
     try:
+        deformers = []
         for node in nodes:
-            deformer = _find_deformer(node)
-            if deformer is None:
-                OpenMaya.MGlobal.displayError('Couldn\'t find a zInvertedBlendShape for: %s' % node)
-                continue
+            if 'blendShape' in cmds.nodeType(node, inherited=True):
+                node_deformers = [deformer for deformer in _find_deformers_for_blend_shape(node)
+                        if _get_active_sculpting_mesh_for_deformer(deformer)]
+                if not node_deformers:
+                    OpenMaya.MGlobal.displayWarning('No inverted shapes on %s are being sculpted.' % node)
+            else:
+                node_deformers = [_find_deformer(node)]
+                if node_deformers[0] is None:
+                    OpenMaya.MGlobal.displayError('Couldn\'t find a zInvertedBlendShape for: %s' % node)
+                    continue
+
+            deformers.extend(deformer for deformer in node_deformers if deformer not in deformers)
+
+        vertices = None
+        if region:
+            vertices = {}
+            for deformer in list(deformers):
+                vertices[deformer] = _get_region_vertices(deformer, _find_inverted_shape_for_deformer(deformer), rings)
+                if not vertices[deformer]:
+                    OpenMaya.MGlobal.displayWarning('%s has no sculpted or selected vertices to update.' % deformer)
+                    deformers.remove(deformer)
+
+        def updated(updated_deformers):
+            for deformer in updated_deformers:
+                OpenMaya.MGlobal.displayInfo('Updated the inversion for %s.' % deformer)
+
+        # This probes each group of deformers on the same blendShape once, and recalculates
+        # .tweak for all of them with a single command.  The solve runs in the background.
+        _update_inversion_for_deformers(deformers, vertices, background=True, callback=updated)
+    finally:
+        cmds.undoInfo(closeChunk=True)
+
+def get_profile(deformer):
+    """
+    Return the profiling counters of a deformer as an OrderedDict.  Times are in seconds.
+    """
+    values = cmds.zInvertedBlendShapeProfile(deformer)
+    result = collections.OrderedDict()
+    for name, value in zip(values[0::2], values[1::2]):
+        result[name] = float(value) if '.' in value or 'e' in value else int(value)
+    return result
+
+def reset_profile(deformers=None):
+    """
+    Reset the profiling counters of the given deformers, or of every deformer in the scene.
+    """
+    if deformers is None:
+        deformers = cmds.ls(type='zInvertedBlendShape')
+    if deformers:
+        cmds.zInvertedBlendShapeProfile(deformers, reset=True)
+
+def print_profile():
+    """
+    Print the profiling counters of every deformer in the scene, with the ones that have
+    spent the most time evaluating first.
+    """
+    profiles = [(deformer, get_profile(deformer)) for deformer in cmds.ls(type='zInvertedBlendShape')]
+    total_time = lambda profile: profile['outputGeomTime'] + profile['invertedTweakTime'] + profile['tweakRecalculationTime']
+    profiles.sort(key=lambda item: total_time(item[1]), reverse=True)
+
+    print '%-40s %12s %12s %12s %12s %12s %12s' % ('deformer', 'total (s)', 'computes', 'compute (s)', 'tweak (s)', 'tweaks', 'matrix MB')
+    for deformer, profile in profiles:
+        print '%-40s %12.3f %12i %12.3f %12.3f %12i %12.1f' % (deformer, total_time(profile),
+                profile['outputGeomComputes'], profile['outputGeomTime'],
+                profile['invertedTweakTime'] + profile['tweakRecalculationTime'],
+                profile['tweakCount'], profile['matrixBytes'] / 1048576.0)
+
+def _get_corrective_name(deformer):
+    """
+    Return the name a deformer's corrective is exported under: the name of its inverted
+    mesh's transform, without a namespace.  Maya numbers deformers in the order they're
+    created, so their names don't line up in a rebuilt rig, but this is the name the user
+    gave the corrective.
+    """
+    inverted_shape = _find_inverted_shape_for_deformer(deformer)
+    if not inverted_shape:
+        raise RuntimeError('Couldn\'t find the output inverted mesh for %s.' % deformer)
+
+    transform = cmds.listRelatives(inverted_shape, parent=True, fullPath=True)[0]
+    return transform.rsplit('|', 1)[-1].rsplit(':', 1)[-1]
+
+def _get_deformers_for_files(nodes):
+    """
+    Return the deformers for a list of nodes, the selection if nodes is None, or every
+    deformer in the scene if nothing is selected.
+    """
+    if nodes is None:
+        nodes = cmds.ls(sl=True) or cmds.ls(type='zInvertedBlendShape')
+
+    deformers = []
+    for node in nodes:
+        deformer = _find_deformer(node)
+        if deformer is None:
+            OpenMaya.MGlobal.displayError('Couldn\'t find a zInvertedBlendShape for: %s' % node)
+            continue
+        if deformer not in deformers:
+            deformers.append(deformer)
+    return deformers
+
+def export_correctives(directory, nodes=None, matrices=False):
+    """
+    Write the sculpted changes of each deformer to a binary file in directory, and return the
+    paths.  Files are named after the inverted mesh, which is also stored in the file.  If
+    matrices is true, the inversion matrices are saved too.
+
+    The deformers are found from nodes, or from the selection if nodes is None.  If nothing
+    is selected, every deformer in the scene is exported.
+    """
+    _load_plugin()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    paths = []
+    for deformer in _get_deformers_for_files(nodes):
+        name = _get_corrective_name(deformer)
+        path = os.path.join(directory, '%s.zibs' % name)
+        if path in paths:
+            raise RuntimeError('More than one corrective is named "%s".' % name)
+
+        cmds.zInvertedBlendShapeFile(deformer, write=path, matrices=matrices, name=name)
+        paths.append(path)
+    return paths
 
-            _update_inversion_for_deformer(deformer)
+def import_correctives(directory, nodes=None, matrices=False):
+    """
+    Read the sculpted changes of each deformer from a file in directory written by
+    export_correctives, and return the deformers that were updated.  If matrices is true,
+    the inversion matrices are read too.  Only do this if the rig is in the pose they were
+    exported in, or update the pose afterwards.
+
+    The deformers are found from nodes like export_correctives, and each one reads the file
+    named after its inverted mesh.  Deformers without a file are skipped, and a file written
+    for a different corrective is an error.  This is a single undo.
+    """
+    _load_plugin()
+    updated = []
+    cmds.undoInfo(openChunk=True)
+    try:
+        for deformer in _get_deformers_for_files(nodes):
+            name = _get_corrective_name(deformer)
+            path = os.path.join(directory, '%s.zibs' % name)
+            if not os.path.exists(path):
+                OpenMaya.MGlobal.displayWarning('No corrective file for %s in %s.' % (name, directory))
+                continue
 
-            OpenMaya.MGlobal.displayInfo('Updated the inversion for %s.' % deformer)
+            cmds.zInvertedBlendShapeFile(deformer, read=path, matrices=matrices, name=name)
+            updated.append(deformer)
     finally:
         cmds.undoInfo(closeChunk=True)
 
+    return updated
+
+def _show_message(msg):
+    """
+    Show a message in the viewport.  In batch mode, print it instead.
+    """
+    if cmds.about(batch=True):
+        OpenMaya.MGlobal.displayInfo(re.sub('</?hl>', '', msg))
+    else:
+        cmds.inViewMessage(smg=msg, pos='botCenter', fade=1)
+
 def _load_plugin():
     if not cmds.pluginInfo('zInvertedBlendShape.py', query=True, loaded=True):
         cmds.loadPlugin('zInvertedBlendShape.py')
@@ -488,14 +1635,14 @@ def invert_existing(inverted=None):
         print 'Shape: %s' % inverted_shape
 
         # There shouldn't already be zInvertedBlendShape deformer on the mesh.
-        for history_node in cmds.listHistory(inverted_shape):
-            if 'zInvertedBlendShape' in cmds.nodeType(history_node, inherited=True):
+        for history_node, node_types in _get_history(inverted_shape):
+            if 'zInvertedBlendShape' in node_types:
                 OpenMaya.MGlobal.displayError('%s already has a zInvertedBlendShape deformer (%s).' % (inverted, history_node))
                 return
 
         # Find the blendShape that the mesh feeds into.
-        for history_node in cmds.listHistory(inverted_shape, f=True, gl=True, pdo=True):
-            if 'blendShape' not in cmds.nodeType(history_node, inherited=True):
+        for history_node, node_types in _get_history(inverted_shape, future=True, groupLevels=True, pruneDagObjects=True):
+            if 'blendShape' not in node_types:
                 continue
 
             foc_blend_shape = history_node
@@ -505,20 +1652,19 @@ def invert_existing(inverted=None):
             return
 
         # Retrieve the current vertices for the inverted mesh.  Do this before we clobber it below.
-        inverted_points = _get_mesh_points(inverted_shape)
+        inverted_points = _read_points(inverted_shape)
 
         # Retrieve the input vertices coming into the blend shape.  These will become the input
         # into the deformer, and the deformer will apply the changes to get back to the inverted
         # mesh.
         blend_shape_input_geometry = _get_plug_from_node('%s.input[0].inputGeometry' % foc_blend_shape)
-        blend_shape_input_points = _get_points(blend_shape_input_geometry.asMObject())
-        if inverted_points.length() != blend_shape_input_points.length():
-            raise RuntimeError('Expected %s and %s to have the same number of points' % (inverted_points, blend_shape_input_points))
+        blend_shape_input_points = _read_points(blend_shape_input_geometry.asMObject())
+        if zInvertedBlendShapeMath.point_count(inverted_points) != zInvertedBlendShapeMath.point_count(blend_shape_input_points):
+            raise RuntimeError('Expected %s and %s to have the same number of points' % (inverted_shape, foc_blend_shape))
 
         # Replace the input geometry (the input to the deformer) with the original geometry
         # coming into the blend shape.  The inverted shape will be applied by the deformer.
-        inverted_points_iterator = _get_geometry_iterator(inverted_shape)
-        inverted_points_iterator.setAllPositions(blend_shape_input_points, OpenMaya.MSpace.kObject)
+        _write_points(inverted_shape, blend_shape_input_points)
 
         # Create the deformer.
         deformer = cmds.deformer(inverted_shape, type='zInvertedBlendShape')[0]
@@ -526,30 +1672,11 @@ def invert_existing(inverted=None):
         # Hack: If we don't have at least one element in the array, compute() won't be called on it.
         cmds.setAttr('%s.invertedTweak[0]' % deformer, 0, 0, 0)
                    
-        # Create .invertedTweak from the inverted mesh and the original mesh.
-        deformer_node = _get_mobject(deformer)
-        dep_node = OpenMaya.MFnDependencyNode(deformer_node)
-        inverted_tweak_attr = dep_node.attribute('invertedTweak')
-        data_block = dep_node.userNode()._forceCache()
-
-        output_tweak = data_block.outputArrayValue(inverted_tweak_attr)
-        builder = output_tweak.builder()
-
-        for idx, i in enumerate(xrange(inverted_points.length())):
-            delta = inverted_points[i] - blend_shape_input_points[i]
-
-            # Always create index 0, but skip other vertices with no change.
-            if idx != 0 and abs(delta[0]) < 0.001 and abs(delta[1]) < 0.001 and abs(delta[2]) < 0.001:
-                continue
-
-            element = builder.addElement(idx)
-            element.set3Float(delta.x, delta.y, delta.z)
-
-            # This is simpler, but slow.
-            # cmds.setAttr('%s.invertedTweak[%i]' % (deformer, idx), *delta)
-            
-        output_tweak.set(builder)
-        output_tweak.setAllClean()
+        # Create .invertedTweak from the inverted mesh and the original mesh, skipping vertices
+        # that moved less than the deformer's epsilon.
+        epsilon = cmds.getAttr('%s.tweakEpsilon' % deformer)
+        tweaks = zInvertedBlendShapeMath.tweaks_from_points(inverted_points, blend_shape_input_points, epsilon)
+        _get_deformer_node(deformer).set_inverted_tweak(*tweaks)
 
         OpenMaya.MGlobal.displayInfo('Result: %s' % deformer)
         return deformer
@@ -557,31 +1684,58 @@ def invert_existing(inverted=None):
     finally:
         cmds.undoInfo(closeChunk=True)
 
-def _node_visible(node):
+def _dag_node_visible(dag_node):
     """
-    Return true if node is visible.
-
-    Is there a standard way to do this?
+    Return true if an MFnDagNode isn't hidden by its own attributes.  This doesn't look at
+    its parents.
     """
-    if not cmds.attributeQuery('visibility', node=node, exists=True):
+    if not dag_node.findPlug('visibility', False).asBool():
         return False
-
-    if not cmds.getAttr('%s.visibility' % node):
-        return False
-    if cmds.getAttr('%s.intermediateObject' % node):
+    if dag_node.findPlug('intermediateObject', False).asBool():
         return False
 
     # Display layers:
-    if cmds.attributeQuery('overrideEnabled', node=node, exists=True) and cmds.getAttr('%s.overrideEnabled' % node):
-        if not cmds.getAttr('%s.overrideVisibility' % node):
-            return False
-
-    parents = cmds.listRelatives(node, parent=True, path=True) or []
-    if parents:
-        return _node_visible(parents[0])
+    if dag_node.findPlug('overrideEnabled', False).asBool() and not dag_node.findPlug('overrideVisibility', False).asBool():
+        return False
 
     return True
 
+def _get_visible_nodes(nodes):
+    """
+    Return the nodes in a list of node names that are visible, in the same order.
+
+    A node is visible if it and its parents are visible, aren't intermediate objects and
+    aren't hidden by a display layer.  This reads the attributes through the API and only
+    looks at each parent once, so checking lots of nodes under the same deep hierarchy
+    doesn't look at the same transforms over and over.
+
+    Is there a standard way to do this?
+    """
+    # The visibility of each DAG path we've looked at, by its full path name.
+    path_visibility = {}
+
+    def path_visible(path):
+        name = path.fullPathName()
+        if name not in path_visibility:
+            visible = _dag_node_visible(OpenMaya.MFnDagNode(path))
+            if visible and path.length() > 1:
+                parent = OpenMaya.MDagPath(path)
+                parent.pop()
+                visible = path_visible(parent)
+            path_visibility[name] = visible
+        return path_visibility[name]
+
+    visible_nodes = []
+    for node in nodes:
+        try:
+            path = _get_dag_path(node)
+        except RuntimeError:
+            # This isn't a DAG node, so it can't be visible.
+            continue
+
+        if path_visible(path):
+            visible_nodes.append(node)
+    return visible_nodes
 
 def _enable_editing_for_deformer(deformer):
     posed_mesh =  _find_sculpting_output_mesh(deformer)
@@ -596,9 +1750,11 @@ def _enable_editing_for_deformer(deformer):
     posed_mesh_transform = cmds.listRelatives(posed_mesh, p=True, path=True)
     cmds.select(posed_mesh_transform[0])
 
-    # If something is already connected to our tweak input, we're already enabled.
+    # If something is already connected to our tweak input, we're already enabled, unless
+    # the update that turns on .enableTweak was cancelled.
     if _get_active_sculpting_mesh_for_deformer(deformer):
-        OpenMaya.MGlobal.displayWarning('%s is already enabled for editing' % deformer)
+        if cmds.getAttr('%s.enableTweak' % deformer):
+            OpenMaya.MGlobal.displayWarning('%s is already enabled for editing' % deformer)
         return True
 
     # We're going to connect the deformer to posedMesh's tweakLocation, but we need to
@@ -617,13 +1773,30 @@ def _enable_editing_for_deformer(deformer):
     existing_connections = cmds.listConnections('%s.savedTweakConnection' % deformer)
     cmds.connectAttr('%s.tweak[0]' % deformer, '%s.tweakLocation' % posed_mesh, f=True)
 
-    # Enable propagation of .tweak to .invertedTweak.
-    cmds.setAttr('%s.enableTweak' % deformer, True)
+    # .enableTweak is turned on by _update_inversion_for_editing once the inversion is up to date.
+    return True
 
-    # Make sure the inversion is up to date.
-    _update_inversion_for_deformer(deformer)
+def _update_inversion_for_editing(deformers, background=False):
+    """
+    Update the inversion of deformers that editing was just enabled for, then enable
+    propagation of .tweak to .invertedTweak.
 
-    return True
+    Until the new matrices are in, sculpting isn't inverted, so strokes are never inverted
+    with the matrices of an old pose.  If background is true and the update is cancelled,
+    .enableTweak stays off, and enabling editing again will update it.
+    """
+    def updated(updated_deformers):
+        # Deformers whose update was skipped or failed keep .enableTweak off.
+        for deformer in updated_deformers:
+            if not cmds.objExists(deformer) or not _get_active_sculpting_mesh_for_deformer(deformer):
+                continue
+
+            cmds.setAttr('%s.enableTweak' % deformer, True)
+            if cmds.getAttr('%s.liveUpdate' % deformer):
+                _watch_pose(deformer)
+
+    # Deformers on the same blendShape are updated together, so the rig is only probed once.
+    _update_inversion_for_deformers(deformers, background=background, callback=updated)
 
 def enable_editing(node=None):
     """
@@ -642,6 +1815,7 @@ def enable_editing(node=None):
 
     cmds.undoInfo(openChunk=True)
     try:
+        deformers = []
         for node in nodes:
             # We can select a deformer or an inverted shape node.  We can't select the
             # final output shape, since we won't know which blend shape to enable.
@@ -652,7 +1826,14 @@ def enable_editing(node=None):
 
             if _enable_editing_for_deformer(deformer):
                 msg = 'Editing <hl>enabled</hl> fo: %s' % node
-                cmds.inViewMessage(smg=msg, pos='botCenter', fade=1)
+                _show_message(msg)
+                if not cmds.getAttr('%s.enableTweak' % deformer) and deformer not in deformers:
+                    deformers.append(deformer)
+
+        # Make sure the inversion is up to date.  This finishes in the background, with a
+        # single update for all of the deformers.
+        if deformers:
+            _update_inversion_for_editing(deformers, background=True)
     finally:
         cmds.undoInfo(closeChunk=True)
 
@@ -683,6 +1864,8 @@ def _disable_editing_for_deformer(deformer):
         cmds.disconnectAttr(saved_tweak_connection, '%s.savedTweakConnection[0]' % deformer)
 
     cmds.setAttr('%s.enableTweak' % deformer, False)
+    _unwatch_unsolved_vertices(deformer)
+    _unwatch_pose(deformer)
 
     return True
 
@@ -711,7 +1894,7 @@ def disable_editing(node=None):
 
             if _disable_editing_for_deformer(deformer):
                 msg = 'Editing <hl>disabled</hl> for: %s' % node
-                cmds.inViewMessage(smg=msg, pos='botCenter', fade=1)
+                _show_message(msg)
     finally:
         cmds.undoInfo(closeChunk=True)
 
@@ -0,0 +1,316 @@
+"""
+Create, update and bake inverted blend shapes without a UI, across many scenes.
+
+    mayapy zInvertedBlendShapeBatch.py manifest.json
+    mayapy zInvertedBlendShapeBatch.py manifest.json --jobs 4
+
+The manifest is a JSON file listing the scenes to process and the correctives in each:
+
+    {
+        "scenes": [
+            {
+                "scene": "rigs/body.ma",
+                "output": "baked/body.ma",
+                "export": "correctives/body",
+                "bake": true,
+                "correctives": [
+                    {
+                        "mesh": "body",
+                        "name": "body_elbowBend",
+                        "pose": {"L_elbow.rotateY": 90, "body_blendShape.body_elbowBend": 1},
+                        "frame": 12,
+                        "sculpt": "sculpts:body_elbowBend",
+                        "corrective": "correctives/body/body_elbowBend.zibs",
+                        "matrices": false
+                    }
+                ]
+            }
+        ]
+    }
+
+Each scene is opened once, and each of its correctives is processed in turn:
+
+- If "name" isn't an inverted mesh with a deformer yet, one is created for "mesh".  If
+  "name" is a mesh without a deformer, it's added like invert_existing.
+- The rig is put in the pose: attributes in "pose" are set, and the time is set to "frame".
+  The pose can include the corrective's own blendShape weight, even if it was just created.
+  The pose and the corrective's weight are put back afterwards, so a new corrective is off
+  again and doesn't change the mesh later correctives are sculpted against.
+- Editing is enabled, which updates the inversion for the pose.
+- If "sculpt" is given, it's a mesh in the scene with the same topology as "mesh", posed
+  the way the corrective should look.  The corrective is changed so "mesh" matches it.
+- If "corrective" is given, it's a file written by zInvertedBlendShape.export_correctives,
+  which replaces the corrective.  If "matrices" is true, its inversion matrices are used
+  instead of the ones just solved.
+- Editing is disabled again.
+
+Afterwards, if "export" is set, the correctives are exported to that directory.  Unless
+"bake" is false, they're then baked into their inverted meshes and the deformers are
+deleted, so the scene no longer needs the plugin.  The scene is saved to "output", or over
+itself if there's no output.  Relative paths are relative to the manifest.
+
+Scenes are processed in parallel, each in its own mayapy process.  A scene that fails
+doesn't stop the others, but the exit code is 1 if any scene failed.  The plugin and scripts
+need to be on Maya's paths, usually by installing zInvertedBlendShape.mod.
+"""
+
+import argparse, json, multiprocessing, os, subprocess, sys, traceback
+from multiprocessing.pool import ThreadPool
+
+def load_manifest(path):
+    """
+    Read a manifest, and return its list of scenes with their paths made absolute.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    resolve = lambda value: os.path.normpath(os.path.join(base_dir, value))
+
+    scenes = manifest.get('scenes')
+    if not isinstance(scenes, list):
+        raise ValueError('%s has no list of scenes.' % path)
+
+    for idx, scene in enumerate(scenes):
+        if 'scene' not in scene:
+            raise ValueError('Scene %i in %s has no "scene".' % (idx, path))
+
+        scene['scene'] = resolve(scene['scene'])
+        scene['output'] = resolve(scene['output']) if scene.get('output') else scene['scene']
+        if scene.get('export'):
+            scene['export'] = resolve(scene['export'])
+
+        for corrective in scene.setdefault('correctives', []):
+            if 'mesh' not in corrective:
+                raise ValueError('A corrective in %s has no "mesh".' % scene['scene'])
+            if corrective.get('corrective'):
+                corrective['corrective'] = resolve(corrective['corrective'])
+
+    return scenes
+
+def _set_pose(pose, frame):
+    """
+    Set the attributes in pose and the current time, and return the old pose and time.
+    """
+    import maya.cmds as cmds
+
+    old_frame = cmds.currentTime(q=True)
+    if frame is not None:
+        cmds.currentTime(frame)
+
+    old_pose = {}
+    for attr, value in pose.items():
+        old_value = cmds.getAttr(attr)
+        if isinstance(old_value, list):
+            # Compound attributes like translate come back as [(x, y, z)].
+            old_value = list(old_value[0])
+        old_pose[attr] = old_value
+
+        if isinstance(value, (list, tuple)):
+            cmds.setAttr(attr, *value)
+        else:
+            cmds.setAttr(attr, value)
+
+    return old_pose, old_frame
+
+def _find_or_create_deformer(mesh, name):
+    """
+    Return (deformer, created) for the inverted mesh name, creating the inverted mesh for
+    mesh or adding a deformer to it if needed.  created is true if the blendShape target
+    was just added.
+    """
+    import maya.cmds as cmds
+    import zInvertedBlendShape
+
+    if not cmds.objExists(name):
+        inverted_shape = zInvertedBlendShape.invert(base=mesh, name=name)
+        if inverted_shape is None:
+            raise RuntimeError('Couldn\'t create an inverted blend shape for %s.' % mesh)
+        return zInvertedBlendShape._find_deformer(inverted_shape), True
+
+    deformer = zInvertedBlendShape._find_deformer(name)
+    if deformer is None:
+        deformer = zInvertedBlendShape.invert_existing(name)
+        if deformer is None:
+            raise RuntimeError('Couldn\'t add a deformer to %s.' % name)
+    return deformer, False
+
+def _get_target_weight_attr(deformer):
+    """
+    Return the blendShape weight of the target deformer's inverted mesh drives, or None if
+    it isn't connected directly to a target.
+    """
+    import zInvertedBlendShape
+
+    inverted_shape = zInvertedBlendShape._find_inverted_shape_for_deformer(deformer)
+    blend_shape, target, key = zInvertedBlendShape._get_blend_shape_target(inverted_shape)
+    if blend_shape is None:
+        return None
+    return '%s.weight[%i]' % (blend_shape, target)
+
+def _apply_sculpt(deformer, sculpt):
+    """
+    Change deformer's corrective so the mesh being sculpted matches the mesh sculpt.
+    """
+    import maya.cmds as cmds
+    import zInvertedBlendShape, zInvertedBlendShapeMath
+
+    posed_mesh = zInvertedBlendShape._get_active_sculpting_mesh_for_deformer(deformer)
+    posed_points = zInvertedBlendShape._read_points(posed_mesh)
+    sculpt_points = zInvertedBlendShape._read_points(sculpt)
+    if zInvertedBlendShapeMath.point_count(sculpt_points) != zInvertedBlendShapeMath.point_count(posed_points):
+        raise RuntimeError('%s doesn\'t have the same number of vertices as %s.' % (sculpt, posed_mesh))
+
+    # Enabling editing set .tweak to the current corrective in the posed space.  Add the
+    # difference between the sculpt and the posed mesh to it, then invert all of it again.
+    epsilon = cmds.getAttr('%s.tweakEpsilon' % deformer)
+    changes = zInvertedBlendShapeMath.tweaks_from_points(sculpt_points, posed_points, epsilon)
+
+    node = zInvertedBlendShape._get_deformer_node(deformer)
+    data_block = node._forceCache()
+    tweaks = zInvertedBlendShapeMath.sum_tweaks(*(node.get_tweak(data_block) + changes))
+    node.set_tweak_array(data_block, node.tweak_attr, *tweaks)
+    cmds.zInvertedBlendShapeEdit(deformer, rebuildInvertedTweak=True)
+
+def run_corrective(corrective):
+    """
+    Create or update one corrective in the open scene, and return its deformer.  See the
+    module documentation for the keys of corrective.
+    """
+    import maya.cmds as cmds
+    import zInvertedBlendShape
+
+    mesh = corrective['mesh']
+    name = corrective.get('name') or '%s_inverted' % mesh
+
+    # Create the corrective before setting the pose, since the pose may set its weight.
+    deformer, created = _find_or_create_deformer(mesh, name)
+
+    # invert() turns a new target on so it can be edited.  It was off before it existed.
+    weight_attr = _get_target_weight_attr(deformer)
+    old_weight = None
+    if weight_attr is not None:
+        old_weight = 0 if created else cmds.getAttr(weight_attr)
+
+    old_pose, old_frame = _set_pose(corrective.get('pose', {}), corrective.get('frame'))
+    try:
+        if not zInvertedBlendShape._enable_editing_for_deformer(deformer):
+            raise RuntimeError('Couldn\'t enable editing for %s.' % deformer)
+
+        # Update the inversion for the pose.  This doesn't use the background, so it's
+        # finished when this returns.
+        zInvertedBlendShape._update_inversion_for_editing([deformer])
+        if not cmds.getAttr('%s.enableTweak' % deformer):
+            zInvertedBlendShape._disable_editing_for_deformer(deformer)
+            raise RuntimeError('Couldn\'t update the inversion for %s.' % deformer)
+
+        try:
+            if corrective.get('sculpt'):
+                _apply_sculpt(deformer, corrective['sculpt'])
+            if corrective.get('corrective'):
+                cmds.zInvertedBlendShapeFile(deformer, read=corrective['corrective'], matrices=bool(corrective.get('matrices')))
+        finally:
+            zInvertedBlendShape._disable_editing_for_deformer(deformer)
+    finally:
+        _set_pose(old_pose, old_frame)
+
+        # Don't fight whatever drives the weight, if it's connected.
+        if weight_attr is not None and cmds.getAttr(weight_attr, settable=True):
+            cmds.setAttr(weight_attr, old_weight)
+
+    return deformer
+
+def run_scene(scene):
+    """
+    Open a scene, process its correctives, and save it.  See the module documentation for
+    the keys of scene.
+    """
+    import maya.cmds as cmds
+    import zInvertedBlendShape
+
+    cmds.file(scene['scene'], open=True, force=True)
+    zInvertedBlendShape._load_plugin()
+
+    deformers = []
+    for corrective in scene['correctives']:
+        deformer = run_corrective(corrective)
+        print 'Updated %s' % deformer
+        if deformer not in deformers:
+            deformers.append(deformer)
+
+    if scene.get('export') and deformers:
+        for path in zInvertedBlendShape.export_correctives(scene['export'], deformers):
+            print 'Exported %s' % path
+
+    if scene.get('bake', True) and deformers:
+        cmds.zInvertedBlendShapeEdit(deformers, bake=True)
+        cmds.delete(deformers)
+        print 'Baked %i correctives' % len(deformers)
+
+    output = scene['output']
+    output_dir = os.path.dirname(output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    cmds.file(rename=output)
+    cmds.file(save=True, force=True, type='mayaBinary' if output.lower().endswith('.mb') else 'mayaAscii')
+    print 'Saved %s' % output
+
+def _run_worker(manifest_path, index):
+    """
+    Process one scene of a manifest in this mayapy process.  Return the exit code.
+    """
+    import maya.standalone
+    maya.standalone.initialize(name='python')
+    try:
+        run_scene(load_manifest(manifest_path)[index])
+        return 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        # uninitialize was added in Maya 2016.
+        if hasattr(maya.standalone, 'uninitialize'):
+            maya.standalone.uninitialize()
+
+def _run_scene_process(mayapy, manifest_path, index):
+    """
+    Run a worker process for one scene, and return (exit code, output).
+    """
+    process = subprocess.Popen([mayapy, os.path.abspath(__file__), manifest_path, '--scene', str(index)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create, update and bake inverted blend shapes in mayapy.')
+    parser.add_argument('manifest', help='JSON manifest of scenes and correctives')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='scenes to process at once')
+    parser.add_argument('--mayapy', default=sys.executable, help='mayapy to run workers with')
+    parser.add_argument('--scene', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    manifest_path = os.path.abspath(args.manifest)
+    if args.scene is not None:
+        return _run_worker(manifest_path, args.scene)
+
+    scenes = load_manifest(manifest_path)
+
+    # Each scene gets a Maya session of its own.  The pool threads just wait on the processes.
+    pool = ThreadPool(max(1, min(args.jobs, len(scenes))))
+    results = pool.map(lambda index: _run_scene_process(args.mayapy, manifest_path, index), range(len(scenes)))
+    pool.close()
+
+    failed = 0
+    for scene, (returncode, output) in zip(scenes, results):
+        print '==== %s: %s' % (scene['scene'], 'ok' if returncode == 0 else 'FAILED')
+        print output
+        if returncode != 0:
+            failed += 1
+
+    print '%i of %i scenes succeeded.' % (len(scenes) - failed, len(scenes))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
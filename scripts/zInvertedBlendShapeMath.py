@@ -0,0 +1,1052 @@
+"""
+Array math for zInvertedBlendShape.
+
+These helpers work on flat buffers of floats rather than Maya API objects, so the same
+code can be used by the plugin and by the scripts.  Points are stored as x, y, z triples
+and 3x3 matrices as nine row-major values.  If NumPy is available everything is vectorized
+and buffers are NumPy arrays.  Otherwise we fall back on plain Python and array.array
+buffers, which is slow but gives the same results.
+"""
+
+import array, base64, collections, ctypes, errno, mmap, os, struct, sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Vertices whose Jacobian is closer than this to being singular are flagged, and get an
+# identity matrix instead of an inverse.  This is the ratio of the determinant to the product
+# of the row lengths, so it only measures how close the rows are to being coplanar and doesn't
+# depend on the scale of the mesh.
+SINGULAR_TOLERANCE = 1e-4
+
+# Matrices closer than this to identity are left out of packed matrix blobs.
+IDENTITY_TOLERANCE = 1e-6
+
+# The header of a packed matrix blob: a magic number, the size of each stored value (4 or 8),
+# the total number of matrices, and how many of them are stored.  The header is followed by
+# the int32 indices of the stored matrices, then nine values for each stored matrix.
+_MATRIX_BLOB_MAGIC = b'ZIBM'
+_matrix_blob_header = struct.Struct('<4sB3xII')
+
+# The header of a MatrixCache file: a magic number, the number of matrices, and the number
+# of singular vertices, padded to 16 bytes so the arrays after it are aligned.  This is
+# followed by the float64 inversion matrices, the float64 Jacobians and the int32 singular
+# vertex indices.
+_MATRIX_CACHE_MAGIC = b'ZIBC'
+_matrix_cache_header = struct.Struct('<4sII4x')
+
+# The header of a packed tweak blob: a magic number, how the deltas are stored (TWEAK_INT16
+# or TWEAK_HALF), the number of tweaks, and the scale of int16 values.  The header is followed
+# by the int32 index of each tweak, then three values for each tweak.
+_TWEAK_BLOB_MAGIC = b'ZIBT'
+_tweak_blob_header = struct.Struct('<4sB3xIf')
+TWEAK_INT16 = 1
+TWEAK_HALF = 2
+
+# The header of a corrective file: a magic number, the format version, the number of vertices
+# in the mesh, the number of tweaks, the number of inversion matrices (0 if they weren't
+# saved), the number of unsolved vertices, and the length of the corrective's name.  The
+# header is followed by the UTF-8 name padded to 8 bytes, the int32 index of each tweak and
+# three float32 deltas for each tweak, then the float64 inversion matrices, the float64
+# Jacobians and the int32 unsolved vertex indices.  The header and each array are aligned
+# for their type, so they can be read straight out of a memory-mapped file.
+_CORRECTIVE_MAGIC = b'ZIBS'
+_CORRECTIVE_VERSION = 2
+_corrective_header = struct.Struct('<4sH2xIIIII4x')
+
+# The contents of a corrective file.  If the file has no inversion matrices, matrices and
+# jacobians are None.  name is the name the corrective was exported under.
+Corrective = collections.namedtuple('Corrective', ('vertex_count', 'indices', 'deltas', 'matrices', 'jacobians', 'unsolved', 'name'))
+
+_identity = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+def has_numpy():
+    return numpy is not None
+
+def point_buffer(values):
+    """
+    Return a point buffer from a flat sequence of x, y, z values.
+    """
+    if numpy is not None:
+        return numpy.asarray(values, dtype=numpy.float64).reshape(-1, 3)
+    return array.array('d', values)
+
+def matrix_buffer(values):
+    """
+    Return a matrix buffer from a flat sequence of row-major 3x3 matrix values.
+    """
+    if numpy is not None:
+        return numpy.asarray(values, dtype=numpy.float64).reshape(-1, 3, 3)
+    return array.array('d', values)
+
+def point_count(points):
+    if numpy is not None:
+        return len(points)
+    return len(points) // 3
+
+def matrix_count(matrices):
+    if numpy is not None:
+        return len(matrices)
+    return len(matrices) // 9
+
+def point_at(points, idx):
+    """
+    Return one point in a point buffer as an (x, y, z) tuple.
+    """
+    if numpy is not None:
+        return tuple(points[idx].tolist())
+    return tuple(points[idx*3:idx*3+3])
+
+def homogeneous_point_values(points):
+    """
+    Return a point buffer as a flat list of x, y, z, 1 values, for building an MPointArray.
+    """
+    if numpy is not None:
+        values = numpy.ones((len(points), 4))
+        values[:,0:3] = points
+        return values.ravel().tolist()
+
+    values = []
+    for i in range(0, len(points), 3):
+        values.extend((points[i], points[i+1], points[i+2], 1.0))
+    return values
+
+def matrix_at(matrices, idx):
+    """
+    Return one matrix in a matrix buffer as a tuple of nine row-major values.
+    """
+    if numpy is not None:
+        return tuple(matrices[idx].ravel().tolist())
+    return tuple(matrices[idx*9:idx*9+9])
+
+def iterate_matrices(matrices):
+    """
+    Yield each matrix in a matrix buffer as a tuple of nine row-major values.
+    """
+    if numpy is not None:
+        for matrix in matrices.reshape(-1, 9).tolist():
+            yield tuple(matrix)
+        return
+
+    for i in range(0, len(matrices), 9):
+        yield tuple(matrices[i:i+9])
+
+def identity_matrices(count):
+    """
+    Return a matrix buffer containing count identity matrices.
+    """
+    if numpy is not None:
+        matrices = numpy.empty((count, 3, 3))
+        matrices[:] = numpy.identity(3)
+        return matrices
+    return array.array('d', _identity * count)
+
+def take_points(points, indices):
+    """
+    Return a point buffer containing only the given vertices of points.
+    """
+    if numpy is not None:
+        return points[numpy.asarray(indices, dtype=int)]
+
+    result = array.array('d')
+    for idx in indices:
+        result.extend(points[idx*3:idx*3+3])
+    return result
+
+def point_range(points, start, end):
+    """
+    Return points start up to end of a point buffer.  For NumPy buffers, this is a view.
+    """
+    if numpy is not None:
+        return points[start:end]
+    return points[start*3:end*3]
+
+def matrix_range(matrices, start, end):
+    """
+    Return matrices start up to end of a matrix buffer.  For NumPy buffers, this is a view.
+    """
+    if numpy is not None:
+        return matrices[start:end]
+    return matrices[start*9:end*9]
+
+def concatenate_matrices(buffers):
+    """
+    Return a matrix buffer containing the matrices in a list of matrix buffers, in order.
+    """
+    if numpy is not None:
+        return numpy.concatenate([numpy.reshape(buf, (-1, 3, 3)) for buf in buffers])
+
+    result = array.array('d')
+    for buf in buffers:
+        result.extend(buf)
+    return result
+
+def set_matrices(matrices, indices, values):
+    """
+    Replace the given matrices in a matrix buffer with the matrices in values, in place.
+    """
+    if numpy is not None:
+        matrices[numpy.asarray(indices, dtype=int)] = values
+        return
+
+    for value_idx, idx in enumerate(indices):
+        matrices[idx*9:idx*9+9] = values[value_idx*9:value_idx*9+9]
+
+def merge_region(matrices, jacobians, unsolved, vertices, region_matrices, region_jacobians, stale=True):
+    """
+    Merge the solution for a region of vertices into full matrix buffers in place, and return
+    the sorted list of vertices that are unsolved afterwards.
+
+    If stale is true, the region was solved for a new pose, so the matrices of every vertex
+    outside of it are out of date and they're all unsolved.  Otherwise, the region fills in
+    vertices for the pose the rest were already solved for, and only vertices that were
+    unsolved before and aren't in the region stay unsolved.
+    """
+    set_matrices(matrices, vertices, region_matrices)
+    set_matrices(jacobians, vertices, region_jacobians)
+
+    if not stale:
+        return sorted(set(unsolved) - set(vertices))
+
+    count = matrix_count(matrices)
+    if numpy is not None:
+        return numpy.setdiff1d(numpy.arange(count), numpy.asarray(vertices, dtype=numpy.int64)).tolist()
+
+    region = set(vertices)
+    return [idx for idx in range(count) if idx not in region]
+
+def index_ranges(indices):
+    """
+    Compress a sorted list of indices into a flat list of [start, end) pairs.
+    """
+    ranges = []
+    for idx in indices:
+        if ranges and ranges[-1] == idx:
+            ranges[-1] = idx + 1
+        else:
+            ranges.extend((idx, idx + 1))
+    return ranges
+
+def indices_from_ranges(ranges):
+    """
+    Expand a flat list of [start, end) pairs created by index_ranges.
+    """
+    indices = []
+    for i in range(0, len(ranges) - 1, 2):
+        indices.extend(range(ranges[i], ranges[i+1]))
+    return indices
+
+def tweak_buffers(indices, deltas):
+    """
+    Return (indices, deltas) buffers for a sparse list of tweaks, given a list of vertex
+    indices and a flat list of x, y, z deltas.  The indices are int32 and the deltas are
+    float32.
+    """
+    if numpy is not None:
+        return numpy.asarray(indices, dtype=numpy.int32), numpy.asarray(deltas, dtype=numpy.float32).reshape(-1, 3)
+    return array.array('i', indices), array.array('f', deltas)
+
+def tweaks_from_points(points, base_points, tolerance):
+    """
+    Return (indices, deltas) tweak buffers for the vertices that are different between two
+    point buffers, ignoring differences smaller than tolerance on every axis.
+
+    Vertex 0 is always included, even if it hasn't moved, since the deformer needs at least
+    one tweak.
+    """
+    if numpy is not None:
+        deltas = points - base_points
+        changed = numpy.any(numpy.abs(deltas) >= tolerance, axis=1)
+        changed[0:1] = True
+        indices = numpy.flatnonzero(changed)
+        return tweak_buffers(indices, deltas[indices])
+
+    indices = []
+    deltas = []
+    for idx in range(len(points) // 3):
+        delta = [points[idx*3+axis] - base_points[idx*3+axis] for axis in range(3)]
+        if idx != 0 and all(abs(value) < tolerance for value in delta):
+            continue
+        indices.append(idx)
+        deltas.extend(delta)
+    return tweak_buffers(indices, deltas)
+
+def _half_bits(value):
+    """
+    Return the bits of the nearest float16 to a float.
+    """
+    bits = struct.unpack('<I', struct.pack('<f', value))[0]
+    sign = (bits >> 16) & 0x8000
+    exponent = ((bits >> 23) & 0xff) - 127 + 15
+    mantissa = bits & 0x7fffff
+    if exponent <= 0:
+        # Denormals, and values too small to represent at all.
+        if exponent < -10:
+            return sign
+        mantissa = (mantissa | 0x800000) >> (1 - exponent)
+        return sign | ((mantissa + 0x1000) >> 13)
+    if exponent >= 31:
+        return sign | 0x7c00
+
+    # Rounding can carry into the exponent, which is what we want.
+    return sign | ((exponent << 10) + ((mantissa + 0x1000) >> 13))
+
+def _half_value(bits):
+    """
+    Return the value of float16 bits as a float.
+    """
+    sign = -1.0 if bits & 0x8000 else 1.0
+    exponent = (bits >> 10) & 0x1f
+    mantissa = bits & 0x3ff
+    if exponent == 0:
+        return sign * mantissa * 2.0 ** -24
+    if exponent == 31:
+        return sign * float('inf')
+    return sign * (1 + mantissa / 1024.0) * 2.0 ** (exponent - 15)
+
+def pack_tweaks(indices, deltas, storage=TWEAK_INT16):
+    """
+    Pack a pair of tweak buffers into a compact string.
+
+    If storage is TWEAK_INT16, the deltas are quantized to int16, scaled so the largest delta
+    uses the whole range.  If it's TWEAK_HALF, they're stored as float16.  The result is
+    base64-encoded, so it can be stored in a string attribute.
+    """
+    count = len(indices)
+    scale = 1.0
+
+    if numpy is not None:
+        if storage == TWEAK_INT16:
+            largest = float(numpy.abs(deltas).max()) if count else 0
+            scale = largest / 32767 if largest > 0 else 1.0
+            values = numpy.rint(deltas / scale).astype('<i2')
+        else:
+            values = deltas.astype('<f2')
+        body = numpy.asarray(indices, dtype='<i4').tobytes() + values.tobytes()
+    else:
+        if storage == TWEAK_INT16:
+            largest = max(abs(value) for value in deltas) if count else 0
+            scale = largest / 32767 if largest > 0 else 1.0
+            values = array.array('h', [int(round(value / scale)) for value in deltas])
+        else:
+            values = array.array('H', [_half_bits(value) for value in deltas])
+        body = _array_to_bytes(array.array('i', indices)) + _array_to_bytes(values)
+
+    data = _tweak_blob_header.pack(_TWEAK_BLOB_MAGIC, storage, count, scale) + body
+    encoded = base64.b64encode(data)
+    if not isinstance(encoded, str):
+        encoded = encoded.decode('ascii')
+    return encoded
+
+def unpack_tweaks(blob):
+    """
+    Unpack a string created by pack_tweaks into a pair of tweak buffers.
+
+    Return None if the blob is empty.
+    """
+    if not blob:
+        return None
+
+    data = base64.b64decode(blob)
+    magic, storage, count, scale = _tweak_blob_header.unpack_from(data, 0)
+    if magic != _TWEAK_BLOB_MAGIC or storage not in (TWEAK_INT16, TWEAK_HALF):
+        raise ValueError('Invalid inverted tweak data')
+
+    indices_offset = _tweak_blob_header.size
+    values_offset = indices_offset + count * 4
+
+    if numpy is not None:
+        indices = numpy.frombuffer(data, '<i4', count, indices_offset)
+        values = numpy.frombuffer(data, '<i2' if storage == TWEAK_INT16 else '<f2', count * 3, values_offset)
+        deltas = values.astype(numpy.float32) * numpy.float32(scale)
+        return tweak_buffers(indices, deltas)
+
+    indices = _array_from_bytes('i', data, indices_offset, count)
+    if storage == TWEAK_INT16:
+        deltas = [value * scale for value in _array_from_bytes('h', data, values_offset, count * 3)]
+    else:
+        deltas = [_half_value(bits) for bits in _array_from_bytes('H', data, values_offset, count * 3)]
+    return tweak_buffers(indices, deltas)
+
+def iterate_tweaks(indices, deltas):
+    """
+    Yield (index, x, y, z) for each tweak in a pair of tweak buffers.
+    """
+    if numpy is not None:
+        for idx, delta in zip(indices.tolist(), deltas.tolist()):
+            yield idx, delta[0], delta[1], delta[2]
+        return
+
+    for i, idx in enumerate(indices):
+        yield idx, deltas[i*3], deltas[i*3+1], deltas[i*3+2]
+
+def nonzero_tweaks(indices, deltas):
+    """
+    Return (indices, deltas) tweak buffers without the tweaks that are exactly zero, like the
+    placeholder tweak at index 0.  If there aren't any, the buffers are returned unchanged.
+    """
+    if numpy is not None:
+        keep = deltas.any(axis=1)
+        if keep.all():
+            return indices, deltas
+        return indices[keep], deltas[keep]
+
+    result_indices = array.array('i')
+    result_deltas = array.array('f')
+    for i, idx in enumerate(indices):
+        delta = deltas[i*3:i*3+3]
+        if delta[0] or delta[1] or delta[2]:
+            result_indices.append(idx)
+            result_deltas.extend(delta)
+    if len(result_indices) == len(indices):
+        return indices, deltas
+    return result_indices, result_deltas
+
+def _isin(values, test_values):
+    # numpy.isin was added in NumPy 1.13.
+    if hasattr(numpy, 'isin'):
+        return numpy.isin(values, test_values)
+    return numpy.in1d(values, test_values)
+
+def merge_tweaks(indices, deltas, changed_indices, changed_deltas, removed_indices=()):
+    """
+    Return new (indices, deltas) tweak buffers with the tweaks at changed_indices replaced
+    by changed_deltas, and the tweaks at removed_indices removed.  changed_indices and
+    changed_deltas are a list of indices and a flat list of x, y, z values.
+    """
+    if numpy is not None:
+        changed_indices = numpy.asarray(changed_indices, dtype=numpy.int32)
+        changed_deltas = numpy.asarray(changed_deltas, dtype=numpy.float32).reshape(-1, 3)
+        replaced = numpy.concatenate((changed_indices, numpy.asarray(removed_indices, dtype=numpy.int32)))
+
+        keep = ~_isin(indices, replaced)
+        indices = numpy.concatenate((indices[keep], changed_indices))
+        deltas = numpy.concatenate((deltas[keep], changed_deltas))
+
+        order = numpy.argsort(indices, kind='mergesort')
+        return indices[order], deltas[order]
+
+    tweaks = dict((idx, x_y_z) for idx, x_y_z in zip(indices, zip(deltas[0::3], deltas[1::3], deltas[2::3])))
+    for idx in removed_indices:
+        tweaks.pop(idx, None)
+    for i, idx in enumerate(changed_indices):
+        tweaks[idx] = tuple(changed_deltas[i*3:i*3+3])
+
+    new_indices = sorted(tweaks)
+    new_deltas = []
+    for idx in new_indices:
+        new_deltas.extend(tweaks[idx])
+    return tweak_buffers(new_indices, new_deltas)
+
+def sum_tweaks(indices, deltas, other_indices, other_deltas):
+    """
+    Return new (indices, deltas) tweak buffers with the sum of two pairs of tweak buffers.
+    """
+    if numpy is not None:
+        unique, inverse = numpy.unique(numpy.concatenate((indices, other_indices)), return_inverse=True)
+        result = numpy.zeros((len(unique), 3), dtype=numpy.float32)
+        numpy.add.at(result, inverse, numpy.concatenate((numpy.reshape(deltas, (-1, 3)), numpy.reshape(other_deltas, (-1, 3)))))
+        return tweak_buffers(unique, result)
+
+    tweaks = {}
+    for tweak_indices, tweak_deltas in ((indices, deltas), (other_indices, other_deltas)):
+        for i, idx in enumerate(tweak_indices):
+            total = tweaks.setdefault(idx, [0.0, 0.0, 0.0])
+            for axis in range(3):
+                total[axis] += tweak_deltas[i*3+axis]
+
+    new_indices = sorted(tweaks)
+    new_deltas = []
+    for idx in new_indices:
+        new_deltas.extend(tweaks[idx])
+    return tweak_buffers(new_indices, new_deltas)
+
+def weight_buffers(indices, values):
+    """
+    Return (indices, values) buffers for sparse per-vertex weights.
+    """
+    if numpy is not None:
+        return numpy.asarray(indices, dtype=numpy.int32), numpy.asarray(values, dtype=numpy.float32)
+    return array.array('i', indices), array.array('f', values)
+
+def weight_tweaks(indices, deltas, weights=None, envelope=1.0):
+    """
+    Return tweak deltas scaled by envelope and by per-vertex weights.
+
+    weights is a pair of sparse weight buffers from weight_buffers, sorted by index.  Vertices
+    without a weight have a weight of 1.  Only the tweaked vertices are looked at.
+    """
+    if numpy is not None:
+        scale = numpy.empty(len(indices), dtype=numpy.float32)
+        scale.fill(envelope)
+        if weights is not None and len(weights[0]):
+            weight_indices, weight_values = weights
+            positions = numpy.minimum(numpy.searchsorted(weight_indices, indices), len(weight_indices) - 1)
+            found = weight_indices[positions] == indices
+            scale[found] *= weight_values[positions[found]]
+        return deltas * scale[:, numpy.newaxis]
+
+    weight_map = {}
+    if weights is not None:
+        weight_map = dict(zip(weights[0], weights[1]))
+
+    result = array.array('f')
+    for i, idx in enumerate(indices):
+        scale = envelope * weight_map.get(idx, 1.0)
+        result.extend(value * scale for value in deltas[i*3:i*3+3])
+    return result
+
+def raw_point_view(address, count):
+    """
+    Return a writable point buffer viewing count float32 x, y, z points at a memory address,
+    such as the result of MFnMesh.getRawPoints.  This requires NumPy.
+    """
+    pointer = ctypes.cast(address, ctypes.POINTER(ctypes.c_float))
+    return numpy.ctypeslib.as_array(pointer, shape=(count * 3,)).reshape(-1, 3)
+
+def copy_raw_points(address, count):
+    """
+    Return a point buffer with a copy of count float32 x, y, z points at a memory address,
+    such as the result of MFnMesh.getRawPoints.  Unlike raw_point_view, this doesn't need
+    NumPy.
+    """
+    if numpy is not None:
+        return numpy.array(raw_point_view(address, count), dtype=numpy.float64)
+    return array.array('d', (ctypes.c_float * (count * 3)).from_address(address))
+
+def add_tweaks(points, indices, deltas):
+    """
+    Add tweak buffers to a NumPy point buffer in place.  Tweaks past the end of points are
+    ignored.
+    """
+    if len(indices) and indices[-1] >= len(points):
+        in_range = indices < len(points)
+        indices, deltas = indices[in_range], deltas[in_range]
+    points[indices] += deltas
+
+def _determinant(m):
+    return (m[0] * (m[4] * m[8] - m[5] * m[7]) -
+            m[1] * (m[3] * m[8] - m[5] * m[6]) +
+            m[2] * (m[3] * m[7] - m[4] * m[6]))
+
+def _row_length_product(m):
+    result = 1.0
+    for row in range(3):
+        x, y, z = m[row*3:row*3+3]
+        result *= (x*x + y*y + z*z) ** 0.5
+    return result
+
+def _invert(m):
+    """
+    Invert a single 3x3 matrix with the adjugate.  The matrix must not be singular.
+    """
+    det = _determinant(m)
+    return (
+        (m[4] * m[8] - m[5] * m[7]) / det,
+        (m[2] * m[7] - m[1] * m[8]) / det,
+        (m[1] * m[5] - m[2] * m[4]) / det,
+        (m[5] * m[6] - m[3] * m[8]) / det,
+        (m[0] * m[8] - m[2] * m[6]) / det,
+        (m[2] * m[3] - m[0] * m[5]) / det,
+        (m[3] * m[7] - m[4] * m[6]) / det,
+        (m[1] * m[6] - m[0] * m[7]) / det,
+        (m[0] * m[4] - m[1] * m[3]) / det,
+    )
+
+def solve_inversion_matrices(base_points, x_points, y_points, z_points, tolerance=SINGULAR_TOLERANCE):
+    """
+    Given the posed mesh with no offset, and with every inverted vertex offset by one
+    unit on X, Y and Z, build the Jacobian for each vertex and invert them all at once.
+
+    Each row of a Jacobian is how far the posed vertex moved when the inverted vertex
+    moved along that axis.  Return (inverses, jacobians, singular), where singular is a list
+    of the vertex indices whose Jacobian couldn't be inverted reliably.  Those vertices get
+    identity matrices.
+    """
+    if numpy is not None:
+        base = numpy.asarray(base_points, dtype=numpy.float64).reshape(-1, 3)
+        jacobians = numpy.empty((len(base), 3, 3))
+        jacobians[:,0,:] = numpy.asarray(x_points, dtype=numpy.float64).reshape(-1, 3) - base
+        jacobians[:,1,:] = numpy.asarray(y_points, dtype=numpy.float64).reshape(-1, 3) - base
+        jacobians[:,2,:] = numpy.asarray(z_points, dtype=numpy.float64).reshape(-1, 3) - base
+        return invert_jacobians(jacobians, tolerance)
+
+    jacobians = array.array('d')
+    for i in range(0, len(base_points), 3):
+        base = base_points[i:i+3]
+        for axis_points in (x_points, y_points, z_points):
+            jacobians.extend(axis_points[i+axis] - base[axis] for axis in range(3))
+
+    return invert_jacobians(jacobians, tolerance)
+
+def invert_jacobians(jacobians, tolerance=SINGULAR_TOLERANCE):
+    """
+    Invert a matrix buffer of Jacobians, and return (inverses, jacobians, singular) like
+    solve_inversion_matrices.
+
+    Singular Jacobians are replaced with identity in place.
+    """
+    if numpy is not None:
+        # Flag singular and ill-conditioned vertices, and replace them with identity so the
+        # batched inverse below can't fail.
+        scale = numpy.prod(numpy.linalg.norm(jacobians, axis=2), axis=1)
+        singular = ~(numpy.abs(numpy.linalg.det(jacobians)) > tolerance * scale)
+        jacobians[singular] = numpy.identity(3)
+
+        return numpy.linalg.inv(jacobians), jacobians, numpy.flatnonzero(singular).tolist()
+
+    inverses = array.array('d')
+    singular = []
+    for idx, jacobian in enumerate(iterate_matrices(jacobians)):
+        if not abs(_determinant(jacobian)) > tolerance * _row_length_product(jacobian):
+            singular.append(idx)
+            inverses.extend(_identity)
+            jacobians[idx*9:idx*9+9] = array.array('d', _identity)
+            continue
+
+        inverses.extend(_invert(jacobian))
+
+    return inverses, jacobians, singular
+
+def _multiply(a, b):
+    return tuple(sum(a[row*3+i] * b[i*3+col] for i in range(3)) for row in range(3) for col in range(3))
+
+def skin_jacobians(weights, influence_matrices, geom_matrix=_identity, envelope=1.0, normalize=False, scales=None):
+    """
+    Return the Jacobians of a linear skinCluster as a matrix buffer.
+
+    weights is a flat sequence of skin weights, with one weight per influence for each vertex.
+    influence_matrices is a matrix buffer with the upper 3x3 of bindPreMatrix * matrix for
+    each influence, and geom_matrix is the upper 3x3 of the skinCluster's .geomMatrix.  If
+    normalize is true, each vertex's weights are normalized first.  If scales is given, each
+    vertex's Jacobian is multiplied by its scale afterwards, for weights applied upstream of
+    the skinCluster.
+
+    Points are skinned in world space, using geom_matrix to get there and back, and blended
+    with the original points by envelope.
+    """
+    geom_inverse = _invert(geom_matrix) if abs(_determinant(geom_matrix)) > 1e-12 else _identity
+    influence_count = matrix_count(influence_matrices)
+
+    if numpy is not None:
+        weights = numpy.asarray(weights, dtype=numpy.float64).reshape(-1, influence_count)
+        if normalize:
+            totals = weights.sum(axis=1)
+            totals[totals == 0] = 1
+            weights = weights / totals[:,numpy.newaxis]
+
+        jacobians = numpy.dot(weights, numpy.asarray(influence_matrices).reshape(-1, 9)).reshape(-1, 3, 3)
+        jacobians = numpy.einsum('ij,njk,kl->nil', numpy.reshape(geom_matrix, (3, 3)), jacobians, numpy.reshape(geom_inverse, (3, 3)))
+        jacobians = jacobians * envelope + numpy.identity(3) * (1 - envelope)
+        if scales is not None:
+            jacobians *= numpy.asarray(scales, dtype=numpy.float64)[:,numpy.newaxis,numpy.newaxis]
+        return jacobians
+
+    jacobians = array.array('d')
+    for vertex in range(len(weights) // influence_count):
+        vertex_weights = weights[vertex*influence_count:(vertex+1)*influence_count]
+        total = sum(vertex_weights) if normalize else 1
+        if total == 0:
+            total = 1
+
+        blended = [0.0] * 9
+        for influence, weight in enumerate(vertex_weights):
+            if weight == 0:
+                continue
+            matrix = influence_matrices[influence*9:influence*9+9]
+            for i in range(9):
+                blended[i] += matrix[i] * weight / total
+
+        jacobian = _multiply(_multiply(geom_matrix, blended), geom_inverse)
+        scale = scales[vertex] if scales is not None else 1
+        jacobians.extend((value * envelope + _identity[i] * (1 - envelope)) * scale for i, value in enumerate(jacobian))
+    return jacobians
+
+def invert_matrices(matrices):
+    """
+    Return a matrix buffer with the inverse of each matrix.  Singular matrices are left
+    unchanged.
+    """
+    if numpy is not None:
+        result = numpy.array(matrices)
+        invertible = numpy.abs(numpy.linalg.det(result)) > 1e-12
+        result[invertible] = numpy.linalg.inv(result[invertible])
+        return result
+
+    result = array.array('d')
+    for matrix in iterate_matrices(matrices):
+        if abs(_determinant(matrix)) > 1e-12:
+            matrix = _invert(matrix)
+        result.extend(matrix)
+    return result
+
+def transform_tweaks(matrices, indices, deltas):
+    """
+    Multiply each tweak delta, as a row vector, by the matrix for its vertex, and return the
+    new deltas.  Tweaks on vertices past the end of matrices are returned unchanged.
+    """
+    if numpy is not None:
+        result = numpy.array(deltas, dtype=numpy.float64)
+        transformed = indices < len(matrices)
+        result[transformed] = numpy.einsum('ni,nij->nj', result[transformed], matrices[indices[transformed]])
+        return result
+
+    count = matrix_count(matrices)
+    result = array.array('d')
+    for i, idx in enumerate(indices):
+        x, y, z = deltas[i*3:i*3+3]
+        if idx < count:
+            m = matrices[idx*9:idx*9+9]
+            x, y, z = (x * m[0] + y * m[3] + z * m[6],
+                       x * m[1] + y * m[4] + z * m[7],
+                       x * m[2] + y * m[5] + z * m[8])
+        result.extend((x, y, z))
+    return result
+
+def _array_to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def _array_from_bytes(typecode, data, offset, count):
+    values = array.array(typecode)
+    chunk = data[offset:offset + count * values.itemsize]
+    if hasattr(values, 'frombytes'):
+        values.frombytes(chunk)
+    else:
+        values.fromstring(chunk)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+def _write_file(path, chunks):
+    """
+    Write a list of byte strings to path.
+
+    This writes to a temporary file and moves it into place, so a reader never sees a
+    partial file.  On POSIX, the move atomically replaces any existing file.  Windows won't
+    rename over an existing file, and Python 2 has no os.replace, so there the old file is
+    removed first.  That isn't atomic: a reader can briefly find no file at all.
+    """
+    temp_path = '%s.%i.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def _map_file(path):
+    """
+    Return a read-only memory map of the file at path.
+    """
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def pack_matrices(matrices, double_precision=False):
+    """
+    Pack a matrix buffer into a compact string.
+
+    Matrices that are identity are left out.  The values are stored as float32, or float64
+    if double_precision is true.  The result is base64-encoded, so it can be stored in a
+    string attribute.
+    """
+    value_size = 8 if double_precision else 4
+    count = matrix_count(matrices)
+
+    if numpy is not None:
+        values = matrices.reshape(-1, 9)
+        stored = numpy.any(numpy.abs(values - _identity) > IDENTITY_TOLERANCE, axis=1)
+        indices = numpy.flatnonzero(stored).astype('<i4')
+        values = values[stored].astype('<f8' if double_precision else '<f4')
+        body = indices.tobytes() + values.tobytes()
+        stored_count = len(indices)
+    else:
+        indices = array.array('i')
+        values = array.array('d' if double_precision else 'f')
+        for idx, matrix in enumerate(iterate_matrices(matrices)):
+            if all(abs(a - b) <= IDENTITY_TOLERANCE for a, b in zip(matrix, _identity)):
+                continue
+            indices.append(idx)
+            values.extend(matrix)
+        body = _array_to_bytes(indices) + _array_to_bytes(values)
+        stored_count = len(indices)
+
+    data = _matrix_blob_header.pack(_MATRIX_BLOB_MAGIC, value_size, count, stored_count) + body
+    encoded = base64.b64encode(data)
+    if not isinstance(encoded, str):
+        encoded = encoded.decode('ascii')
+    return encoded
+
+def unpack_matrices(blob):
+    """
+    Unpack a string created by pack_matrices into a matrix buffer.
+
+    Return None if the blob is empty.
+    """
+    if not blob:
+        return None
+
+    data = base64.b64decode(blob)
+    magic, value_size, count, stored_count = _matrix_blob_header.unpack_from(data, 0)
+    if magic != _MATRIX_BLOB_MAGIC or value_size not in (4, 8):
+        raise ValueError('Invalid inversion matrix data')
+
+    indices_offset = _matrix_blob_header.size
+    values_offset = indices_offset + stored_count * 4
+
+    if numpy is not None:
+        # These are views into the decoded blob, not copies.
+        indices = numpy.frombuffer(data, '<i4', stored_count, indices_offset)
+        values = numpy.frombuffer(data, '<f8' if value_size == 8 else '<f4', stored_count * 9, values_offset)
+
+        matrices = identity_matrices(count)
+        matrices[indices] = values.reshape(-1, 3, 3)
+        return matrices
+
+    indices = _array_from_bytes('i', data, indices_offset, stored_count)
+    values = _array_from_bytes('d' if value_size == 8 else 'f', data, values_offset, stored_count * 9)
+
+    matrices = identity_matrices(count)
+    for stored_idx, idx in enumerate(indices):
+        matrices[idx*9:idx*9+9] = array.array('d', values[stored_idx*9:stored_idx*9+9])
+    return matrices
+
+def matrix_nbytes(matrices):
+    """
+    Return the size of a matrix buffer in bytes.
+    """
+    if numpy is not None:
+        return matrices.nbytes
+    return len(matrices) * matrices.itemsize
+
+class MatrixCache(object):
+    """
+    A least-recently-used cache of solved inversion matrices.
+
+    Keys are strings, and values are (matrices, jacobians, singular) tuples as returned by
+    solve_inversion_matrices.  Once the matrices in memory take more than max_bytes, the
+    least recently used entries are dropped.
+
+    If directory is set, entries are also written there, one file per key, and entries that
+    aren't in memory are read back by memory-mapping their file.  The buffers are copied out
+    of the mapping, so they're writable and the file isn't held open.
+    """
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _entry_size(self, value):
+        matrices, jacobians, singular = value
+        return matrix_nbytes(matrices) + matrix_nbytes(jacobians)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.zibc' % key)
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if it isn't cached.
+        """
+        value = self.entries.pop(key, None)
+        if value is None and self.directory is not None:
+            value = self._read(key)
+            if value is not None:
+                self.size += self._entry_size(value)
+
+        if value is None:
+            return None
+
+        # Move this entry to the end, so it's the last to be evicted.
+        self.entries[key] = value
+        self._evict()
+        return value
+
+    def put(self, key, value):
+        """
+        Cache value for key, replacing any existing value.
+        """
+        old_value = self.entries.pop(key, None)
+        if old_value is not None:
+            self.size -= self._entry_size(old_value)
+
+        self.entries[key] = value
+        self.size += self._entry_size(value)
+        if self.directory is not None:
+            self._write(key, value)
+        self._evict()
+
+    def discard(self, key):
+        """
+        Remove the entry for key from memory and from disk, if it's there.
+        """
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= self._entry_size(value)
+
+        if self.directory is not None:
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def resize(self, max_bytes):
+        """
+        Change the memory limit, evicting entries if needed.
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        """
+        Clear the cache in memory.  Entries on disk are left alone.
+        """
+        self.entries.clear()
+        self.size = 0
+
+    def _evict(self):
+        # Always keep the most recent entry, even if it's bigger than max_bytes by itself.
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            self.size -= self._entry_size(value)
+
+    def _write(self, key, value):
+        matrices, jacobians, singular = value
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        chunks = [_matrix_cache_header.pack(_MATRIX_CACHE_MAGIC, matrix_count(matrices), len(singular))]
+        if numpy is not None:
+            chunks.append(numpy.asarray(matrices, dtype='<f8').tobytes())
+            chunks.append(numpy.asarray(jacobians, dtype='<f8').tobytes())
+            chunks.append(numpy.asarray(singular, dtype='<i4').tobytes())
+        else:
+            chunks.append(_array_to_bytes(matrices))
+            chunks.append(_array_to_bytes(jacobians))
+            chunks.append(_array_to_bytes(array.array('i', singular)))
+        _write_file(self._path(key), chunks)
+
+    def _read(self, key):
+        try:
+            data = _map_file(self._path(key))
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        magic, count, singular_count = _matrix_cache_header.unpack_from(data, 0)
+        if magic != _MATRIX_CACHE_MAGIC:
+            raise ValueError('Invalid inversion matrix cache file: %s' % self._path(key))
+
+        matrices_offset = _matrix_cache_header.size
+        jacobians_offset = matrices_offset + count * 9 * 8
+        singular_offset = jacobians_offset + count * 9 * 8
+
+        if numpy is not None:
+            matrices = numpy.frombuffer(data, '<f8', count * 9, matrices_offset).reshape(-1, 3, 3).copy()
+            jacobians = numpy.frombuffer(data, '<f8', count * 9, jacobians_offset).reshape(-1, 3, 3).copy()
+            singular = numpy.frombuffer(data, '<i4', singular_count, singular_offset).tolist()
+            data.close()
+            return matrices, jacobians, singular
+
+        matrices = _array_from_bytes('d', data, matrices_offset, count * 9)
+        jacobians = _array_from_bytes('d', data, jacobians_offset, count * 9)
+        singular = _array_from_bytes('i', data, singular_offset, singular_count).tolist()
+        data.close()
+        return matrices, jacobians, singular
+
+def write_corrective(path, vertex_count, indices, deltas, matrices=None, jacobians=None, unsolved=(), name=u''):
+    """
+    Write a corrective to a binary file: a pair of tweak buffers for a mesh with vertex_count
+    vertices, and optionally the inversion matrices and Jacobians they were sculpted with and
+    the vertices that were unsolved.  name is stored in the file, so readers can check that
+    it's for the corrective they expect.
+    """
+    matrix_total = matrix_count(matrices) if matrices is not None else 0
+    name = name.encode('utf-8')
+    header = _corrective_header.pack(_CORRECTIVE_MAGIC, _CORRECTIVE_VERSION, vertex_count, len(indices), matrix_total,
+            len(unsolved), len(name))
+
+    chunks = [header, name + b'\0' * (-len(name) % 8)]
+    if numpy is not None:
+        chunks.append(numpy.asarray(indices, dtype='<i4').tobytes())
+        chunks.append(numpy.asarray(deltas, dtype='<f4').tobytes())
+        if matrices is not None:
+            chunks.append(numpy.asarray(matrices, dtype='<f8').tobytes())
+            chunks.append(numpy.asarray(jacobians, dtype='<f8').tobytes())
+        chunks.append(numpy.asarray(unsolved, dtype='<i4').tobytes())
+    else:
+        chunks.append(_array_to_bytes(array.array('i', indices)))
+        chunks.append(_array_to_bytes(array.array('f', deltas)))
+        if matrices is not None:
+            chunks.append(_array_to_bytes(array.array('d', matrices)))
+            chunks.append(_array_to_bytes(array.array('d', jacobians)))
+        chunks.append(_array_to_bytes(array.array('i', unsolved)))
+    _write_file(path, chunks)
+
+def read_corrective(path):
+    """
+    Read a file written by write_corrective, and return a Corrective.
+
+    The file is memory-mapped, and closed again before this returns.  The buffers are copied
+    out of the mapping, since the deformer keeps and edits them, and a file that's still
+    mapped can't be replaced on Windows.
+    """
+    if os.path.getsize(path) < _corrective_header.size:
+        raise ValueError('%s is too short to be a corrective file.' % path)
+
+    data = _map_file(path)
+    try:
+        magic, version, vertex_count, tweak_count, count, unsolved_count, name_length = _corrective_header.unpack_from(data, 0)
+        if magic != _CORRECTIVE_MAGIC:
+            raise ValueError('%s isn\'t a corrective file.' % path)
+        if version != _CORRECTIVE_VERSION:
+            raise ValueError('%s has an unsupported corrective file version (%i).' % (path, version))
+        if count not in (0, vertex_count):
+            raise ValueError('%s has %i matrices for %i vertices.' % (path, count, vertex_count))
+
+        name_offset = _corrective_header.size
+        indices_offset = name_offset + name_length + (-name_length % 8)
+        deltas_offset = indices_offset + tweak_count * 4
+        matrices_offset = deltas_offset + tweak_count * 3 * 4
+        jacobians_offset = matrices_offset + count * 9 * 8
+        unsolved_offset = jacobians_offset + count * 9 * 8
+        if len(data) < unsolved_offset + unsolved_count * 4:
+            raise ValueError('%s is truncated.' % path)
+
+        name = data[name_offset:name_offset + name_length].decode('utf-8')
+        matrices = jacobians = None
+        if numpy is not None:
+            indices = numpy.frombuffer(data, '<i4', tweak_count, indices_offset).astype(numpy.int32)
+            deltas = numpy.frombuffer(data, '<f4', tweak_count * 3, deltas_offset).astype(numpy.float32).reshape(-1, 3)
+            if count:
+                matrices = numpy.frombuffer(data, '<f8', count * 9, matrices_offset).reshape(-1, 3, 3).copy()
+                jacobians = numpy.frombuffer(data, '<f8', count * 9, jacobians_offset).reshape(-1, 3, 3).copy()
+            unsolved = numpy.frombuffer(data, '<i4', unsolved_count, unsolved_offset).tolist()
+            in_range = not tweak_count or (indices.min() >= 0 and indices.max() < vertex_count)
+        else:
+            indices = _array_from_bytes('i', data, indices_offset, tweak_count)
+            deltas = _array_from_bytes('f', data, deltas_offset, tweak_count * 3)
+            if count:
+                matrices = _array_from_bytes('d', data, matrices_offset, count * 9)
+                jacobians = _array_from_bytes('d', data, jacobians_offset, count * 9)
+            unsolved = _array_from_bytes('i', data, unsolved_offset, unsolved_count).tolist()
+            in_range = not tweak_count or (min(indices) >= 0 and max(indices) < vertex_count)
+    finally:
+        data.close()
+
+    if not in_range:
+        raise ValueError('%s has tweaks on vertices past the end of its %i-vertex mesh.' % (path, vertex_count))
+
+    return Corrective(vertex_count, indices, deltas, matrices, jacobians, unsolved, name)
@@ -0,0 +1,175 @@
+"""
+Tests for zInvertedBlendShapeBatch.  Correctives are run against a stand-in for maya.cmds
+and zInvertedBlendShape that only keeps track of attribute values:
+
+    python -m unittest discover -s tests
+"""
+
+import json, os, shutil, sys, tempfile, types, unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'scripts'))
+
+import zInvertedBlendShapeBatch
+
+def module(name, **attrs):
+    result = types.ModuleType(name)
+    result.__dict__.update(attrs)
+    return result
+
+class FakeScene(object):
+    """
+    A body mesh with a blendShape, and optionally an existing corrective on target 1.
+    """
+    deformer = 'zInvertedBlendShape1'
+    weight_attr = 'body_blendShape.weight[1]'
+
+    def __init__(self, existing_weight=None):
+        self.attrs = {'L_elbow.rotateY': 0.0}
+        self.nodes = set(['body', 'body_blendShape'])
+        self.time = 1.0
+        self.updated_poses = []
+        self.update_succeeds = True
+        if existing_weight is not None:
+            self.add_corrective('body_elbowBend', existing_weight)
+
+    def add_corrective(self, name, weight):
+        self.nodes.add(name)
+        self.attrs[self.weight_attr] = weight
+        self.attrs['%s.enableTweak' % self.deformer] = False
+        self.attrs['%s.tweakEpsilon' % self.deformer] = 0.001
+
+    def cmds(self):
+        scene = self
+        def getAttr(attr, settable=False):
+            if attr not in scene.attrs:
+                raise ValueError('No object matches name: %s' % attr)
+            return True if settable else scene.attrs[attr]
+
+        def setAttr(attr, value):
+            if attr not in scene.attrs:
+                raise ValueError('No object matches name: %s' % attr)
+            scene.attrs[attr] = value
+
+        def currentTime(frame=None, q=False):
+            if q:
+                return scene.time
+            scene.time = frame
+
+        return module('maya.cmds', getAttr=getAttr, setAttr=setAttr, currentTime=currentTime,
+                objExists=lambda name: name in scene.nodes)
+
+    def zInvertedBlendShape(self):
+        scene = self
+        def invert(base, name):
+            # Like invert(), the new target is turned on.
+            scene.add_corrective(name, 1)
+            return '%sShape' % name
+
+        def update_inversion_for_editing(deformers):
+            scene.updated_poses.append((scene.time, dict(scene.attrs)))
+            scene.attrs['%s.enableTweak' % scene.deformer] = scene.update_succeeds
+
+        def disable_editing_for_deformer(deformer):
+            scene.attrs['%s.enableTweak' % deformer] = False
+
+        return module('zInvertedBlendShape', invert=invert,
+                _find_deformer=lambda node: scene.deformer if node.startswith('body_elbowBend') else None,
+                _find_inverted_shape_for_deformer=lambda deformer: 'body_elbowBendShape',
+                _get_blend_shape_target=lambda inverted_shape: ('body_blendShape', 1, None),
+                _enable_editing_for_deformer=lambda deformer: True,
+                _update_inversion_for_editing=update_inversion_for_editing,
+                _disable_editing_for_deformer=disable_editing_for_deformer)
+
+class TestRunCorrective(unittest.TestCase):
+    names = ['maya', 'maya.cmds', 'zInvertedBlendShape']
+
+    def install(self, scene):
+        cmds = scene.cmds()
+        sys.modules.update({'maya': module('maya', cmds=cmds), 'maya.cmds': cmds,
+                'zInvertedBlendShape': scene.zInvertedBlendShape()})
+
+    def setUp(self):
+        self.saved_modules = dict((name, sys.modules.get(name)) for name in self.names)
+
+    def tearDown(self):
+        for name, module in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def corrective(self, pose):
+        return {'mesh': 'body', 'name': 'body_elbowBend', 'pose': pose, 'frame': 12}
+
+    def test_new_corrective(self):
+        # The pose can set the weight of the target that's being created, and the new target
+        # is off again afterwards, along with the rest of the pose.
+        scene = FakeScene()
+        self.install(scene)
+        deformer = zInvertedBlendShapeBatch.run_corrective(self.corrective({'L_elbow.rotateY': 90, scene.weight_attr: 1}))
+
+        self.assertEqual(deformer, scene.deformer)
+        self.assertEqual(len(scene.updated_poses), 1)
+        time, attrs = scene.updated_poses[0]
+        self.assertEqual(time, 12)
+        self.assertEqual(attrs['L_elbow.rotateY'], 90)
+        self.assertEqual(attrs[scene.weight_attr], 1)
+
+        self.assertEqual(scene.time, 1.0)
+        self.assertEqual(scene.attrs['L_elbow.rotateY'], 0)
+        self.assertEqual(scene.attrs[scene.weight_attr], 0)
+
+    def test_existing_corrective(self):
+        # An existing target's weight is left the way it was.
+        scene = FakeScene(existing_weight=0.5)
+        self.install(scene)
+        zInvertedBlendShapeBatch.run_corrective(self.corrective({'L_elbow.rotateY': 90, scene.weight_attr: 1}))
+        self.assertEqual(scene.attrs[scene.weight_attr], 0.5)
+
+    def test_failed_update(self):
+        # If the inversion isn't updated, the corrective isn't changed and the pose is put back.
+        scene = FakeScene()
+        scene.update_succeeds = False
+        self.install(scene)
+        self.assertRaises(RuntimeError, zInvertedBlendShapeBatch.run_corrective, self.corrective({'L_elbow.rotateY': 90}))
+        self.assertFalse(scene.attrs['%s.enableTweak' % scene.deformer])
+        self.assertEqual(scene.attrs['L_elbow.rotateY'], 0)
+        self.assertEqual(scene.attrs[scene.weight_attr], 0)
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def write(self, manifest):
+        with open(self.path, 'w') as f:
+            json.dump(manifest, f)
+
+    def test_paths(self):
+        # Paths are relative to the manifest, and scenes are saved over themselves by default.
+        self.write({'scenes': [
+            {'scene': 'rigs/body.ma', 'export': 'correctives/body', 'correctives': [
+                {'mesh': 'body', 'corrective': 'correctives/body/body_elbowBend.zibs'},
+            ]},
+            {'scene': 'rigs/face.ma', 'output': 'baked/face.ma'},
+        ]})
+        body, face = zInvertedBlendShapeBatch.load_manifest(self.path)
+
+        self.assertEqual(body['scene'], os.path.join(self.temp_dir, 'rigs', 'body.ma'))
+        self.assertEqual(body['output'], body['scene'])
+        self.assertEqual(body['export'], os.path.join(self.temp_dir, 'correctives', 'body'))
+        self.assertEqual(body['correctives'][0]['corrective'], os.path.join(self.temp_dir, 'correctives', 'body', 'body_elbowBend.zibs'))
+        self.assertEqual(face['output'], os.path.join(self.temp_dir, 'baked', 'face.ma'))
+        self.assertEqual(face['correctives'], [])
+
+    def test_errors(self):
+        for manifest in ({}, {'scenes': [{'output': 'body.ma'}]}, {'scenes': [{'scene': 'body.ma', 'correctives': [{}]}]}):
+            self.write(manifest)
+            self.assertRaises(ValueError, zInvertedBlendShapeBatch.load_manifest, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
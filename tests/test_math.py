@@ -0,0 +1,294 @@
+"""
+Tests for zInvertedBlendShapeMath.  These run with or without NumPy, and the tests named
+WithoutNumPy run again with the array.array fallback even if NumPy is installed:
+
+    python -m unittest discover -s tests
+"""
+
+import base64, os, shutil, sys, tempfile, unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'scripts'))
+
+import zInvertedBlendShapeMath
+
+class WithoutNumPy(object):
+    """
+    Mix this into a test case to run its tests with the array.array fallback.
+    """
+    def setUp(self):
+        self.saved_numpy = zInvertedBlendShapeMath.numpy
+        zInvertedBlendShapeMath.numpy = None
+        super(WithoutNumPy, self).setUp()
+
+    def tearDown(self):
+        super(WithoutNumPy, self).tearDown()
+        zInvertedBlendShapeMath.numpy = self.saved_numpy
+
+def flat(values):
+    """
+    Return a buffer's values as a flat list of floats.
+    """
+    if hasattr(values, 'ravel'):
+        values = values.ravel()
+    return [float(value) for value in values]
+
+def scaled_matrices(scales):
+    values = []
+    for scale in scales:
+        values.extend((scale, 0, 0, 0, scale, 0, 0, 0, scale))
+    return zInvertedBlendShapeMath.matrix_buffer(values)
+
+class TestPackMatrices(unittest.TestCase):
+    matrices = [
+        1, 0, 0, 0, 1, 0, 0, 0, 1,
+        0.5, 0.25, 0, -0.125, 2, 0, 0, 0, 3,
+        1 / 3.0, 0, 0, 0, 1, 0, 0.1, 0, 1,
+    ]
+
+    def test_round_trip(self):
+        for double_precision, places in ((False, 6), (True, 15)):
+            matrices = zInvertedBlendShapeMath.matrix_buffer(self.matrices)
+            unpacked = zInvertedBlendShapeMath.unpack_matrices(zInvertedBlendShapeMath.pack_matrices(matrices, double_precision))
+            self.assertEqual(zInvertedBlendShapeMath.matrix_count(unpacked), 3)
+            for value, expected in zip(flat(unpacked), self.matrices):
+                self.assertAlmostEqual(value, expected, places=places)
+
+    def test_identity_left_out(self):
+        # Matrices within IDENTITY_TOLERANCE of identity aren't stored, and come back as identity.
+        matrices = zInvertedBlendShapeMath.matrix_buffer(self.matrices + [1 + 1e-8, 0, 0, 0, 1, 0, 0, 0, 1])
+        blob = zInvertedBlendShapeMath.pack_matrices(matrices)
+        header_size = zInvertedBlendShapeMath._matrix_blob_header.size
+        self.assertEqual(len(base64.b64decode(blob)), header_size + 2 * (4 + 9 * 4))
+
+        unpacked = zInvertedBlendShapeMath.unpack_matrices(blob)
+        self.assertEqual(flat(zInvertedBlendShapeMath.matrix_at(unpacked, 3)), [1, 0, 0, 0, 1, 0, 0, 0, 1])
+
+    def test_empty(self):
+        self.assertIsNone(zInvertedBlendShapeMath.unpack_matrices(''))
+        self.assertRaises(ValueError, zInvertedBlendShapeMath.unpack_matrices, base64.b64encode(b'\0' * 16))
+
+class TestPackMatricesWithoutNumPy(WithoutNumPy, TestPackMatrices):
+    pass
+
+class TestPackTweaks(unittest.TestCase):
+    def tweaks(self):
+        # Vertex 0 hasn't moved but is kept as the placeholder, vertex 1 moved less than the
+        # epsilon and vertex 3 moved more than it on one axis.
+        base_points = zInvertedBlendShapeMath.point_buffer([0.0] * 12)
+        points = zInvertedBlendShapeMath.point_buffer([0, 0, 0, 0.0005, -0.0005, 0, 0.5, -0.25, 2, 0, 0.02, 0])
+        return zInvertedBlendShapeMath.tweaks_from_points(points, base_points, 0.001)
+
+    def test_round_trip(self):
+        for storage in (zInvertedBlendShapeMath.TWEAK_INT16, zInvertedBlendShapeMath.TWEAK_HALF):
+            indices, deltas = zInvertedBlendShapeMath.unpack_tweaks(zInvertedBlendShapeMath.pack_tweaks(*self.tweaks(), storage=storage))
+            self.assertEqual(list(indices), [0, 2, 3])
+            for value, expected in zip(flat(deltas), [0, 0, 0, 0.5, -0.25, 2, 0, 0.02, 0]):
+                self.assertAlmostEqual(value, expected, places=4)
+
+    def test_empty(self):
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers([], [])
+        for storage in (zInvertedBlendShapeMath.TWEAK_INT16, zInvertedBlendShapeMath.TWEAK_HALF):
+            unpacked_indices, unpacked_deltas = zInvertedBlendShapeMath.unpack_tweaks(zInvertedBlendShapeMath.pack_tweaks(indices, deltas, storage))
+            self.assertEqual(list(unpacked_indices), [])
+            self.assertEqual(flat(unpacked_deltas), [])
+
+        self.assertIsNone(zInvertedBlendShapeMath.unpack_tweaks(''))
+
+class TestPackTweaksWithoutNumPy(WithoutNumPy, TestPackTweaks):
+    pass
+
+def row_times_matrix(v, m):
+    return [v[0] * m[col] + v[1] * m[3+col] + v[2] * m[6+col] for col in range(3)]
+
+class TestSkinJacobians(unittest.TestCase):
+    # Two influences that rotate, scale and move the points, and an unnormalized weight
+    # for each influence on three vertices.  These are floats, like the values from Maya.
+    influences = [
+        ([0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0], [1.0, 2.0, 3.0]),
+        ([2.0, 0.0, 0.0, 0.0, 0.5, 0.25, 0.0, 0.0, 1.0], [-1.0, 0.0, 0.5]),
+    ]
+    weights = [1.0, 0.0, 0.25, 0.5, 0.3, 0.9]
+    geom_matrix = [0.0, 0.0, 2.0, 0.0, 1.0, 0.0, -1.0, 0.0, 0.0]
+
+    def skin(self, points, envelope, normalize):
+        # Deform points like a linear skinCluster, with row vectors as Maya uses them.
+        geom_inverse = zInvertedBlendShapeMath._invert(self.geom_matrix)
+        result = []
+        for vertex in range(len(points) // 3):
+            point = points[vertex*3:vertex*3+3]
+            world = row_times_matrix(point, self.geom_matrix)
+            vertex_weights = self.weights[vertex*2:vertex*2+2]
+            total = sum(vertex_weights) if normalize else 1
+
+            skinned = [0, 0, 0]
+            for (matrix, translate), weight in zip(self.influences, vertex_weights):
+                moved = row_times_matrix(world, matrix)
+                for axis in range(3):
+                    skinned[axis] += (moved[axis] + translate[axis]) * weight / total
+
+            skinned = row_times_matrix(skinned, geom_inverse)
+            result.extend(point[axis] + (skinned[axis] - point[axis]) * envelope for axis in range(3))
+        return result
+
+    def probe(self, envelope, normalize, scales):
+        # Move each vertex one unit along each axis, scaled like weights upstream of the skinCluster.
+        points = [0.5, 1, -2, 3, 0, 1, -1, -1, 0.25]
+        axis_points = []
+        for axis in range(3):
+            offset = list(points)
+            for vertex, scale in enumerate(scales):
+                offset[vertex*3+axis] += scale
+            axis_points.append(self.skin(offset, envelope, normalize))
+        return zInvertedBlendShapeMath.solve_inversion_matrices(self.skin(points, envelope, normalize), *axis_points)
+
+    def test_matches_probe(self):
+        influence_matrices = zInvertedBlendShapeMath.matrix_buffer(sum([matrix for matrix, translate in self.influences], []))
+        for envelope, normalize, scales in ((1, False, None), (0.5, True, [1, 0.5, 2])):
+            jacobians = zInvertedBlendShapeMath.skin_jacobians(self.weights, influence_matrices, self.geom_matrix,
+                    envelope, normalize, scales)
+            inverses, expected, singular = self.probe(envelope, normalize, scales or [1, 1, 1])
+            self.assertEqual(singular, [])
+            for value, expected_value in zip(flat(jacobians), flat(expected)):
+                self.assertAlmostEqual(value, expected_value, places=9)
+
+class TestSkinJacobiansWithoutNumPy(WithoutNumPy, TestSkinJacobians):
+    pass
+
+class TestMergeRegion(unittest.TestCase):
+    def test_region_update_after_full_solve(self):
+        # A full solve leaves nothing unsolved.  Updating a region for a new pose makes
+        # every other vertex unsolved, since its matrix is for the old pose.
+        matrices = scaled_matrices([1] * 6)
+        jacobians = scaled_matrices([1] * 6)
+        unsolved = zInvertedBlendShapeMath.merge_region(matrices, jacobians, [], [1, 4],
+                scaled_matrices([2, 3]), scaled_matrices([0.5, 1 / 3.0]))
+
+        self.assertEqual(unsolved, [0, 2, 3, 5])
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(matrices, 1)[0], 2)
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(matrices, 4)[0], 3)
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(matrices, 0)[0], 1)
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(jacobians, 1)[0], 0.5)
+
+    def test_fill_unsolved(self):
+        # Filling in vertices for the same pose only removes them from the unsolved list.
+        matrices = scaled_matrices([1] * 6)
+        jacobians = scaled_matrices([1] * 6)
+        unsolved = zInvertedBlendShapeMath.merge_region(matrices, jacobians, [0, 2, 3, 5], [2, 3],
+                scaled_matrices([2, 2]), scaled_matrices([0.5, 0.5]), stale=False)
+        self.assertEqual(unsolved, [0, 5])
+
+class TestWriteFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.zibs')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_replace(self):
+        zInvertedBlendShapeMath._write_file(self.path, [b'old'])
+        zInvertedBlendShapeMath._write_file(self.path, [b'new', b' data'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'new data')
+        self.assertEqual(os.listdir(self.temp_dir), ['test.zibs'])
+
+    @unittest.skipIf(os.name == 'nt', 'Windows can\'t rename over an existing file')
+    def test_replace_without_removing(self):
+        # On POSIX, the rename replaces the old file in one step, so it's never removed.
+        zInvertedBlendShapeMath._write_file(self.path, [b'old'])
+        def remove(path):
+            raise AssertionError('%s was removed' % path)
+        old_remove, os.remove = os.remove, remove
+        try:
+            zInvertedBlendShapeMath._write_file(self.path, [b'new'])
+        finally:
+            os.remove = old_remove
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+class TestMatrixCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_read_from_disk(self):
+        matrices = scaled_matrices([1, 2, 3])
+        jacobians = scaled_matrices([1, 0.5, 1 / 3.0])
+        zInvertedBlendShapeMath.MatrixCache(1024, self.temp_dir).put('pose', (matrices, jacobians, [2]))
+
+        # A new cache has nothing in memory, so this reads the file.
+        cache = zInvertedBlendShapeMath.MatrixCache(1024, self.temp_dir)
+        read_matrices, read_jacobians, singular = cache.get('pose')
+        self.assertEqual(singular, [2])
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(read_matrices, 2)[0], 3)
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(read_jacobians, 1)[4], 0.5)
+
+        # The matrices are copies, so they can be changed.
+        read_matrices[0] = 4
+        self.assertEqual(zInvertedBlendShapeMath.matrix_at(read_matrices, 0)[0], 4)
+
+    def test_discard(self):
+        cache = zInvertedBlendShapeMath.MatrixCache(1024, self.temp_dir)
+        cache.put('pose', (scaled_matrices([1]), scaled_matrices([1]), []))
+        cache.discard('pose')
+        self.assertIsNone(cache.get('pose'))
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+        # Discarding something that isn't there does nothing.
+        cache.discard('pose')
+
+    def test_alignment(self):
+        # The float64 arrays start on an 8-byte boundary.
+        self.assertEqual(zInvertedBlendShapeMath._matrix_cache_header.size % 8, 0)
+
+class TestCorrective(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.zibs')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_round_trip(self):
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers([0, 2], [0, 0, 0, 1, -2, 0.5])
+        zInvertedBlendShapeMath.write_corrective(self.path, 3, indices, deltas,
+                scaled_matrices([1, 2, 3]), scaled_matrices([1, 0.5, 1 / 3.0]), [1], u'body_elbowBend')
+
+        corrective = zInvertedBlendShapeMath.read_corrective(self.path)
+        self.assertEqual(corrective.vertex_count, 3)
+        self.assertEqual(list(corrective.indices), [0, 2])
+        self.assertEqual(flat(corrective.deltas), [0, 0, 0, 1, -2, 0.5])
+        self.assertEqual(flat(corrective.matrices), flat(scaled_matrices([1, 2, 3])))
+        self.assertEqual(corrective.unsolved, [1])
+        self.assertEqual(corrective.name, u'body_elbowBend')
+
+        # The matrices are copies, so they can be changed, and the file can be replaced.
+        corrective.matrices[0] = 4
+        zInvertedBlendShapeMath.write_corrective(self.path, 3, indices, deltas)
+        self.assertIsNone(zInvertedBlendShapeMath.read_corrective(self.path).matrices)
+
+    def test_short_file(self):
+        for data in (b'', b'ZIBS'):
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(ValueError, zInvertedBlendShapeMath.read_corrective, self.path)
+
+    def test_tweak_past_end(self):
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers([0, 3], [0, 0, 0, 1, 1, 1])
+        zInvertedBlendShapeMath.write_corrective(self.path, 3, indices, deltas)
+        self.assertRaises(ValueError, zInvertedBlendShapeMath.read_corrective, self.path)
+
+    def test_wrong_matrix_count(self):
+        indices, deltas = zInvertedBlendShapeMath.tweak_buffers([0], [0, 0, 0])
+        zInvertedBlendShapeMath.write_corrective(self.path, 3, indices, deltas, scaled_matrices([1, 1]), scaled_matrices([1, 1]))
+        self.assertRaises(ValueError, zInvertedBlendShapeMath.read_corrective, self.path)
+
+class TestCorrectiveWithoutNumPy(WithoutNumPy, TestCorrective):
+    pass
+
+if __name__ == '__main__':
+    unittest.main()
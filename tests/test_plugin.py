@@ -0,0 +1,148 @@
+"""
+Tests for the deformer, run against the stand-in API in benchmarks/fake_maya:
+
+    python -m unittest discover -s tests
+"""
+
+import os, shutil, sys, tempfile, threading, unittest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+# This installs the fake API and loads the plugin.
+from benchmark import plugin, node_class, Scene
+import zInvertedBlendShapeMath
+
+def output_points(scene):
+    return list(scene.data_block.get(plugin.MPxGeometryFilter_outputGeom)[0].points)
+
+class TestParallelEvaluation(unittest.TestCase):
+    def test_scheduling_type(self):
+        # Correctives can be evaluated in parallel with each other.
+        node = node_class()
+        self.assertEqual(node.schedulingType(), plugin.OpenMayaMPx.MPxNode.kParallel)
+
+    def test_nodes_on_other_threads(self):
+        # Nodes evaluated on other threads give the same output as evaluating them in turn.
+        densities = [0, 0.01, 0.1, 1]
+        expected = []
+        for density in densities:
+            scene = Scene(1000, density)
+            scene.compute()()
+            expected.append(output_points(scene))
+
+        scenes = [Scene(1000, density) for density in densities]
+        errors = []
+        def compute(scene):
+            try:
+                for i in xrange(5):
+                    scene.compute()()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=compute, args=(scene,)) for scene in scenes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for scene, points in zip(scenes, expected):
+            self.assertEqual(output_points(scene), points)
+
+class TestInvertedTweak(unittest.TestCase):
+    def test_matches_matrices(self):
+        # Each inverted tweak is its .tweak multiplied by its vertex's inversion matrix.
+        scene = Scene(100, 0.1)
+        inverted_tweak = scene.data_block.get(node_class.inverted_tweak_attr)
+        self.assertEqual(sorted(inverted_tweak), sorted(scene.tweaks))
+
+        for idx, (x, y, z) in scene.tweaks.items():
+            m = zInvertedBlendShapeMath.matrix_at(scene.matrices, idx)
+            expected = (x*m[0] + y*m[3] + z*m[6], x*m[1] + y*m[4] + z*m[7], x*m[2] + y*m[5] + z*m[8])
+            for value, expected_value in zip(inverted_tweak[idx], expected):
+                self.assertAlmostEqual(value, expected_value, places=5)
+
+    def test_changed_tweaks(self):
+        # Updating only the changed tweaks gives the same result as rebuilding all of them.
+        scene = Scene(100, 1)
+        tweaks = scene.data_block.get(node_class.tweak_attr)
+        tweaks[5] = (0.5, 0.25, -0.5)
+        del tweaks[6]
+        tweaks[7] = (0, 0, 0)
+        scene.node.dirty_tweak_indices = set([5, 6, 7])
+        scene.node.set_inverted_from_tweak(scene.data_block)
+        changed = dict(scene.data_block.get(node_class.inverted_tweak_attr))
+
+        scene.node.dirty_tweak_indices = None
+        scene.node.set_inverted_from_tweak(scene.data_block)
+        self.assertEqual(changed, scene.data_block.get(node_class.inverted_tweak_attr))
+        self.assertNotIn(6, changed)
+        self.assertNotIn(7, changed)
+
+class TestOutputGeometry(unittest.TestCase):
+    def input_mesh(self, scene):
+        return scene.data_block.get(plugin.MPxGeometryFilter_input)[0][plugin.MPxGeometryFilter_inputGeom]
+
+    def output_mesh(self, scene):
+        return scene.data_block.get(plugin.MPxGeometryFilter_outputGeom)[0]
+
+    def test_envelope_zero(self):
+        # With the envelope at 0, the input is passed through without being copied.
+        scene = Scene(100, 0.1)
+        scene.data_block.set(plugin.MPxGeometryFilter_envelope, 0.0)
+        scene.compute()()
+        self.assertIs(self.output_mesh(scene), self.input_mesh(scene))
+
+    def test_empty_tweak(self):
+        # A corrective that hasn't been sculpted only has the placeholder tweak, so the input
+        # is passed through without being copied.
+        scene = Scene(100, 0)
+        scene.compute()()
+        self.assertIs(self.output_mesh(scene), self.input_mesh(scene))
+
+    def test_tweaked(self):
+        # Tweaks are applied to a copy, leaving the input alone.
+        scene = Scene(100, 0.1)
+        input_points = list(self.input_mesh(scene).points)
+        scene.compute()()
+        self.assertIsNot(self.output_mesh(scene), self.input_mesh(scene))
+        self.assertEqual(list(self.input_mesh(scene).points), input_points)
+        self.assertNotEqual(output_points(scene), input_points)
+
+    def test_partial_set(self):
+        # Only the vertices in the deformer set are moved, whether the tweak is dense or sparse.
+        for density in (1, 0.01):
+            scene = Scene(1000, density)
+            members = range(0, 1000, 2)
+            self.input_mesh(scene).groups[0] = members
+            input_points = list(self.input_mesh(scene).points)
+            scene.compute()()
+
+            points = output_points(scene)
+            for idx in xrange(1000):
+                moved = points[idx*3:idx*3+3] != input_points[idx*3:idx*3+3]
+                self.assertEqual(moved, idx in scene.tweaks and idx % 2 == 0)
+
+class TestCorrectiveFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'body_elbowBend.zibs')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, True)
+
+    def test_name(self):
+        # A file is only read into the corrective it was written for.
+        scene = Scene(100, 0.1)
+        scene.node.write_corrective(self.path, corrective_name='body_elbowBend')
+
+        other = Scene(100, 1)
+        self.assertRaises(RuntimeError, other.node.read_corrective, self.path, corrective_name='body_kneeBend')
+        self.assertEqual(other.node.get_inverted_tweak(other.data_block)[0].tolist(), sorted(other.tweaks))
+
+        other.node.read_corrective(self.path, corrective_name='body_elbowBend')
+        self.assertEqual(other.node.get_inverted_tweak(other.data_block)[0].tolist(), sorted(scene.tweaks))
+
+if __name__ == '__main__':
+    unittest.main()